@@ -22,6 +22,21 @@ ecr_repository_name = config["ecr-repository-name"]
 cpu = config["cpu"]
 memory_limit_mib = config["memory-limit-mib"]
 timeout_minutes = config["timeout-minutes"]
+max_resumes = config["max-resumes"]
+split_range_gb = config["split-range-gb"]
+max_split_ranges = config["max-split-ranges"]
+task_sizes = config["task-sizes"]
+drive_mode = config["drive-mode"]
+split_wait_minutes = config["split-wait-minutes"]
+preflight = config["preflight"]
+worker = config["worker"]
+max_running_extractions = config["max-running-extractions"]
+label_model_version = config["label-model-version"]
+rekognition = config["rekognition"]
+frame_filter = config["frame-filter"]
+mosaic_grid = config["mosaic-grid"]
+labelling_mode = config["labelling-mode"]
+label_output = config["label-output"]
 
 default_environment_vars = config["environment-variables"]
 
@@ -36,6 +51,21 @@ Fargate(
     cpu=cpu,
     memory_limit_mib=memory_limit_mib,
     timeout_minutes=timeout_minutes,
+    max_resumes=max_resumes,
+    split_range_gb=split_range_gb,
+    max_split_ranges=max_split_ranges,
+    task_sizes=task_sizes,
+    drive_mode=drive_mode,
+    split_wait_minutes=split_wait_minutes,
+    preflight=preflight,
+    worker=worker,
+    max_running_extractions=max_running_extractions,
+    label_model_version=label_model_version,
+    rekognition=rekognition,
+    frame_filter=frame_filter,
+    mosaic_grid=mosaic_grid,
+    labelling_mode=labelling_mode,
+    label_output=label_output,
     env=core.Environment(
         account=os.environ["CDK_DEFAULT_ACCOUNT"],
         region=os.environ["CDK_DEFAULT_REGION"])
@@ -5,21 +5,444 @@ import re
 import tarfile
 import os
 import logging
-from botocore.exceptions import ClientError
+import gzip
+import math
+from botocore.exceptions import ClientError, ParamValidationError
 import shutil
 
+from bagindex import NotABagError, read_bag_index, time_range, topic_counts
 
-def trigger_bag_processing(bucket, dest_bucket, prefix):
-    state_machine_arn = os.environ["state_machine_arn"]
-    s3_object = dict(
-        [("bucket", bucket), ("key", prefix), ("dest_bucket", dest_bucket)]
+# bags that can't be admitted yet go back on the queue for this long
+ADMISSION_DELAY_SECONDS = 60
+
+# the item in the slots table counting the slots in use, with an attribute named after each execution holding
+# slots, set to when it took them and how many
+SLOTS_KEY = {"id": "extractions"}
+
+# an execution is started just after its slot is taken, a slot held this long by an execution that doesn't exist
+# was never used (bag-queue-proc failed in between)
+START_GRACE_SECONDS = 15 * 60
+
+# the full object checksums S3 may hold for an object, in the order they are used as its fingerprint
+CHECKSUM_ALGORITHMS = ["CRC64NVME", "SHA256", "SHA1", "CRC32C", "CRC32"]
+
+# a drive recorded as a sequence of split bags <drive>_0.bag, <drive>_1.bag, ...
+DRIVE_SPLIT = re.compile(r"(.*)_(\d+)\.bag$")
+
+
+def extraction_mode(prefix):
+    """
+    Returns the mode the extraction task is run in for a new object, or None if it is not processed on its own. In
+    drive mode the first split of a drive starts a task that works through the rest of the splits as they land.
+    """
+    if not (prefix.endswith(".bag") or prefix.endswith(".tar.gz")):
+        return None
+    match = DRIVE_SPLIT.match(prefix)
+    if os.environ.get("drive_mode") == "true" and match:
+        return "drive" if match.group(2) == "0" else None
+    return "extract"
+
+
+def preflight(s3, bucket, prefix):
+    """
+    Triages a bag from its header and index, read with a couple of ranged GETs, before a Fargate task is started
+    for it. Returns the reason the bag is rejected (None if it should be extracted) and the metadata read, which is
+    passed on in the execution input.
+
+    Only an object that isn't a V2.0 bag at all is rejected without its index. If the header or index can't be read
+    the bag is extracted anyway with no metadata, so that a problem reading them can't turn every bag away.
+    """
+    try:
+        index = read_bag_index(s3, bucket, prefix)
+    except NotABagError as e:
+        return str(e), {}
+    except Exception:
+        logging.exception(f"could not read the index of s3://{bucket}/{prefix}, extracting it without preflight")
+        put_metrics(PreflightErrors=(1, "Count"))
+        return None, {}
+
+    start, end = time_range(index)
+    metadata = {
+        "size": index["size"],
+        "indexed": index["indexed"],
+        "chunk_count": index["chunk_count"],
+        "start_time": start,
+        "end_time": end,
+        "duration": end - start if start is not None else None,
+        "topics": topic_counts(index) if index["indexed"] else {},
+    }
+
+    max_size_gb = float(os.environ.get("preflight_max_size_gb", 0))
+    if max_size_gb and index["size"] > max_size_gb * 1024 ** 3:
+        return f"larger than {max_size_gb} GB", metadata
+
+    if not index["indexed"]:
+        # the bag was not closed properly, the topics and duration can only be found by reading all of it
+        if os.environ.get("preflight_reject_unindexed") == "true":
+            return "no index, the bag is truncated", metadata
+        return None, metadata
+
+    required_topics = [t for t in os.environ.get("preflight_required_topics", "").split(",") if t]
+    if required_topics and not any(metadata["topics"].get(t) for t in required_topics):
+        return f"none of the topics {required_topics}", metadata
+
+    if metadata["duration"] is None:
+        return "no messages", metadata
+    min_duration = float(os.environ.get("preflight_min_duration_seconds", 0))
+    if metadata["duration"] < min_duration:
+        return f"shorter than {min_duration} seconds", metadata
+
+    return None, metadata
+
+
+def reject_bag(s3, bucket, dest_bucket, prefix, reason, metadata):
+    """ Records why a bag was not extracted next to where its outputs would have gone"""
+    logging.warning(f"not extracting s3://{bucket}/{prefix}: {reason}")
+    result = dict(bucket=bucket, key=prefix, reason=reason, bag=metadata)
+    s3.put_object(
+        Bucket=dest_bucket,
+        Key=f"preflight/{prefix}.json.gz",
+        Body=gzip.compress(json.dumps(result).encode()),
+    )
+
+
+def fingerprint(s3, bucket, prefix):
+    """
+    Identifies the content of a new object for the cache of completed extractions, from checksums S3 computed over
+    every byte of it. An object with a full object checksum is identified by its size and that checksum, which stays
+    the same however it was uploaded. Anything else falls back to its size and ETag, which only match for objects
+    uploaded the same way.
+    """
+    try:
+        head = s3.head_object(Bucket=bucket, Key=prefix, ChecksumMode="ENABLED")
+    except ParamValidationError:
+        # a botocore too old to ask for checksums
+        head = s3.head_object(Bucket=bucket, Key=prefix)
+    for algorithm in CHECKSUM_ALGORITHMS:
+        checksum = head.get(f"Checksum{algorithm}")
+        # the checksum of a multipart upload is made of its parts' unless S3 computed it over the whole object, a
+        # composite checksum ends with the number of parts
+        if checksum and "-" not in checksum:
+            return f"{algorithm.lower()}:{head['ContentLength']}:{checksum}"
+    etag = head["ETag"].strip('"')
+    return f"etag:{head['ContentLength']}:{etag}"
+
+
+def completed_extraction(fingerprint):
+    """ Returns the cache entry of an earlier extraction of the same content, or None"""
+    table = boto3.resource("dynamodb").Table(os.environ["cache_table"])
+    return table.get_item(Key={"fingerprint": fingerprint}, ConsistentRead=True).get("Item")
+
+
+def alias_bag(s3, bucket, dest_bucket, prefix, extraction):
+    """ Points a bag that has already been extracted under another key at the outputs of that extraction"""
+    logging.warning(
+        f"s3://{bucket}/{prefix} was already extracted from s3://{extraction['bucket']}/{extraction['key']}"
+    )
+    alias = dict(bucket=bucket, key=prefix, extracted_from=dict(bucket=extraction["bucket"], key=extraction["key"]))
+    s3.put_object(
+        Bucket=dest_bucket,
+        Key=f"aliases/{prefix}.json.gz",
+        Body=gzip.compress(json.dumps(alias).encode()),
     )
+
+
+def put_metrics(**metrics):
+    """ Publishes metrics by logging them in CloudWatch embedded metric format"""
+    print(
+        json.dumps(
+            {
+                "_aws": {
+                    "Timestamp": int(time.time() * 1000),
+                    "CloudWatchMetrics": [
+                        {
+                            "Namespace": "RosbagPipeline",
+                            "Dimensions": [[]],
+                            "Metrics": [{"Name": name, "Unit": unit} for name, (_, unit) in metrics.items()],
+                        }
+                    ],
+                },
+                **{name: value for name, (value, _) in metrics.items()},
+            }
+        )
+    )
+
+
+def task_size(s3, bucket, prefix, metadata, mode="extract"):
+    """
+    Returns the name of the smallest task size configured for bags as large as this one, or None to use the
+    default task definition. In drive mode the task extracts every split of the drive, which have not all landed
+    yet, so it gets the size for bags of any size.
+    """
+    sizes = json.loads(os.environ.get("task_sizes", "[]"))
+    if not sizes:
+        return None
+    if mode == "drive":
+        size = float("inf")
+    elif metadata:
+        size = metadata["size"]
+    else:
+        size = s3.head_object(Bucket=bucket, Key=prefix)["ContentLength"]
+    for t in sorted(sizes, key=lambda t: float("inf") if t["max_bag_gb"] is None else t["max_bag_gb"]):
+        if t["max_bag_gb"] is None or size <= t["max_bag_gb"] * 1024 ** 3:
+            return t["name"]
+    return None
+
+
+def planned_ranges(prefix, mode, metadata):
+    """ The number of ranges plan-bag-ranges will split a bag into given enough slots, each extracted by a task"""
+    if mode != "extract" or not prefix.endswith(".bag") or not metadata or not metadata["indexed"]:
+        return 1
+    if metadata["chunk_count"] < 2:
+        return 1
+    range_bytes = int(os.environ["split_range_gb"]) * 1024 ** 3
+    return max(1, min(int(os.environ["max_split_ranges"]), math.ceil(metadata["size"] / range_bytes)))
+
+
+def running_workers(ecs):
+    return ecs.list_tasks(cluster=os.environ["cluster_arn"], startedBy="bag-worker", desiredStatus="RUNNING")[
+        "taskArns"
+    ]
+
+
+def slots_in_use(table):
+    return int(table.get_item(Key=SLOTS_KEY, ConsistentRead=True).get("Item", {}).get("running", 0))
+
+
+def take_slots(table, limit, name, count):
+    """ Takes count slots for the execution name, as long as no more than limit are then in use (None for no limit)"""
+    update = dict(
+        UpdateExpression="SET #execution = :holder ADD running :count",
+        ConditionExpression="attribute_not_exists(#execution)",
+        ExpressionAttributeNames={"#execution": name},
+        ExpressionAttributeValues={":count": count, ":holder": {"taken_at": int(time.time()), "slots": count}},
+    )
+    if limit is not None:
+        update["ConditionExpression"] += " AND (attribute_not_exists(running) OR running <= :limit)"
+        update["ExpressionAttributeValues"][":limit"] = limit - count
+    try:
+        table.update_item(Key=SLOTS_KEY, **update)
+        return True
+    except ClientError as e:
+        if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+            return False
+        raise
+
+
+def execution_status(client, name, taken_at):
+    """ Returns the status of the execution holding slots, STARTING if it has just taken them"""
+    arn = os.environ["state_machine_arn"].replace(":stateMachine:", ":execution:") + ":" + name
+    try:
+        return client.describe_execution(executionArn=arn)["status"]
+    except client.exceptions.ExecutionDoesNotExist:
+        return "STARTING" if time.time() - taken_at < START_GRACE_SECONDS else None
+
+
+def reclaim_slots(table):
+    """
+    Frees the slots of executions that ended without giving them back, returns True if any were freed. Each holder
+    is recorded with the slots it took, which are only freed once its execution has ended (it was stopped or timed
+    out) or was never started. Freeing them removes the holder in the same conditional update, so slots the
+    execution gives back at the same time are not freed twice.
+    """
+    item = table.get_item(Key=SLOTS_KEY, ConsistentRead=True).get("Item", {})
+    client = boto3.client("stepfunctions")
+    running = 0
+    freed = 0
+    for name, holder in item.items():
+        if name in ("id", "running"):
+            continue
+        if execution_status(client, name, float(holder["taken_at"])) in ("RUNNING", "STARTING"):
+            running += 1
+            continue
+        try:
+            table.update_item(
+                Key=SLOTS_KEY,
+                UpdateExpression="REMOVE #execution ADD running :minus",
+                ConditionExpression="attribute_exists(#execution)",
+                ExpressionAttributeNames={"#execution": name},
+                ExpressionAttributeValues={":minus": -int(holder["slots"])},
+            )
+            freed += 1
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
+    put_metrics(ExtractionsRunning=(running, "Count"))
+    if freed:
+        logging.warning(f"the slots of {freed} extractions were not given back, freed them")
+    return freed > 0
+
+
+def acquire_slots(name, wanted=1):
+    """
+    Takes up to wanted of the max_running_extractions slots (0 for no limit) for the execution name, one for each
+    extraction task it will run at once, returns how many it took, 0 if they are all in use. Every running worker
+    task uses a slot too. The state machine gives the slots back when the execution ends, whether it succeeded or
+    not. An execution that is stopped or times out can't, so when the slots run out the executions holding them are
+    checked.
+    """
+    table = boto3.resource("dynamodb").Table(os.environ["slots_table"])
+    max_running = int(os.environ["max_running_extractions"])
+    if not max_running:
+        take_slots(table, None, name, wanted)
+        return wanted
+    workers = len(running_workers(boto3.client("ecs"))) if float(os.environ.get("worker_max_bag_gb", 0)) else 0
+    limit = max_running - workers
+    count = min(wanted, limit - slots_in_use(table))
+    if count < 1 and reclaim_slots(table):
+        count = min(wanted, limit - slots_in_use(table))
+    if count >= 1 and take_slots(table, limit, name, count):
+        return count
+    return 0
+
+
+def release_slots(name, count):
+    boto3.resource("dynamodb").Table(os.environ["slots_table"]).update_item(
+        Key=SLOTS_KEY,
+        UpdateExpression="REMOVE #execution ADD running :minus",
+        ExpressionAttributeNames={"#execution": name},
+        ExpressionAttributeValues={":minus": -count},
+    )
+
+
+def defer(sqs, queue, body, queued_at):
+    """ Puts a bag that could not be admitted back on the queue, remembering when it first arrived"""
+    sqs.send_message(
+        QueueUrl=queue,
+        MessageBody=json.dumps(body),
+        DelaySeconds=ADMISSION_DELAY_SECONDS,
+        MessageAttributes={"queued_at": {"DataType": "Number", "StringValue": str(queued_at)}},
+    )
+    put_metrics(BagsDeferred=(1, "Count"))
+
+
+def process_new_object(bucket, dest_bucket, prefix, queued_at=None):
+    """ Starts the extraction of a new object, returns False if it has to wait for a slot"""
+    mode = extraction_mode(prefix)
+    if not mode:
+        return True
+    s3 = boto3.client("s3")
+    metadata = None
+    if mode == "extract" and prefix.endswith(".bag"):
+        reason, metadata = preflight(s3, bucket, prefix)
+        if reason:
+            reject_bag(s3, bucket, dest_bucket, prefix, reason, metadata)
+            return True
+
+    cache_key = fingerprint(s3, bucket, prefix)
+    extraction = completed_extraction(cache_key)
+    if extraction:
+        if extraction["bucket"] != bucket or extraction["key"] != prefix:
+            alias_bag(s3, bucket, dest_bucket, prefix, extraction)
+        else:
+            logging.warning(f"s3://{bucket}/{prefix} has already been extracted, skipping it")
+        return True
+    max_worker_gb = float(os.environ.get("worker_max_bag_gb", 0))
+    if mode == "extract" and metadata and metadata["size"] <= max_worker_gb * 1024 ** 3:
+        if not queue_for_worker(bucket, dest_bucket, prefix, mode, cache_key):
+            logging.info(f"no worker is running and the extraction slots are in use, s3://{bucket}/{prefix} waits")
+            return False
+        return True
+
+    name = execution_name(prefix)
+    # a split bag is extracted by as many tasks at once as it has slots
+    slots = acquire_slots(name, planned_ranges(prefix, mode, metadata))
+    if not slots:
+        logging.info(f"all extraction slots are in use, s3://{bucket}/{prefix} has to wait")
+        return False
+    if queued_at:
+        put_metrics(AdmissionWaitSeconds=(time.time() - queued_at, "Seconds"))
+    try:
+        size = task_size(s3, bucket, prefix, metadata, mode)
+        started = trigger_bag_processing(bucket, dest_bucket, prefix, name, mode, metadata, cache_key, size, slots)
+    except Exception:
+        release_slots(name, slots)
+        raise
+    if not started:
+        release_slots(name, slots)
+    return True
+
+
+def queue_for_worker(bucket, dest_bucket, prefix, mode, cache_key):
+    """
+    Sends a small bag to the worker queue rather than starting an execution for it, and starts a worker task if
+    fewer than the maximum are running and one of the max_running_extractions slots is free. Workers extract bags
+    back to back and stop once the queue has been empty for a while. Returns False, without queuing the bag, if no
+    worker is running and none can be started.
+    """
+    ecs = boto3.client("ecs")
+    cluster = os.environ["cluster_arn"]
+    running = running_workers(ecs)
+    start = len(running) < int(os.environ["worker_max_tasks"])
+    max_running = int(os.environ["max_running_extractions"])
+    if start and max_running:
+        # each worker uses a slot, without holding it, for as long as it runs
+        table = boto3.resource("dynamodb").Table(os.environ["slots_table"])
+        in_use = len(running) + slots_in_use(table)
+        if in_use >= max_running and reclaim_slots(table):
+            in_use = len(running) + slots_in_use(table)
+        start = in_use < max_running
+    if not running and not start:
+        return False
+
+    job = dict(bucket=bucket, key=prefix, dest_bucket=dest_bucket, mode=mode, fingerprint=cache_key)
+    boto3.client("sqs").send_message(QueueUrl=os.environ["worker_queue_url"], MessageBody=json.dumps(job))
+    if not start:
+        return True
+    ecs.run_task(
+        cluster=cluster,
+        taskDefinition=os.environ["task_definition_arn"],
+        launchType="FARGATE",
+        platformVersion="1.4.0",
+        startedBy="bag-worker",
+        networkConfiguration={
+            "awsvpcConfiguration": {
+                "subnets": os.environ["worker_subnets"].split(","),
+                "securityGroups": [os.environ["worker_security_group"]],
+                "assignPublicIp": "DISABLED",
+            }
+        },
+        overrides={
+            "containerOverrides": [
+                {
+                    "name": os.environ["container_name"],
+                    "environment": [
+                        {"name": "mode", "value": "worker"},
+                        {"name": "s3_destination", "value": dest_bucket},
+                        {"name": "worker_queue_url", "value": os.environ["worker_queue_url"]},
+                        {"name": "cache_table", "value": os.environ["cache_table"]},
+                        {"name": "worker_concurrency", "value": os.environ["worker_concurrency"]},
+                        {"name": "worker_idle_seconds", "value": os.environ["worker_idle_seconds"]},
+                    ],
+                }
+            ]
+        },
+    )
+    return True
+
+
+def execution_name(prefix):
     now = str(int(time.time()))
     name = prefix + "-sf-" + now
     name = re.sub("\W+", "", name)
     # limit name to 80 chars
-    name = name[-79:]
+    return name[-79:]
+
 
+def trigger_bag_processing(bucket, dest_bucket, prefix, name, mode="extract", metadata=None, cache_key=None,
+                           size=None, slots=1):
+    state_machine_arn = os.environ["state_machine_arn"]
+    s3_object = dict(
+        [("bucket", bucket), ("key", prefix), ("dest_bucket", dest_bucket), ("mode", mode)]
+    )
+    if metadata:
+        s3_object["bag"] = metadata
+    # recorded in the cache by the state machine once the extraction has completed
+    s3_object["fingerprint"] = cache_key
+    if size:
+        s3_object["task_size"] = size
+    # the most ranges plan-bag-ranges may split the bag into, and what the state machine gives back when it ends
+    s3_object["slots"] = str(slots)
     print(s3_object)
     client = boto3.client("stepfunctions")
     try:
@@ -28,6 +451,8 @@ def trigger_bag_processing(bucket, dest_bucket, prefix):
         )
     except client.exceptions.InvalidName as e:
         logging.warning(e)
+        return False
+    return True
 
 
 def lambda_handler(event, context):
@@ -42,18 +467,23 @@ def lambda_handler(event, context):
         for m in messages:
             print(m)
             body = json.loads(m["body"])
+            # when the bag first arrived, for bags that have been waiting for a slot
+            if "queued_at" in m.get("messageAttributes", {}):
+                queued_at = float(m["messageAttributes"]["queued_at"]["stringValue"])
+            else:
+                queued_at = int(m["attributes"]["SentTimestamp"]) / 1000
             if "Records" in body:
                 for r in body["Records"]:
                     bucket = r["s3"]["bucket"]["name"]
                     prefix = r["s3"]["object"]["key"]
                     print(prefix)
-                    if prefix.endswith(".bag"):
-                        trigger_bag_processing(bucket, dest_bucket, prefix)
+                    if not process_new_object(bucket, dest_bucket, prefix, queued_at):
+                        defer(sqs, queue, {"Records": [r]}, queued_at)
             else:
                 bucket = body["s3BucketArn"].replace("arn:aws:s3:::", "")
                 prefix = body["s3Key"]
                 print(prefix)
-                if prefix.endswith(".bag"):
-                    trigger_bag_processing(bucket, dest_bucket, prefix)
+                if not process_new_object(bucket, dest_bucket, prefix, queued_at):
+                    defer(sqs, queue, body, queued_at)
 
     return {"status": 200}
@@ -0,0 +1,178 @@
+# Reads the index of a ROS bag (V2.0) from S3 with ranged GETs, without downloading or decoding any messages.
+#
+# A bag starts with the version line and a bag header record holding the position of the index. The index at the end
+# of the file holds one connection record per topic and one chunk info record per chunk, with the chunk's position,
+# time range and per connection message counts.
+# http://wiki.ros.org/Bags/Format/2.0
+
+import struct
+
+VERSION_LINE = b"#ROSBAG V2.0\n"
+
+OP_MSG_DATA = 2
+OP_BAG_HEADER = 3
+OP_INDEX_DATA = 4
+OP_CHUNK = 5
+OP_CHUNK_INFO = 6
+OP_CONNECTION = 7
+
+# the header and data of the bag header record are padded to 4096 bytes, which with the two lengths is 4104 (some
+# writers pad the whole record to 4096 instead). read_bag_header reads more if the lengths say the record is longer.
+BAG_HEADER_READ_SIZE = len(VERSION_LINE) + 4096 + 8
+
+
+class BagFormatError(Exception):
+    pass
+
+
+class NotABagError(BagFormatError):
+    """ The object doesn't start with the V2.0 version line, as opposed to a bag whose records can't be parsed"""
+
+
+def read_range(s3, bucket, key, start, end=None):
+    """ Returns the bytes [start, end) of an S3 object, or everything from start if end is None"""
+    byte_range = f"bytes={start}-" if end is None else f"bytes={start}-{end - 1}"
+    return s3.get_object(Bucket=bucket, Key=key, Range=byte_range)["Body"].read()
+
+
+def parse_fields(buf):
+    """ Parses a record header (or connection header) into a dict of field name -> raw bytes"""
+    fields = {}
+    pos = 0
+    while pos < len(buf):
+        (field_len,) = struct.unpack_from("<I", buf, pos)
+        pos += 4
+        field = bytes(buf[pos : pos + field_len])
+        pos += field_len
+        name, _, value = field.partition(b"=")
+        fields[name.decode("ISO-8859-1")] = value
+    return fields
+
+
+def record_end(buf, pos):
+    """ The offset the record at pos ends at, None if buf doesn't hold both its lengths"""
+    if pos + 4 > len(buf):
+        return None
+    (hdr_len,) = struct.unpack_from("<I", buf, pos)
+    if pos + 8 + hdr_len > len(buf):
+        return None
+    (data_len,) = struct.unpack_from("<I", buf, pos + 4 + hdr_len)
+    return pos + 8 + hdr_len + data_len
+
+
+def iter_records(buf, pos=0):
+    """ Yields (offset, header fields, data) for every complete record in buf"""
+    while pos + 4 <= len(buf):
+        (hdr_len,) = struct.unpack_from("<I", buf, pos)
+        if hdr_len == 0 or pos + 8 + hdr_len > len(buf):
+            return
+        header = parse_fields(buf[pos + 4 : pos + 4 + hdr_len])
+        (data_len,) = struct.unpack_from("<I", buf, pos + 4 + hdr_len)
+        data_start = pos + 8 + hdr_len
+        if data_start + data_len > len(buf):
+            return
+        yield pos, header, buf[data_start : data_start + data_len]
+        pos = data_start + data_len
+
+
+def ros_time(value):
+    secs, nsecs = struct.unpack("<II", value)
+    return secs + nsecs / 1e9
+
+
+def conn_id(value):
+    return struct.unpack("<I", value)[0]
+
+
+def parse_connection(header, data):
+    fields = parse_fields(data)
+    connection = {k: v.decode("ISO-8859-1") for k, v in fields.items()}
+    connection["topic"] = header["topic"].decode("ISO-8859-1")
+    # the id as stored in the bag, which is how the extractor keys its connections
+    connection["conn"] = header["conn"].hex()
+    return connection
+
+
+def parse_chunk_info(header, data):
+    counts = {}
+    for i in range(conn_id(header["count"])):
+        conn, count = struct.unpack_from("<II", data, i * 8)
+        counts[struct.pack("<I", conn).hex()] = count
+    return {
+        "pos": struct.unpack("<Q", header["chunk_pos"])[0],
+        "start_time": ros_time(header["start_time"]),
+        "end_time": ros_time(header["end_time"]),
+        "counts": counts,
+    }
+
+
+def read_bag_header(s3, bucket, key, head=None):
+    """ Parses the bag header, from head (the first BAG_HEADER_READ_SIZE bytes of the bag) if already read"""
+    if head is None:
+        head = read_range(s3, bucket, key, 0, BAG_HEADER_READ_SIZE)
+    if not head.startswith(VERSION_LINE):
+        raise NotABagError(f"s3://{bucket}/{key} is not a V2.0 ROS bag")
+    end = record_end(head, len(VERSION_LINE))
+    if end is not None and len(head) < end <= len(head) + 1024 ** 2:
+        # a record padded more than we read up front
+        head = head + read_range(s3, bucket, key, len(head), end)
+    for _, header, _ in iter_records(head, len(VERSION_LINE)):
+        if header["op"][0] == OP_BAG_HEADER:
+            return {
+                "index_pos": struct.unpack("<Q", header["index_pos"])[0],
+                "conn_count": conn_id(header["conn_count"]),
+                "chunk_count": conn_id(header["chunk_count"]),
+            }
+    raise BagFormatError(f"s3://{bucket}/{key} has no bag header")
+
+
+def read_bag_index(s3, bucket, key, size=None):
+    """
+    Reads the bag header and the index at the end of the bag with two ranged GETs. Returns a dict with the object
+    size, the bag header fields, the connections and the chunk infos sorted by position. indexed is False if the
+    bag was never closed properly (index_pos is 0) or the index is incomplete, in which case only the connections
+    found are returned.
+    """
+    if size is None:
+        size = s3.head_object(Bucket=bucket, Key=key)["ContentLength"]
+
+    head = read_range(s3, bucket, key, 0, BAG_HEADER_READ_SIZE)
+    index = read_bag_header(s3, bucket, key, head)
+    index["size"] = size
+    index["connections"] = {}
+    index["chunks"] = []
+    if index["index_pos"] == 0 or index["index_pos"] >= size:
+        index["indexed"] = False
+        return index
+
+    buf = read_range(s3, bucket, key, index["index_pos"])
+    for _, header, data in iter_records(buf):
+        op = header["op"][0]
+        if op == OP_CONNECTION:
+            connection = parse_connection(header, data)
+            index["connections"][connection["conn"]] = connection
+        elif op == OP_CHUNK_INFO:
+            index["chunks"].append(parse_chunk_info(header, data))
+
+    index["chunks"].sort(key=lambda c: c["pos"])
+    index["indexed"] = (
+        len(index["connections"]) == index["conn_count"] and len(index["chunks"]) == index["chunk_count"]
+    )
+    return index
+
+
+def topic_counts(index):
+    """ Returns the number of messages per topic"""
+    counts = {}
+    for chunk in index["chunks"]:
+        for conn, count in chunk["counts"].items():
+            topic = index["connections"][conn]["topic"]
+            counts[topic] = counts.get(topic, 0) + count
+    return counts
+
+
+def time_range(index):
+    """ Returns the (start, end) time of the bag in seconds, or (None, None) if it has no chunk infos"""
+    if not index["chunks"]:
+        return None, None
+    return min(c["start_time"] for c in index["chunks"]), max(c["end_time"] for c in index["chunks"])
@@ -42,6 +42,21 @@ class Fargate(core.Stack):
         memory_limit_mib: int,
         cpu: int,
         timeout_minutes: int,
+        max_resumes: int,
+        split_range_gb: int,
+        max_split_ranges: int,
+        task_sizes: list,
+        drive_mode: bool,
+        split_wait_minutes: int,
+        preflight: dict,
+        worker: dict,
+        max_running_extractions: int,
+        label_model_version: str,
+        rekognition: dict,
+        frame_filter: dict,
+        mosaic_grid: list,
+        labelling_mode: str,
+        label_output: str,
         **kwargs,
     ) -> None:
 
@@ -151,39 +166,74 @@ class Fargate(core.Stack):
             ),
             transit_encryption="ENABLED",
         )
-        task_definition = ecs.FargateTaskDefinition(
-            self,
-            f"{image_name}_task_definition",
-            family=f"{image_name}-family",
-            cpu=cpu,
-            memory_limit_mib=memory_limit_mib,
-            task_role=ecs_task_role,
-            volumes=[ecs.Volume(name="rosbagVolume", efs_volume_configuration=vc)],
-        )
-
         repo = ecr.Repository.from_repository_name(
             self, id=id, repository_name=ecr_repository_name
         )
         img = ecs.EcrImage.from_ecr_repository(repository=repo, tag="latest")
 
-        logs = ecs.LogDriver.aws_logs(
-            stream_prefix="ecs",
-            log_group=aws_logs.LogGroup(self, f"{image_name}-log-group2"),
-        )
+        log_group = aws_logs.LogGroup(self, f"{image_name}-log-group2")
 
         container_name = f"{image_name}-container"
 
-        container_def = task_definition.add_container(
-            container_name,
-            image=img,
-            memory_limit_mib=memory_limit_mib,
-            environment={"topics_to_extract": "/tf"},
-            logging=logs,
+        # counters of the frames queued, labelled and failed for each drive and camera, to monitor the pipeline
+        rek_progress_db = dynamodb.Table(
+            self,
+            "RekProgress",
+            partition_key=dynamodb.Attribute(
+                name="drive", type=dynamodb.AttributeType.STRING
+            ),
+            sort_key=dynamodb.Attribute(
+                name="camera", type=dynamodb.AttributeType.STRING
+            ),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
         )
-        mp = ecs.MountPoint(
-            container_path="/root/efs", read_only=False, source_volume="rosbagVolume"
+
+        def add_task_definition(id, family, cpu, memory_limit_mib):
+            """ Returns a task definition for the extraction container with the given size"""
+            task_definition = ecs.FargateTaskDefinition(
+                self,
+                id,
+                family=family,
+                cpu=cpu,
+                memory_limit_mib=memory_limit_mib,
+                task_role=ecs_task_role,
+                volumes=[ecs.Volume(name="rosbagVolume", efs_volume_configuration=vc)],
+            )
+            container_def = task_definition.add_container(
+                container_name,
+                image=img,
+                memory_limit_mib=memory_limit_mib,
+                environment={
+                    "topics_to_extract": "/tf",
+                    "scene_change_threshold": str(frame_filter["scene-change-threshold"]),
+                    "keyframe_seconds": str(frame_filter["keyframe-seconds"]),
+                    "mosaic_cols": str(mosaic_grid[0]),
+                    "mosaic_rows": str(mosaic_grid[1]),
+                    "progress_table": rek_progress_db.table_name,
+                },
+                logging=ecs.LogDriver.aws_logs(stream_prefix="ecs", log_group=log_group),
+            )
+            mp = ecs.MountPoint(
+                container_path="/root/efs", read_only=False, source_volume="rosbagVolume"
+            )
+            container_def.add_mount_points(mp)
+            return task_definition
+
+        # the default size, used for the ranges of split bags, merges and workers
+        task_definition = add_task_definition(
+            f"{image_name}_task_definition", f"{image_name}-family", cpu, memory_limit_mib
         )
-        container_def.add_mount_points(mp)
+
+        # bags are extracted by the first of these that fits them, picked by bag-queue-proc
+        sized_task_definitions = {
+            size["name"]: add_task_definition(
+                f"{image_name}_{size['name']}_task_definition",
+                f"{image_name}-{size['name']}-family",
+                size["cpu"],
+                size["memory-limit-mib"],
+            )
+            for size in task_sizes
+        }
 
         # Define an ECS cluster hosted within the requested VPC
         cluster = ecs.Cluster(
@@ -194,44 +244,301 @@ class Fargate(core.Stack):
             vpc=vpc,
         )
 
-        run_task = tasks.EcsRunTask(
-            self,
-            "fargatetask",
-            assign_public_ip=False,
-            subnets=private_subnets,
-            cluster=cluster,
-            launch_target=tasks.EcsFargateLaunchTarget(
-                platform_version=ecs.FargatePlatformVersion.VERSION1_4
-            ),
-            task_definition=task_definition,
-            container_overrides=[
-                tasks.ContainerOverride(
-                    container_definition=task_definition.default_container,
-                    environment=[
-                        tasks.TaskEnvironmentVariable(
-                            name=k, value=sfn.JsonPath.string_at(v)
+        def extraction_task(id, environment, task_definition=task_definition):
+            """
+            Returns the first state of the extraction container's run with the given environment overrides, and a
+            state that is reached once it has succeeded. A task that exits non-zero, is stopped before its container
+            exits or times out is run again and resumes from the last checkpoint the failed task saved, up to
+            max_resumes times, after which the execution fails.
+            """
+            run_task = tasks.EcsRunTask(
+                self,
+                id,
+                assign_public_ip=False,
+                subnets=private_subnets,
+                cluster=cluster,
+                launch_target=tasks.EcsFargateLaunchTarget(
+                    platform_version=ecs.FargatePlatformVersion.VERSION1_4
+                ),
+                task_definition=task_definition,
+                container_overrides=[
+                    tasks.ContainerOverride(
+                        container_definition=task_definition.default_container,
+                        environment=environment,
+                    )
+                ],
+                integration_pattern=sfn.IntegrationPattern.RUN_JOB,
+                input_path=sfn.JsonPath.entire_payload,
+                result_path="$.task_result",
+                timeout=core.Duration.minutes(timeout_minutes),
+            )
+            # a task that timed out is resumed like one that failed, and counts against max_resumes
+            run_task.add_retry(errors=[sfn.Errors.TIMEOUT], max_attempts=0)
+            run_task.add_retry(
+                backoff_rate=1, interval=core.Duration.seconds(60), max_attempts=1920
+            )
+
+            fs.connections.allow_default_port_from(run_task.connections)
+
+            task_succeeded = sfn.Condition.and_(
+                sfn.Condition.is_present("$.task_result.Containers[0].ExitCode"),
+                sfn.Condition.number_equals("$.task_result.Containers[0].ExitCode", 0),
+            )
+            start = sfn.Pass(
+                self,
+                f"{id}Start",
+                result=sfn.Result.from_object({"count": 0}),
+                result_path="$.resumes",
+            ).next(run_task)
+            resume_task = (
+                sfn.Choice(self, f"{id}CanResume")
+                .when(
+                    sfn.Condition.number_greater_than_equals("$.resumes.count", max_resumes),
+                    sfn.Fail(
+                        self,
+                        f"{id}Failed",
+                        error="ExtractionTaskFailed",
+                        cause=f"{id} failed after {max_resumes} resumes",
+                    ),
+                )
+                .otherwise(
+                    sfn.Pass(
+                        self,
+                        f"{id}CountResume",
+                        # States.MathAdd has no JsonPath helper in this CDK version
+                        parameters={"count.$": "States.MathAdd($.resumes.count, 1)"},
+                        result_path="$.resumes",
+                    )
+                    .next(
+                        sfn.Wait(
+                            self,
+                            f"{id}WaitBeforeResume",
+                            time=sfn.WaitTime.duration(core.Duration.seconds(60)),
                         )
-                        for k, v in environment_vars.items()
-                    ],
+                    )
+                    .next(run_task)
                 )
+            )
+            run_task.add_catch(resume_task, errors=[sfn.Errors.TIMEOUT], result_path="$.task_error")
+            complete = sfn.Pass(self, f"{id}Complete", result_path=sfn.JsonPath.DISCARD)
+            run_task.next(
+                sfn.Choice(self, f"{id}Succeeded")
+                .when(task_succeeded, complete)
+                .otherwise(resume_task)
+            )
+            return start, complete
+
+        task_environment = [
+            tasks.TaskEnvironmentVariable(name=k, value=sfn.JsonPath.string_at(v))
+            for k, v in environment_vars.items()
+        ]
+
+        # Bags larger than split_range_gb are split into byte ranges along their chunks, extracted by parallel tasks
+        # and stitched back together by a merge task
+        bagindex_layer = aws_lambda.LayerVersion(
+            self,
+            "BagIndexLayer",
+            code=aws_lambda.Code.from_asset("./infrastructure/bagindex-layer"),
+            compatible_runtimes=[aws_lambda.Runtime("python3.7")],
+        )
+
+        plan_lambda = aws_lambda.Function(
+            self,
+            "PlanBagRanges",
+            code=aws_lambda.Code.from_asset("./infrastructure/plan-bag-ranges"),
+            environment={
+                "range_gb": str(split_range_gb),
+                "max_ranges": str(max_split_ranges),
+            },
+            memory_size=1024,
+            timeout=core.Duration.minutes(5),
+            vpc=vpc,
+            retry_attempts=0,
+            handler="plan-bag-ranges.lambda_handler",
+            runtime=aws_lambda.Runtime("python3.7", supports_inline_code=True),
+            layers=[bagindex_layer],
+        )
+        plan_lambda.add_to_role_policy(
+            aws_iam.PolicyStatement(
+                actions=[
+                    "kms:Decrypt",
+                    "kms:Encrypt",
+                    "kms:ReEncrypt*",
+                    "kms:DescribeKey",
+                    "kms:GenerateDataKey",
+                ],
+                resources=["*"],
+            )
+        )
+        plan_lambda.add_to_role_policy(
+            aws_iam.PolicyStatement(
+                actions=["s3:List*", "s3:Get*", "s3:PutObject"], resources=["*"]
+            )
+        )
+
+        plan_ranges = tasks.LambdaInvoke(
+            self,
+            "PlanRanges",
+            lambda_function=plan_lambda,
+            payload_response_only=True,
+            result_path="$.plan",
+        )
+
+        # Completed extractions by the fingerprint of the source object, bag-queue-proc skips bags found here
+        extraction_cache = dynamodb.Table(
+            self,
+            "ExtractionCache",
+            partition_key=dynamodb.Attribute(
+                name="fingerprint", type=dynamodb.AttributeType.STRING
+            ),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+        )
+
+        record_extraction = tasks.DynamoPutItem(
+            self,
+            "RecordExtraction",
+            table=extraction_cache,
+            item={
+                "fingerprint": tasks.DynamoAttributeValue.from_string(
+                    sfn.JsonPath.string_at("$.fingerprint")
+                ),
+                "bucket": tasks.DynamoAttributeValue.from_string(
+                    sfn.JsonPath.string_at("$.bucket")
+                ),
+                "key": tasks.DynamoAttributeValue.from_string(
+                    sfn.JsonPath.string_at("$.key")
+                ),
+                "execution": tasks.DynamoAttributeValue.from_string(
+                    sfn.JsonPath.string_at("$$.Execution.Id")
+                ),
+            },
+            result_path=sfn.JsonPath.DISCARD,
+        )
+
+        extract_environment = task_environment + [
+            # "extract", or "drive" to extract the split bags of a drive as one
+            tasks.TaskEnvironmentVariable(
+                name="mode", value=sfn.JsonPath.string_at("$.mode")
+            ),
+            tasks.TaskEnvironmentVariable(
+                name="split_wait_seconds", value=str(split_wait_minutes * 60)
+            ),
+        ]
+        extract_task, extract_complete = extraction_task(
+            "fargatetask", extract_environment
+        )
+
+        # run the extraction with the task size bag-queue-proc picked for the bag, if any
+        choose_task_size = sfn.Choice(self, "TaskSize").otherwise(extract_task)
+        for name, sized_task_definition in sized_task_definitions.items():
+            sized_task, sized_complete = extraction_task(
+                f"ExtractTask-{name}", extract_environment, sized_task_definition
+            )
+            sized_complete.next(record_extraction)
+            choose_task_size.when(
+                sfn.Condition.and_(
+                    sfn.Condition.is_present("$.task_size"),
+                    sfn.Condition.string_equals("$.task_size", name),
+                ),
+                sized_task,
+            )
+
+        range_task, _ = extraction_task(
+            "ExtractRangeTask",
+            task_environment
+            + [
+                tasks.TaskEnvironmentVariable(name="mode", value="range"),
+                tasks.TaskEnvironmentVariable(
+                    name="plan_key", value=sfn.JsonPath.string_at("$.plan_key")
+                ),
+                tasks.TaskEnvironmentVariable(
+                    name="range_index", value=sfn.JsonPath.string_at("$.range_index")
+                ),
             ],
-            integration_pattern=sfn.IntegrationPattern.RUN_JOB,
-            input_path=sfn.JsonPath.entire_payload,
-            output_path=sfn.JsonPath.entire_payload,
-            timeout=core.Duration.minutes(timeout_minutes),
         )
-        run_task.add_retry(
-            backoff_rate=1, interval=core.Duration.seconds(60), max_attempts=1920
+        extract_ranges = sfn.Map(
+            self,
+            "ExtractRanges",
+            items_path="$.plan.ranges",
+            # PlanRanges makes no more ranges than the execution holds slots for
+            max_concurrency=max_split_ranges,
+            parameters={
+                "bucket": sfn.JsonPath.string_at("$.bucket"),
+                "key": sfn.JsonPath.string_at("$.key"),
+                "dest_bucket": sfn.JsonPath.string_at("$.dest_bucket"),
+                "plan_key": sfn.JsonPath.string_at("$.plan.plan_key"),
+                "range_index": sfn.JsonPath.string_at("$$.Map.Item.Value"),
+            },
+            result_path=sfn.JsonPath.DISCARD,
+        ).iterator(range_task)
+
+        merge_task, merge_complete = extraction_task(
+            "MergeRangesTask",
+            task_environment + [tasks.TaskEnvironmentVariable(name="mode", value="merge")],
+        )
+
+        extract_complete.next(record_extraction)
+        merge_complete.next(record_extraction)
+
+        extraction = plan_ranges.next(
+            sfn.Choice(self, "SplitBag")
+            .when(
+                sfn.Condition.number_greater_than("$.plan.range_count", 1),
+                extract_ranges.next(merge_task),
+            )
+            .otherwise(choose_task_size)
         )
 
-        fs.connections.allow_default_port_from(run_task.connections)
+        # bag-queue-proc takes a slot for each task an execution will run at once before starting it, so that no more
+        # than max-running-extractions extraction tasks run at once, workers included. The execution gives them back
+        # when it ends whether or not the extraction succeeded. The item records the execution holding each slot and
+        # how many it took, so that the slots of stopped executions can be told apart
+        extraction_slots = dynamodb.Table(
+            self,
+            "ExtractionSlots",
+            partition_key=dynamodb.Attribute(
+                name="id", type=dynamodb.AttributeType.STRING
+            ),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+        )
+
+        def release_slot(id):
+            return tasks.DynamoUpdateItem(
+                self,
+                id,
+                table=extraction_slots,
+                key={"id": tasks.DynamoAttributeValue.from_string("extractions")},
+                update_expression="REMOVE #execution SET running = running - :slots",
+                expression_attribute_names={
+                    "#execution": sfn.JsonPath.string_at("$$.Execution.Name")
+                },
+                expression_attribute_values={
+                    ":slots": tasks.DynamoAttributeValue.number_from_string(
+                        sfn.JsonPath.string_at("$.slots")
+                    )
+                },
+                result_path=sfn.JsonPath.DISCARD,
+            )
+
+        definition = (
+            sfn.Parallel(self, "Extraction", result_path=sfn.JsonPath.DISCARD)
+            .branch(extraction)
+            .add_catch(
+                release_slot("ReleaseSlotAfterFailure").next(
+                    sfn.Fail(self, "ExtractionFailed")
+                ),
+                result_path="$.error",
+            )
+            .next(release_slot("ReleaseSlot"))
+        )
 
         state_logs = aws_logs.LogGroup(self, "stateLogs")
         state_machine = sfn.StateMachine(
             self,
             "RunTaskStateMachine",
-            definition=run_task,
-            timeout=core.Duration.minutes(timeout_minutes),
+            definition=definition,
+            # the ranges of a split bag and then the merge task, each run up to max_resumes + 1 times a minute apart
+            timeout=core.Duration.minutes(2 * (max_resumes + 1) * (timeout_minutes + 1)),
             logs=sfn.LogOptions(destination=state_logs),
         )
 
@@ -240,21 +547,56 @@ class Fargate(core.Stack):
         input_bag_queue = aws_sqs.Queue(
             self, "inputBagQueue", visibility_timeout=core.Duration.minutes(5)
         )
+
+        # Bags up to worker max-bag-gb are queued for long running worker tasks, which extract them back to back
+        # without a state machine execution and task launch per bag
+        worker_bag_queue = aws_sqs.Queue(
+            self,
+            "workerBagQueue",
+            visibility_timeout=core.Duration.minutes(15),
+            dead_letter_queue=aws_sqs.DeadLetterQueue(
+                max_receive_count=10, queue=aws_sqs.Queue(self, "workerBagDlq")
+            ),
+        )
+        worker_bag_queue.grant_consume_messages(ecs_task_role)
+        extraction_cache.grant_write_data(ecs_task_role)
+        rek_progress_db.grant_write_data(ecs_task_role)
+        worker_security_group = ec2.SecurityGroup(self, "WorkerSecurityGroup", vpc=vpc)
+        fs.connections.allow_default_port_from(worker_security_group)
         # send .png object created events to our SQS input queue
         src_bucket.add_event_notification(
             aws_s3.EventType.OBJECT_CREATED,
             s3n.SqsDestination(input_bag_queue),
             aws_s3.NotificationKeyFilter(suffix="bag"),
         )
+        # archives of bags are streamed through the same extraction task
+        src_bucket.add_event_notification(
+            aws_s3.EventType.OBJECT_CREATED,
+            s3n.SqsDestination(input_bag_queue),
+            aws_s3.NotificationKeyFilter(suffix="tar.gz"),
+        )
 
         # Create the SQS queue for input/results jobs and SNS for job completion notifications
         dlq = aws_sqs.Queue(self, "dlq")
+        # a frame that keeps failing to be labelled ends up in the dlq rather than being redelivered forever
         rek_job_queue = aws_sqs.Queue(
-            self, "rekJobQueue", visibility_timeout=core.Duration.minutes(2)
+            self,
+            "rekJobQueue",
+            visibility_timeout=core.Duration.minutes(10),
+            dead_letter_queue=aws_sqs.DeadLetterQueue(max_receive_count=5, queue=dlq),
         )
         rek_results_queue = aws_sqs.Queue(
             self, "rekResultQueue", visibility_timeout=core.Duration.minutes(5)
         )
+        # the frames the labelling Lambdas found a VRU in, with their labels, for SelectLabellingImgs to anonymize
+        anonymize_queue = aws_sqs.Queue(
+            self,
+            "anonymizeQueue",
+            visibility_timeout=core.Duration.minutes(15),
+            dead_letter_queue=aws_sqs.DeadLetterQueue(
+                max_receive_count=5, queue=aws_sqs.Queue(self, "anonymizeDlq")
+            ),
+        )
 
         ## TESTING - this lamda is for development and allows us to push a bunch of .bag files through
         # without having to copy them into teh src bucket. Create a manifest and then use that with
@@ -305,6 +647,33 @@ class Fargate(core.Stack):
                 "state_machine_arn": state_machine.state_machine_arn,
                 "dest_bucket": dest_bucket.bucket_name,
                 "topics_to_extract": "/gps",
+                "drive_mode": "true" if drive_mode else "false",
+                # bags failing these checks are not extracted, see preflight/ in the destination bucket
+                "preflight_required_topics": ",".join(preflight["required-topics"]),
+                "preflight_min_duration_seconds": str(preflight["min-duration-seconds"]),
+                "preflight_max_size_gb": str(preflight["max-size-gb"]),
+                "preflight_reject_unindexed": "true" if preflight["reject-unindexed"] else "false",
+                "cache_table": extraction_cache.table_name,
+                "slots_table": extraction_slots.table_name,
+                "max_running_extractions": str(max_running_extractions),
+                # to take a slot for each range a bag will be split into
+                "split_range_gb": str(split_range_gb),
+                "max_split_ranges": str(max_split_ranges),
+                "task_sizes": json.dumps(
+                    [{"name": t["name"], "max_bag_gb": t["max-bag-gb"]} for t in task_sizes]
+                ),
+                "worker_max_bag_gb": str(worker["max-bag-gb"] if worker["enabled"] else 0),
+                "worker_max_tasks": str(worker["max-tasks"]),
+                "worker_concurrency": str(worker["concurrency"]),
+                "worker_idle_seconds": str(worker["idle-minutes"] * 60),
+                "worker_queue_url": worker_bag_queue.queue_url,
+                "cluster_arn": cluster.cluster_arn,
+                "task_definition_arn": task_definition.task_definition_arn,
+                "container_name": container_name,
+                "worker_subnets": ",".join(
+                    s.subnet_id for s in vpc.select_subnets(subnet_type=ec2.SubnetType.PRIVATE).subnets
+                ),
+                "worker_security_group": worker_security_group.security_group_id,
             },
             memory_size=3008,
             timeout=core.Duration.minutes(5),
@@ -313,6 +682,7 @@ class Fargate(core.Stack):
             handler="bag-queue-proc.lambda_handler",
             runtime=aws_lambda.Runtime("python3.7", supports_inline_code=True),
             security_groups=fs.connections.security_groups,
+            layers=[bagindex_layer],
         )
         # SQS queue of .bag files to be processed
         bag_queue_lambda.add_event_source(les.SqsEventSource(input_bag_queue))
@@ -334,6 +704,37 @@ class Fargate(core.Stack):
                 actions=["s3:List*", "s3:Get*", "s3:PutObject"], resources=["*"]
             )
         )
+        extraction_cache.grant_read_data(bag_queue_lambda.role)
+        extraction_slots.grant_read_write_data(bag_queue_lambda.role)
+        # bags waiting for a slot go back on the input queue
+        input_bag_queue.grant_send_messages(bag_queue_lambda.role)
+        # to check on the executions holding slots when they run out
+        bag_queue_lambda.add_to_role_policy(
+            aws_iam.PolicyStatement(
+                actions=["states:DescribeExecution"],
+                resources=[
+                    f"arn:aws:states:{region}:{account}:execution:{state_machine.state_machine_name}:*"
+                ],
+            )
+        )
+        worker_bag_queue.grant_send_messages(bag_queue_lambda.role)
+        bag_queue_lambda.add_to_role_policy(
+            aws_iam.PolicyStatement(
+                actions=["ecs:RunTask"], resources=[task_definition.task_definition_arn]
+            )
+        )
+        bag_queue_lambda.add_to_role_policy(
+            aws_iam.PolicyStatement(actions=["ecs:ListTasks"], resources=["*"])
+        )
+        bag_queue_lambda.add_to_role_policy(
+            aws_iam.PolicyStatement(
+                actions=["iam:PassRole"],
+                resources=[
+                    task_definition.task_role.role_arn,
+                    task_definition.obtain_execution_role().role_arn,
+                ],
+            )
+        )
         bag_queue_lambda.add_to_role_policy(
             aws_iam.PolicyStatement(
                 actions=["states:StartExecution"],
@@ -356,21 +757,30 @@ class Fargate(core.Stack):
             billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
         )
 
-        # create a DynamoDB table to monitor/debug the pipeline
-        rek_monitor_db = dynamodb.Table(
+        # the DetectLabels results of each frame by a hash of its bytes, so frames extracted again are not relabelled
+        rek_label_cache = dynamodb.Table(
             self,
-            "RekMonitor",
+            "RekLabelCache",
             partition_key=dynamodb.Attribute(
-                name="img_file", type=dynamodb.AttributeType.STRING
+                name="content_hash", type=dynamodb.AttributeType.STRING
             ),
             billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
         )
 
-        # send .png object created events to our SQS input queue
-        dest_bucket.add_event_notification(
-            aws_s3.EventType.OBJECT_CREATED,
-            s3n.SqsDestination(rek_job_queue),
-            aws_s3.NotificationKeyFilter(suffix="png"),
+        # send .png object created events to our SQS input queue, unless the frames are labelled from the mp4s
+        if labelling_mode == "frames":
+            dest_bucket.add_event_notification(
+                aws_s3.EventType.OBJECT_CREATED,
+                s3n.SqsDestination(rek_job_queue),
+                aws_s3.NotificationKeyFilter(suffix="png"),
+            )
+
+        # the helpers the labelling Lambdas share
+        labels_layer = aws_lambda.LayerVersion(
+            self,
+            "FrameLabelsLayer",
+            code=aws_lambda.Code.from_asset("./infrastructure/labels-layer"),
+            compatible_runtimes=[aws_lambda.Runtime("python3.7")],
         )
 
         # Lambda to call Rekogition DetectLabels API syncronously
@@ -379,24 +789,55 @@ class Fargate(core.Stack):
             "RekSyncProcessor",
             code=aws_lambda.Code.from_asset("./infrastructure/process-queue-sync"),
             environment={
-                "job_queue_url": rek_job_queue.queue_url,
                 "results_table": rek_labels_db.table_name,
-                "monitor_table": rek_monitor_db.table_name,
+                "progress_table": rek_progress_db.table_name,
+                "label_cache_table": rek_label_cache.table_name,
+                # cached labels from any other model version are ignored
+                "label_model_version": label_model_version,
+                # "jsonl" writes a part per camera per batch, "json" a file per frame
+                "label_output": label_output,
+                "anonymize_queue_url": anonymize_queue.queue_url,
                 "frame_duration": "67",
+                # DetectLabels calls per second per Lambda instance, and how many frames are labelled at once. The
+                # instances share rekognition tps, as no more than max-concurrency of them run at once.
+                "rekognition_tps": str(rekognition["tps"] / rekognition["max-concurrency"]),
+                "rekognition_workers": "10",
             },
             memory_size=3008,
-            # reserved_concurrent_executions=20,
-            timeout=core.Duration.minutes(2),
+            reserved_concurrent_executions=rekognition["max-concurrency"],
+            timeout=core.Duration.minutes(5),
             vpc=vpc,
             retry_attempts=0,
             handler="process-queue-sync.lambda_handler",
             runtime=aws_lambda.Runtime("python3.7", supports_inline_code=True),
             security_groups=fs.connections.security_groups,
+            layers=[labels_layer],
         )
 
-        process_rek_sync_lambda.add_event_source(les.SqsEventSource(rek_job_queue))
+        # the Lambda reports which messages of a batch failed, so only those are retried. SqsEventSource can't be
+        # configured to do that yet, hence the mapping and property override.
+        rek_job_mapping = aws_lambda.EventSourceMapping(
+            self,
+            "RekSyncJobMapping",
+            target=process_rek_sync_lambda,
+            event_source_arn=rek_job_queue.queue_arn,
+            # large batches mean fewer, larger label parts
+            batch_size=100,
+            max_batching_window=core.Duration.seconds(20),
+        )
+        rek_job_mapping.node.default_child.add_property_override(
+            "FunctionResponseTypes", ["ReportBatchItemFailures"]
+        )
+        # invoking no more instances than the reserved concurrency, rather than having the extra invocations
+        # throttled and their messages received again
+        rek_job_mapping.node.default_child.add_property_override(
+            "ScalingConfig", {"MaximumConcurrency": rekognition["max-concurrency"]}
+        )
+        rek_job_queue.grant_consume_messages(process_rek_sync_lambda)
+        anonymize_queue.grant_send_messages(process_rek_sync_lambda)
         rek_labels_db.grant_read_write_data(process_rek_sync_lambda.role)
-        rek_monitor_db.grant_read_write_data(process_rek_sync_lambda.role)
+        rek_progress_db.grant_read_write_data(process_rek_sync_lambda.role)
+        rek_label_cache.grant_read_write_data(process_rek_sync_lambda.role)
         process_rek_sync_lambda.add_to_role_policy(
             aws_iam.PolicyStatement(
                 actions=[
@@ -423,6 +864,86 @@ class Fargate(core.Stack):
             )
         )
 
+        # Lambda to label the frames of each camera with a video label detection job on its mp4, in place of
+        # RekSyncProcessor's DetectLabels call per frame
+        if labelling_mode == "video":
+            video_label_topic = aws_sns.Topic(self, "VideoLabelTopic")
+            rek_video_role = aws_iam.Role(
+                self,
+                "RekVideoRole",
+                assumed_by=aws_iam.ServicePrincipal("rekognition.amazonaws.com"),
+            )
+            video_label_topic.grant_publish(rek_video_role)
+
+            # the label detection jobs whose results have been written, so that they are written once
+            video_label_jobs = dynamodb.Table(
+                self,
+                "VideoLabelJobs",
+                partition_key=dynamodb.Attribute(
+                    name="JobId", type=dynamodb.AttributeType.STRING
+                ),
+                billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            )
+
+            process_video_labels = aws_lambda.Function(
+                self,
+                "VideoLabelProcessor",
+                code=aws_lambda.Code.from_asset("./infrastructure/process-video-labels"),
+                environment={
+                    "results_table": rek_labels_db.table_name,
+                    "progress_table": rek_progress_db.table_name,
+                    "jobs_table": video_label_jobs.table_name,
+                    "sns_topic_arn": video_label_topic.topic_arn,
+                    "rekognition_role_arn": rek_video_role.role_arn,
+                    # the frame rate the extractor encodes the mp4s at
+                    "framerate": "20",
+                    "min_confidence": "50",
+                    "label_output": label_output,
+                    "anonymize_queue_url": anonymize_queue.queue_url,
+                },
+                memory_size=1024,
+                timeout=core.Duration.minutes(10),
+                handler="process-video-labels.lambda_handler",
+                runtime=aws_lambda.Runtime("python3.7", supports_inline_code=True),
+                layers=[labels_layer],
+            )
+            dest_bucket.add_event_notification(
+                aws_s3.EventType.OBJECT_CREATED,
+                s3n.LambdaDestination(process_video_labels),
+                aws_s3.NotificationKeyFilter(suffix="mp4"),
+            )
+            video_label_topic.add_subscription(sns_subs.LambdaSubscription(process_video_labels))
+            rek_labels_db.grant_read_write_data(process_video_labels.role)
+            rek_progress_db.grant_read_write_data(process_video_labels.role)
+            video_label_jobs.grant_read_write_data(process_video_labels.role)
+            anonymize_queue.grant_send_messages(process_video_labels)
+            process_video_labels.add_to_role_policy(
+                aws_iam.PolicyStatement(
+                    actions=["rekognition:StartLabelDetection", "rekognition:GetLabelDetection"],
+                    resources=["*"],
+                )
+            )
+            process_video_labels.add_to_role_policy(
+                aws_iam.PolicyStatement(actions=["iam:PassRole"], resources=[rek_video_role.role_arn])
+            )
+            process_video_labels.add_to_role_policy(
+                aws_iam.PolicyStatement(
+                    actions=[
+                        "kms:Decrypt",
+                        "kms:Encrypt",
+                        "kms:ReEncrypt*",
+                        "kms:DescribeKey",
+                        "kms:GenerateDataKey",
+                    ],
+                    resources=["*"],
+                )
+            )
+            process_video_labels.add_to_role_policy(
+                aws_iam.PolicyStatement(
+                    actions=["s3:List*", "s3:Get*", "s3:PutObject"], resources=["*"]
+                )
+            )
+
         # Lambda to anonymize the images which contain a VRU
         anon_labelling_imgs = aws_s3.Bucket(
             self,
@@ -456,11 +977,8 @@ class Fargate(core.Stack):
 
         select_labelling_imgs.add_layers(pillow_layer)
 
-        dest_bucket.add_event_notification(
-            aws_s3.EventType.OBJECT_CREATED,
-            s3n.LambdaDestination(select_labelling_imgs),
-            aws_s3.NotificationKeyFilter(suffix="json"),
-        )
+        # the labelling Lambdas queue the frames containing a VRU, so the labels written to S3 aren't read back
+        select_labelling_imgs.add_event_source(les.SqsEventSource(anonymize_queue, batch_size=10))
 
         select_labelling_imgs.add_to_role_policy(
             aws_iam.PolicyStatement(
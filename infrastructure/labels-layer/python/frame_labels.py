@@ -0,0 +1,79 @@
+# Helpers shared by the labelling Lambdas, process-queue-sync labelling frames one by one (or in mosaics) and
+# process-video-labels labelling them from the mp4s: the items they write to the results table, and the frames they
+# send on to be anonymized.
+
+import json
+import re
+import time
+from datetime import datetime
+
+# frames with any of these labels contain a vulnerable road user and are sent on to be anonymized
+VRU_LABELS = {"Person", "Bicycle", "Motorcycle", "Motorbike", "Bike"}
+
+# SendMessageBatch takes up to 10 messages and 256KB, leave room for the attributes
+MAX_BATCH_MESSAGES = 10
+MAX_BATCH_BYTES = 200 * 1024
+
+
+def frame_item(bucket, key):
+    """ The key attributes and location of a frame's item in the results table"""
+    path_elems = key.split("/")
+    file_elems = path_elems[-1].split(".")
+
+    # get the timestamp from the filename which will of the format
+    # image_raw-2020-12-16T23_32_19.969307-0002.png
+    year, month, day_time = file_elems[0].split('-')[1:4]
+    day_time = day_time.replace('_', ':')
+    frame_time = datetime.fromisoformat(f'{year}-{month}-{day_time}')
+
+    camera = re.match("[A-Za-z_]*", path_elems[-2]).group(0)
+    s3_key = "/".join([bucket, key]).replace("mp4", "png")
+
+    return {
+        "timestamp": {"S": frame_time.isoformat()},
+        "camera": {"S": camera},
+        "s3_loc": {"S": s3_key},
+    }
+
+
+def batch_write(dynamo, requests, max_attempts=8):
+    """
+    Writes {table name: [put requests]} with as few BatchWriteItem calls as possible, 25 items at a time, retrying
+    whatever DynamoDB leaves unprocessed with exponential backoff
+    """
+    pending = [(table, r) for table, table_requests in requests.items() for r in table_requests]
+    attempt = 0
+    while pending:
+        batch, pending = pending[:25], pending[25:]
+        request_items = {}
+        for table, r in batch:
+            request_items.setdefault(table, []).append(r)
+        unprocessed = dynamo.batch_write_item(RequestItems=request_items).get("UnprocessedItems", {})
+        if unprocessed:
+            attempt = attempt + 1
+            if attempt >= max_attempts:
+                raise RuntimeError(f"DynamoDB left {sum(map(len, unprocessed.values()))} items unprocessed")
+            pending = [(table, r) for table, table_requests in unprocessed.items() for r in table_requests] + pending
+            time.sleep(min(5, 0.05 * 2 ** attempt))
+        else:
+            attempt = 0
+
+
+def send_for_anonymization(sqs, queue_url, frames):
+    """
+    Sends [{"bucket", "key", "labels"}] of frames containing a VRU to the anonymization queue, in as few
+    SendMessageBatch calls as its limits allow
+    """
+    batches = [[]]
+    size = 0
+    for frame in frames:
+        body = json.dumps(frame)
+        if batches[-1] and (len(batches[-1]) == MAX_BATCH_MESSAGES or size + len(body) > MAX_BATCH_BYTES):
+            batches.append([])
+            size = 0
+        batches[-1].append({"Id": str(len(batches[-1])), "MessageBody": body})
+        size = size + len(body)
+    for entries in filter(None, batches):
+        response = sqs.send_message_batch(QueueUrl=queue_url, Entries=entries)
+        if response.get("Failed"):
+            raise RuntimeError(f"{len(response['Failed'])} frames could not be queued for anonymization")
@@ -0,0 +1,101 @@
+import boto3
+import gzip
+import json
+import math
+import os
+import logging
+
+from bagindex import read_bag_index
+
+
+def partition_chunks(index, range_count):
+    """
+    Splits the chunks of a bag into range_count contiguous byte ranges of roughly equal size. Returns a list of
+    (start, end, chunks) tuples, the last range ends where the index starts.
+    """
+    chunks = index["chunks"]
+    ends = [c["pos"] for c in chunks[1:]] + [index["index_pos"]]
+    target = (index["index_pos"] - chunks[0]["pos"]) / range_count
+
+    ranges = []
+    first = 0
+    for i in range(len(chunks)):
+        last_range = len(ranges) == range_count - 1
+        if i == len(chunks) - 1 or (not last_range and ends[i] - chunks[first]["pos"] >= target):
+            ranges.append((chunks[first]["pos"], ends[i], chunks[first : i + 1]))
+            first = i + 1
+
+    return ranges
+
+
+def plan_ranges(index, range_count):
+    """
+    Builds the per range checkpoints the extraction tasks start from: the offset to start reading at, the
+    connection table and the number of messages each connection had before the range so that frame numbering
+    carries on across ranges
+    """
+    frame_counts = {conn: 0 for conn in index["connections"]}
+    ranges = []
+    for i, (start, end, chunks) in enumerate(partition_chunks(index, range_count)):
+        ranges.append(
+            {
+                "start": start,
+                "end": end,
+                "checkpoint": {
+                    "offset": start,
+                    "connections": [
+                        {
+                            "conn": conn,
+                            "header": header,
+                            "frame_count": frame_counts[conn],
+                            # the parts of each range are named after it, see bagFileStream
+                            "csv_part": 0,
+                        }
+                        for conn, header in index["connections"].items()
+                    ],
+                },
+            }
+        )
+        for c in chunks:
+            for conn, count in c["counts"].items():
+                frame_counts[conn] = frame_counts[conn] + count
+
+    return ranges
+
+
+def lambda_handler(event, context):
+
+    print(event)
+    bucket = event["bucket"]
+    key = event["key"]
+    dest_bucket = event["dest_bucket"]
+    range_bytes = int(os.environ["range_gb"]) * 1024 ** 3
+    # no more ranges than the execution holds slots for, as they are all extracted at once
+    max_ranges = min(int(os.environ["max_ranges"]), int(event.get("slots", os.environ["max_ranges"])))
+
+    if not key.endswith(".bag") or event.get("mode") == "drive":
+        # archives and drives made of split bags are streamed through a single task
+        return {"range_count": 1, "ranges": ["0"]}
+
+    s3 = boto3.client("s3")
+    head = s3.head_object(Bucket=bucket, Key=key)
+    index = read_bag_index(s3, bucket, key, size=head["ContentLength"])
+
+    range_count = min(max_ranges, math.ceil(head["ContentLength"] / range_bytes))
+    if not index["indexed"] or len(index["chunks"]) < 2 or range_count < 2:
+        # unindexed bags can only be read from the start
+        return {"range_count": 1, "ranges": ["0"]}
+
+    ranges = plan_ranges(index, range_count)
+    plan = {"etag": head["ETag"], "ranges": ranges}
+    plan_key = f"plans/{key}.json.gz"
+    s3.put_object(Bucket=dest_bucket, Key=plan_key, Body=gzip.compress(json.dumps(plan).encode()))
+    logging.info(f"split s3://{bucket}/{key} into {len(ranges)} ranges")
+
+    # Map iterates over the range numbers, the tasks read their range from the plan in S3 as the connection table
+    # is too large to pass through the state machine
+    return {
+        "range_count": len(ranges),
+        "ranges": [str(i) for i in range(len(ranges))],
+        "plan_key": plan_key,
+    }
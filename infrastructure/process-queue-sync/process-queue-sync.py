@@ -2,20 +2,53 @@ import os
 import boto3
 import json
 import logging
-from botocore.exceptions import ClientError
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor
 import shutil
 import io
+import threading
 import time
 from datetime import datetime, timedelta
 import re
 
+from frame_labels import VRU_LABELS, batch_write, frame_item, send_for_anonymization
+
 s3 = boto3.client(
     "s3",
 )
 dynamo = boto3.client("dynamodb")
+sqs = boto3.client("sqs")
+# adaptive retries slow the client down when Rekognition throttles us
+rek = boto3.client("rekognition", config=Config(retries={"mode": "adaptive", "max_attempts": 10}))
+
+
+class RateLimiter:
+    """ Spaces out calls made from several threads to no more than rate per second"""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.next_call = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            wait = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+
+# this instance's share of the account's DetectLabels quota, the instances together make up to rekognition tps calls
+# per second (see ecs_stack)
+rek_limiter = RateLimiter(float(os.environ.get("rekognition_tps", 5)))
 
 
 def export_json_file(file_labels, bucket, key):
+    """
+    Returns the frame's item for the results table. The labels are also uploaded as JSON next to the frame if
+    label_output is "json", otherwise they go into the batch's JSON lines parts, see write_label_parts().
+    """
 
     frame_duration = int(os.environ["frame_duration"])
 
@@ -31,41 +64,17 @@ def export_json_file(file_labels, bucket, key):
     f = io.BytesIO(json.dumps(file_labels).encode())
     upload_path = "/".join(path_elems[0:-1])
     upload_key = f"{upload_path}/{file}"
-    logging.info(f"Uploading {bucket}/{upload_key}")
-    s3.upload_fileobj(f, bucket, upload_key)
-
-
-    # get the timestamp from the filename which will of the format 
-    # image_raw-2020-12-16T23_32_19.969307-0002.png
-    year, month, day_time = file_elems[0].split('-')[1:4]
-    # iso 
-    day_time = day_time.replace('_',':')
-    iso = f'{year}-{month}-{day_time}'
-    frame_time = datetime.fromisoformat(iso)
+    if os.environ.get("label_output") == "json":
+        logging.info(f"Uploading {bucket}/{upload_key}")
+        s3.upload_fileobj(f, bucket, upload_key)
 
-    camera = re.match("[A-Za-z_]*", path_elems[-2]).group(0)
-    s3_key = "/".join([bucket, key]).replace("mp4", "png")
-    table = os.environ["results_table"]
-
-    db_key = {"timestamp": {"S": frame_time.isoformat()}, "camera": {"S": camera}}
-
-    item = {
-        "timestamp": {"S": frame_time.isoformat()},
-        "camera": {"S": camera},
-        "s3_loc": {"S": s3_key},
-        #        "json" : {"S" : json.dumps(file_labels)} # handy for development but not necessary as the json is also in S3
-    }
-
-    # Put the entry into the table
-    dynamo.put_item(TableName=table, Item=item)
-
-    # Upated the table with each detection
+    # the highest confidence of each label with a bounding box, and the number of people/bikes/motorbikes
+    labels = {}
     ped_cnt = 0
     bike_cnt = 0
     motorbike_cnt = 0
     for l in file_labels:
 
-        # Keep a count of the number of people/bikes/motorbikes in the image
         name = l["Name"].replace(" ", "_")
         # Ignore items where there's no bounding box
         if "Instances" in l:
@@ -73,103 +82,317 @@ def export_json_file(file_labels, bucket, key):
             if count == 0:
                 continue
             if name == "Person":
-                print(name)
                 ped_cnt = ped_cnt + count
             elif name == "Bicycle":
-                print(name)
                 bike_cnt = bike_cnt + count
             elif name == "Motorcycle":
-                print(name)
                 motorbike_cnt = motorbike_cnt + count
 
-        update_expression = f"SET {name} = :conf"
-        condition_expression = f"attribute_not_exists({name}) OR {name} < :conf"
+        labels[name] = max(labels.get(name, 0), l["Confidence"])
+
+    return {
+        **frame_item(bucket, key),
+        "Labels": {"M": {name: {"N": f"{conf}"} for name, conf in labels.items()}},
+        "Ped_Count": {"N": f"{ped_cnt}"},
+        "Bike_Count": {"N": f"{bike_cnt}"},
+        "Motorbike_Count": {"N": f"{motorbike_cnt}"},
+        #        "json" : {"S" : json.dumps(file_labels)} # handy for development but not necessary as the json is also in S3
+    }
+
+
+def write_label_parts(parts, part_name):
+    """
+    Writes the labels of a batch's frames as one JSON lines part per camera, <camera dir>/labels/<part_name>.jsonl,
+    each line holding the key of a frame and its labels. parts is {(bucket, camera dir): [lines]}.
+    """
+    for (bucket, frame_dir), lines in parts.items():
+        key = f"{frame_dir}/labels/{part_name}.jsonl"
+        logging.info(f"Uploading {len(lines)} frames' labels to {bucket}/{key}")
+        s3.put_object(Bucket=bucket, Key=key, Body="".join(json.dumps(l) + "\n" for l in lines).encode())
+
+
+def contains_vru(labels):
+    """ The same test as select-labelling-imgs' filter_vru, on DetectLabels labels"""
+    return any(l["Name"] in VRU_LABELS for l in labels)
 
-        #
-        try:
 
-            dynamo.update_item(
-                TableName=table,
-                Key=db_key,
-                UpdateExpression=update_expression,
-                ConditionExpression=condition_expression,
-                ExpressionAttributeValues={":conf": {"N": f'{l["Confidence"]}'}},
+def process_labels(bucket, key, labels):
+
+    return export_json_file(labels, bucket, key)
+
+
+def content_hash(head):
+    """
+    The hash of a frame's bytes, from its head_object response: the SHA-256 the extractor stores in the object's
+    metadata, otherwise the ETag of a single part upload (the MD5 of its bytes). None if neither is available.
+    """
+    if "sha256" in head.get("Metadata", {}):
+        return f"sha256:{head['Metadata']['sha256']}"
+    etag = head["ETag"].strip('"')
+    if "-" not in etag:
+        return f"md5:{etag}"
+    return None
+
+
+def cached_labels(frame_hash):
+    """ The labels stored for a frame with the same bytes by the current label model, None on a miss"""
+    if frame_hash is None:
+        return None
+    item = dynamo.get_item(
+        TableName=os.environ["label_cache_table"], Key={"content_hash": {"S": frame_hash}}
+    ).get("Item")
+    if item is None or item["model_version"]["S"] != os.environ["label_model_version"]:
+        return None
+    return json.loads(item["labels"]["S"])
+
+
+def split_mosaic_labels(labels, layout):
+    """
+    Maps the labels DetectLabels found in a mosaic back to the frames tiled into it, returns the labels of each frame
+    in the order of layout["tiles"]. Boxes are made relative to their frame, those crossing from one cell into another
+    or reaching outside the frame are dropped, and a label keeps the highest confidence of its boxes in the frame.
+    Labels without boxes describe the whole mosaic, not any one frame in it, so they are dropped unless the mosaic
+    holds a single frame.
+    """
+    cols = layout["cols"]
+    cell_width, cell_height = layout["cell"]
+    width, height = cols * cell_width, layout["rows"] * cell_height
+    tiles = layout["tiles"]
+    tile_labels = [[] for _ in tiles]
+    for l in labels:
+        if not l.get("Instances"):
+            if len(tiles) == 1:
+                tile_labels[0].append(l)
+            continue
+        instances = {}
+        for instance in l["Instances"]:
+            box = instance["BoundingBox"]
+            left, top = box["Left"] * width, box["Top"] * height
+            box_width, box_height = box["Width"] * width, box["Height"] * height
+            col, row = int(left // cell_width), int(top // cell_height)
+            i = row * cols + col
+            if i >= len(tiles):
+                continue
+            # allow a pixel for rounding, Rekognition's ratios are floats
+            x, y = left - col * cell_width, top - row * cell_height
+            _, frame_width, frame_height = tiles[i]
+            if x + box_width > frame_width + 1 or y + box_height > frame_height + 1:
+                continue
+            instances.setdefault(i, []).append(
+                dict(
+                    instance,
+                    BoundingBox={
+                        "Left": x / frame_width,
+                        "Top": y / frame_height,
+                        "Width": min(box_width, frame_width - x) / frame_width,
+                        "Height": min(box_height, frame_height - y) / frame_height,
+                    },
+                )
+            )
+        for i, frame_instances in instances.items():
+            tile_labels[i].append(
+                dict(l, Instances=frame_instances, Confidence=max(inst["Confidence"] for inst in frame_instances))
             )
-        except ClientError as e:
-            logging.warning(e)
+    return tile_labels
+
+
+def unplaced_vru(labels, layout):
+    """ True if DetectLabels found a VRU in a mosaic of several frames without a box placing it in one of them"""
+    return len(layout["tiles"]) > 1 and any(l["Name"] in VRU_LABELS and not l.get("Instances") for l in labels)
 
-    try:
 
+def detect_labels(bucket, key):
+    """ Calls DetectLabels within our rate limit, returns the labels and the model version"""
+    rek_limiter.wait()
+    response = rek.detect_labels(
+        Image={"S3Object": {"Bucket": bucket, "Name": key}}
+    )
+    print(response)
+    model_version = response.get("LabelModelVersion", "")
+    if model_version != os.environ["label_model_version"]:
+        logging.warning(
+            f"DetectLabels used model {model_version}, set label-model-version to it to reuse these labels"
+        )
+    return response["Labels"], model_version
+
+
+def progress_key(key, metadata):
+    """
+    The drive and camera a frame is counted under in the progress table: the drive is the bag's output prefix, which
+    the extractor stores in the metadata of what it uploads, the camera the directory of the frame under it
+    """
+    frame_dir = os.path.dirname(key)
+    drive = metadata.get("drive") or os.path.dirname(frame_dir)
+    return drive, frame_dir[len(drive):].lstrip("/")
+
+
+def update_progress(counts):
+    """
+    Adds {(drive, camera): {counter: n}} to the counters in the progress table, one atomic update per camera, and
+    records when frames of the camera were first and last labelled
+    """
+    now = datetime.now().isoformat()
+    for (drive, camera), counters in counts.items():
+        names = {f"#c{i}": name for i, name in enumerate(counters)}
+        values = {f":c{i}": {"N": str(n)} for i, n in enumerate(counters.values())}
         dynamo.update_item(
-            TableName=table,
-            Key=db_key,
-            UpdateExpression=f"SET Ped_Count = :peds, Bike_Count  = :bikes, Motorbike_Count = :motorbikes ",
-            ExpressionAttributeValues={
-                ":peds": {"N": f"{ped_cnt}"},
-                ":bikes": {"N": f"{bike_cnt}"},
-                ":motorbikes": {"N": f"{motorbike_cnt}"},
-            },
+            TableName=os.environ["progress_table"],
+            Key={"drive": {"S": drive}, "camera": {"S": camera}},
+            UpdateExpression="ADD " + ", ".join(f"{name} {value}" for name, value in zip(names, values))
+            + " SET last_labelled = :now, first_labelled = if_not_exists(first_labelled, :now)",
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues={**values, ":now": {"S": now}},
         )
-    except ClientError as e:
-        logging.warning(e)
-    file_labels = []
-
 
-def process_labels(bucket, key, labels):
 
-    export_json_file(labels, bucket, key)
+def message_frame(m):
+    """ The bucket and key of the frame in an SQS message, None if it is not a frame"""
+    body = json.loads(m["body"])
+    if "Records" not in body:
+        return None
+    key = body["Records"][0]["s3"]["object"]["key"]
+    # only process raw images
+    if 'image_raw' not in key:
+        return None
+    return body["Records"][0]["s3"]["bucket"]["name"], key
+
+
+def label_frame(m):
+    """
+    Labels the frame, or mosaic of frames, in one SQS message, returns the items to write for it, what to count in the
+    progress table and the labels for the batch's parts (None if the message is not for a raw image or the frame is
+    labelled as part of a mosaic). Frames whose bytes have been labelled before reuse those labels rather than
+    calling DetectLabels again, and frames the extractor found near identical to an earlier one are just linked to
+    it. Runs on the handler's thread pool, so each message succeeds or fails on its own.
+    """
+    print(f"Body: {m['body']}")
+    frame = message_frame(m)
+    if frame is None:
+        return None
+    bucket, key = frame
+
+    print(f'key: {key}')
+    head = s3.head_object(Bucket=bucket, Key=key)
+    metadata = head.get("Metadata", {})
+    if "mosaic" in metadata:
+        print(f"{key} is labelled as part of {metadata['mosaic']}")
+        return None
+    if "representative" in metadata:
+        print(f"{key} is represented by {metadata['representative']}")
+        item = {**frame_item(bucket, key), "Representative": {"S": "/".join([bucket, metadata["representative"]])}}
+        return [item], [(progress_key(key, metadata), "linked")], None, []
+
+    frame_hash = content_hash(head)
+    labels = cached_labels(frame_hash)
+    cache_item = None
+    status = "cached"
+    if labels is None:
+        status = "labelled"
+        labels, model_version = detect_labels(bucket, key)
+        if frame_hash is not None:
+            cache_item = {
+                "content_hash": {"S": frame_hash},
+                "model_version": {"S": model_version},
+                "labels": {"S": json.dumps(labels)},
+            }
+    else:
+        print(f"Reusing the labels of {frame_hash}")
+
+    if "tiles" in metadata:
+        # the key of the layout the extractor wrote next to the mosaic
+        layout = json.loads(s3.get_object(Bucket=bucket, Key=metadata["tiles"])["Body"].read())
+        if unplaced_vru(labels, layout):
+            # the frames are labelled one by one rather than sending every frame of the mosaic for anonymization
+            print(f"{key} has a VRU without a box, labelling its frames on their own")
+            frames = [(tile[0], detect_labels(bucket, tile[0])[0]) for tile in layout["tiles"]]
+        else:
+            frames = list(zip([tile[0] for tile in layout["tiles"]], split_mosaic_labels(labels, layout)))
+    else:
+        frames = [(key, labels)]
+
+    items = [process_labels(bucket, frame_key, frame_labels) for frame_key, frame_labels in frames]
+    progress = [(progress_key(frame_key, metadata), status) for frame_key, _ in frames]
+    return items, progress, cache_item, [(bucket, frame_key, frame_labels) for frame_key, frame_labels in frames]
 
 
 def lambda_handler(event, context):
+    """
+    Labels a batch of frames. The messages of frames that could not be labelled or written are returned as
+    batchItemFailures, Lambda deletes the rest and only the failed ones are retried. Unless label_output is "json",
+    the labels of the batch are written as one JSON lines part per camera rather than a JSON file per frame. Frames
+    containing a VRU are queued for anonymization along with their labels. The frames labelled, linked to a
+    representative, labelled from the cache and failed are counted per drive and camera in the progress table.
+    """
 
     print(json.dumps(event))
 
-    sqs = boto3.client("sqs")
-    rek = boto3.client("rekognition")
-    ddb = boto3.client("dynamodb")
-    s3 = boto3.client("s3")
-
     messages = event["Records"]
 
-    label_count = 0
-    sleep_time = 0
-    monitor_table = os.environ["monitor_table"]
-
-    for m in messages:
-
-        body = json.loads(m["body"])
-        print(f"Body: {body}")
-        if "Records" not in body:
+    results_table = os.environ["results_table"]
+    label_cache_table = os.environ["label_cache_table"]
+    # the items of every frame in the batch by their keys, written together once all the frames have been labelled.
+    # A BatchWriteItem can't hold two items with the same key, so a repeated frame only keeps its last labels.
+    writes = {results_table: {}, label_cache_table: {}}
+    # the labels of the batch's frames by bucket and camera directory
+    parts = {}
+    # (drive, camera) and counter of each frame labelled
+    progress = []
+    # the frames to anonymize
+    vru_frames = []
+
+    # the frames are labelled concurrently, the rate limiter keeps the calls within our Rekognition quota
+    with ThreadPoolExecutor(max_workers=int(os.environ.get("rekognition_workers", 10))) as executor:
+        results = [(m, executor.submit(label_frame, m)) for m in messages]
+
+    failed = []
+    labelled_ids = []
+    failures = []
+    for m, result in results:
+        try:
+            labelled = result.result()
+        except Exception as e:
+            logging.error(f"labelling {m['messageId']} failed: {e}")
+            failed.append(m["messageId"])
+            failures.append(m)
             continue
-        bucket = body["Records"][0]["s3"]["bucket"]["name"]
-        key = body["Records"][0]["s3"]["object"]["key"]
-        s3_loc = "/".join([bucket, key])
-        receipt_handle = m["receiptHandle"]
-
-        # only process raw images
-        if key.contains('image_raw'):
-            
-            json_key = key.replace("png", "json")
-            print(f'key: {key}')
-            response = rek.detect_labels(
-                Image={"S3Object": {"Bucket": bucket, "Name": key}}
-            )
-            print(response)
-    
-            process_labels(bucket, key, response["Labels"])
-            ddb.update_item(
-                TableName=monitor_table,
-                Key={"img_file": {"S": s3_loc}},
-                UpdateExpression="SET #s = :sts, #e = :now",
-                ExpressionAttributeNames={"#s": "Status", "#e": "End"},
-                ExpressionAttributeValues={
-                    ":sts": {"S": "Complete"},
-                    ":now": {"S": datetime.now().isoformat()},
-                },
-            )
+        if labelled:
+            items, frame_progress, cache_item, frame_labels = labelled
+            for item in items:
+                writes[results_table][(item["timestamp"]["S"], item["camera"]["S"])] = {"PutRequest": {"Item": item}}
+            if cache_item is not None:
+                writes[label_cache_table][cache_item["content_hash"]["S"]] = {"PutRequest": {"Item": cache_item}}
+            for bucket, frame_key, labels in frame_labels:
+                parts.setdefault((bucket, os.path.dirname(frame_key)), []).append({"key": frame_key, "labels": labels})
+                if contains_vru(labels):
+                    vru_frames.append({"bucket": bucket, "key": frame_key, "labels": labels})
+            progress.extend(frame_progress)
+            labelled_ids.append(m["messageId"])
 
-        sqs.delete_message(
-            QueueUrl=os.environ["job_queue_url"], ReceiptHandle=receipt_handle
-        )
+    try:
+        batch_write(dynamo, {table: list(items.values()) for table, items in writes.items()})
+        if os.environ.get("label_output") != "json":
+            write_label_parts(parts, context.aws_request_id)
+        send_for_anonymization(sqs, os.environ["anonymize_queue_url"], vru_frames)
+    except Exception as e:
+        logging.error(f"writing the labels of {len(labelled_ids)} frames failed: {e}")
+        failed.extend(labelled_ids)
+        progress = [(key, "failed") for key, _ in progress]
+
+    for m in failures:
+        try:
+            bucket, key = message_frame(m)
+            progress.append((progress_key(key, s3.head_object(Bucket=bucket, Key=key).get("Metadata", {})), "failed"))
+        except Exception as e:
+            logging.warning(f"not counting the failure of {m['messageId']}: {e}")
+
+    counts = {}
+    for key, counter in progress:
+        counts.setdefault(key, {}).setdefault(counter, 0)
+        counts[key][counter] = counts[key][counter] + 1
+    # the labels are written by now, a failure to count them doesn't fail the batch
+    try:
+        update_progress(counts)
+    except Exception as e:
+        logging.error(f"updating the progress counters failed: {e}")
 
-    return {"status": 200}
+    return {"batchItemFailures": [{"itemIdentifier": message_id} for message_id in failed]}
@@ -0,0 +1,225 @@
+import os
+import boto3
+import csv
+import hashlib
+import io
+import json
+import logging
+import re
+import time
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from datetime import datetime
+
+from frame_labels import VRU_LABELS, batch_write, frame_item, send_for_anonymization
+
+s3 = boto3.client("s3")
+dynamo = boto3.client("dynamodb")
+sqs = boto3.client("sqs")
+# adaptive retries slow the client down when Rekognition throttles us
+rek = boto3.client("rekognition", config=Config(retries={"mode": "adaptive", "max_attempts": 10}))
+
+# a job is claimed in the jobs table before its results are written, so that a redelivered notification doesn't write
+# them again. A claim older than this, longer than the Lambda's timeout, was left by an invocation that died.
+CLAIM_SECONDS = 15 * 60
+
+
+def labels_item(bucket, key, detections):
+    """
+    Returns the frame's item for the results table. If label_output is "json" the label detections of the frame are
+    also uploaded as JSON next to it, in the StartLabelDetection format with timestamps.
+    """
+    if os.environ.get("label_output") == "json":
+        upload_key = re.sub(r"\.png$", ".json", key)
+        logging.info(f"Uploading {bucket}/{upload_key}")
+        s3.upload_fileobj(io.BytesIO(json.dumps(detections).encode()), bucket, upload_key)
+
+    # the highest confidence of each label with a bounding box, and the number of people/bikes/motorbikes
+    labels = {}
+    counts = {"Person": 0, "Bicycle": 0, "Motorcycle": 0}
+    for d in detections:
+        l = d["Label"]
+        if not l.get("Instances"):
+            continue
+        name = l["Name"].replace(" ", "_")
+        if name in counts:
+            counts[name] = counts[name] + len(l["Instances"])
+        labels[name] = max(labels.get(name, 0), l["Confidence"])
+
+    return {
+        **frame_item(bucket, key),
+        "Labels": {"M": {name: {"N": f"{conf}"} for name, conf in labels.items()}},
+        "Ped_Count": {"N": f"{counts['Person']}"},
+        "Bike_Count": {"N": f"{counts['Bicycle']}"},
+        "Motorbike_Count": {"N": f"{counts['Motorcycle']}"},
+    }
+
+
+def video_frames(bucket, video_key):
+    """
+    The keys of the frames an mp4 was made from, in the order they appear in it. The extractor writes each camera's
+    frames to the directory named like the mp4 and lists them in that topic's CSV files, ffmpeg reads them in file
+    name order.
+    """
+    frame_dir = video_key[: -len(".mp4")]
+    frames = set()
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=f"{frame_dir}/"):
+        for obj in page.get("Contents", []):
+            if not obj["Key"].endswith(".csv"):
+                continue
+            body = s3.get_object(Bucket=bucket, Key=obj["Key"])["Body"].read().decode()
+            for row in csv.reader(io.StringIO(body)):
+                # Time, ISOTime, the frame's file in the task's working directory
+                if len(row) == 3 and row[2].endswith(".png"):
+                    frames.add(f"{frame_dir}/{os.path.basename(row[2])}")
+    return sorted(frames)
+
+
+def start_detection(bucket, key):
+    """ Starts label detection on a camera's mp4, Rekognition notifies the SNS topic when it is done"""
+    if not key.endswith(".mp4"):
+        return
+    response = rek.start_label_detection(
+        Video={"S3Object": {"Bucket": bucket, "Name": key}},
+        # a redelivered S3 event doesn't start a second job
+        ClientRequestToken=hashlib.md5(f"{bucket}/{key}".encode()).hexdigest(),
+        MinConfidence=float(os.environ.get("min_confidence", 50)),
+        NotificationChannel={
+            "SNSTopicArn": os.environ["sns_topic_arn"],
+            "RoleArn": os.environ["rekognition_role_arn"],
+        },
+    )
+    print(f"started label detection {response['JobId']} for {bucket}/{key}")
+
+
+def claim_job(job_id):
+    """ Claims the writing of a job's results, returns False if they have been or are being written already"""
+    now = int(time.time())
+    try:
+        dynamo.put_item(
+            TableName=os.environ["jobs_table"],
+            Item={"JobId": {"S": job_id}, "status": {"S": "started"}, "claimed_at": {"N": str(now)}},
+            ConditionExpression="attribute_not_exists(JobId) OR (#status <> :done AND claimed_at < :stale)",
+            ExpressionAttributeNames={"#status": "status"},
+            ExpressionAttributeValues={":done": {"S": "done"}, ":stale": {"N": str(now - CLAIM_SECONDS)}},
+        )
+        return True
+    except ClientError as e:
+        if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+            return False
+        raise
+
+
+def finish_detection(notification):
+    """
+    Writes the results of a completed label detection job once, however many times SNS delivers its notification.
+    If writing them fails the claim on the job is dropped, so that a redelivery tries again.
+    """
+    if notification["Status"] != "SUCCEEDED":
+        raise RuntimeError(f"label detection failed: {notification}")
+    job_id = notification["JobId"]
+    if not claim_job(job_id):
+        logging.warning(f"the results of label detection {job_id} have already been written")
+        return
+    jobs_table = os.environ["jobs_table"]
+    try:
+        write_detection_results(notification)
+    except Exception:
+        dynamo.delete_item(TableName=jobs_table, Key={"JobId": {"S": job_id}})
+        raise
+    dynamo.update_item(
+        TableName=jobs_table,
+        Key={"JobId": {"S": job_id}},
+        UpdateExpression="SET #status = :done",
+        ExpressionAttributeNames={"#status": "status"},
+        ExpressionAttributeValues={":done": {"S": "done"}},
+    )
+
+
+def write_detection_results(notification):
+    """
+    Fetches the results of a label detection job and writes an item for every frame labels were detected in,
+    mapping the timestamps Rekognition samples the video at back to frames. Unless label_output is "json", the labels
+    of all the frames are written as one JSON lines part, <camera dir>/labels/<job id>.jsonl. Frames containing a VRU
+    are queued for anonymization along with their labels.
+    """
+    bucket = notification["Video"]["S3Bucket"]
+    key = notification["Video"]["S3ObjectName"]
+    framerate = float(os.environ["framerate"])
+    frames = video_frames(bucket, key)
+    if not frames:
+        logging.error(f"no frames are listed for {bucket}/{key}")
+        return
+
+    detections = {}
+    kwargs = {"JobId": notification["JobId"], "SortBy": "TIMESTAMP", "MaxResults": 1000}
+    while True:
+        response = rek.get_label_detection(**kwargs)
+        for d in response["Labels"]:
+            frame = min(round(d["Timestamp"] * framerate / 1000), len(frames) - 1)
+            detections.setdefault(frame, []).append(d)
+        if "NextToken" not in response:
+            break
+        kwargs["NextToken"] = response["NextToken"]
+    print(f"{len(detections)} of the {len(frames)} frames of {bucket}/{key} labelled")
+
+    # the items by their keys, a BatchWriteItem can't hold two items with the same key
+    results = {}
+    for frame, frame_detections in sorted(detections.items()):
+        item = labels_item(bucket, frames[frame], frame_detections)
+        results[(item["timestamp"]["S"], item["camera"]["S"])] = {"PutRequest": {"Item": item}}
+    batch_write(dynamo, {os.environ["results_table"]: list(results.values())})
+
+    if os.environ.get("label_output") != "json":
+        part_key = f"{key[: -len('.mp4')]}/labels/{notification['JobId']}.jsonl"
+        lines = [{"key": frames[frame], "labels": d} for frame, d in sorted(detections.items())]
+        logging.info(f"Uploading {len(lines)} frames' labels to {bucket}/{part_key}")
+        s3.put_object(Bucket=bucket, Key=part_key, Body="".join(json.dumps(l) + "\n" for l in lines).encode())
+
+    send_for_anonymization(sqs, os.environ["anonymize_queue_url"], [
+        {"bucket": bucket, "key": frames[frame], "labels": d}
+        for frame, d in sorted(detections.items())
+        if any(l["Label"]["Name"] in VRU_LABELS for l in d)
+    ])
+
+    # every frame of the video has been through the job, whether labels were found in it or not
+    update_progress(bucket, key, len(frames))
+
+
+def update_progress(bucket, video_key, frame_count):
+    """
+    Sets the labelled counter of a video's drive and camera in the progress table to the frames of the video. The
+    drive is the bag's output prefix, which the extractor stores in the mp4's metadata, the camera the directory of
+    its frames. A camera has one video, so the counter is set rather than added to, and a video labelled again, by
+    the job of a regenerated mp4, isn't counted twice.
+    """
+    frame_dir = video_key[: -len(".mp4")]
+    metadata = s3.head_object(Bucket=bucket, Key=video_key).get("Metadata", {})
+    drive = metadata.get("drive") or os.path.dirname(frame_dir)
+    now = datetime.now().isoformat()
+    dynamo.update_item(
+        TableName=os.environ["progress_table"],
+        Key={"drive": {"S": drive}, "camera": {"S": frame_dir[len(drive):].lstrip("/")}},
+        UpdateExpression="SET #labelled = :n,"
+        " last_labelled = :now, first_labelled = if_not_exists(first_labelled, :now)",
+        ExpressionAttributeNames={"#labelled": "labelled"},
+        ExpressionAttributeValues={":n": {"N": str(frame_count)}, ":now": {"S": now}},
+    )
+
+
+def lambda_handler(event, context):
+    """
+    Labels the frames of each camera with one Rekognition video label detection job per mp4 instead of a DetectLabels
+    call per frame. Invoked by S3 when an mp4 is written, and by SNS when the job started for it completes.
+    """
+
+    print(json.dumps(event))
+
+    for r in event["Records"]:
+        if r.get("EventSource") == "aws:sns":
+            finish_detection(json.loads(r["Sns"]["Message"]))
+        else:
+            start_detection(r["s3"]["bucket"]["name"], r["s3"]["object"]["key"])
+
+    return {"status": 200}
@@ -127,11 +127,40 @@ def anonymize_PII(photo, bucket, key, region, blurriness=15):
     return image
 
 
+def select_frame(bucket, png_key, annotations, image_bucket, region):
+    """ Copies a frame containing a VRU to the image bucket, with text and faces blurred"""
+    if not annotations:
+        return
+    ped, wheeler = filter_vru(annotations)
+    if not ped and not wheeler:
+        return
+
+    local_file = png_key.split("/")[-1]
+
+    local_file = f"/tmp/{local_file}"
+    print(local_file)
+    print(f"downloading {bucket}/{png_key}")
+    s3.download_file(bucket, png_key, local_file)
+    anonymize_PII(local_file, bucket, png_key, region)
+    s3.upload_file(local_file, image_bucket, png_key)
+    os.remove(local_file)
+
+
 def lambda_handler(event, context):
+    """
+    Anonymizes the frames the labelling Lambdas queue because they contain a VRU, each message holds the frame's
+    bucket, key and labels. S3 events for a JSON or JSON lines labels file are still handled, to select the frames
+    of an earlier run by hand.
+    """
 
     print(event)
     for r in event["Records"]:
 
+        if "body" in r:
+            frame = json.loads(r["body"])
+            select_frame(frame["bucket"], frame["key"], frame["labels"], os.environ["image_bucket"], r["awsRegion"])
+            continue
+
         bucket = r["s3"]["bucket"]["name"]
         key = r["s3"]["object"]["key"]
         image_bucket = os.environ["image_bucket"]
@@ -140,23 +169,16 @@ def lambda_handler(event, context):
         json_obj = boto3.resource("s3").Object(bucket, key)
         json_obj.wait_until_exists()
 
-        png_key = key.replace(".json", ".png")
-
-        local_file = png_key.split("/")[-1]
-
-        local_file = f"/tmp/{local_file}"
-        print(local_file)
         json_obj = s3.get_object(Bucket=bucket, Key=key)
-        annotations = json.loads(json_obj["Body"].read())
-        # print(annotations)
-        ped, wheeler = filter_vru(annotations)
-        if not ped and not wheeler:
-            continue
-        print(f"downloading {bucket}/{png_key}")
-        s3.download_file(bucket, png_key, local_file)
-        anonymize_PII(local_file, bucket, png_key, region)
-        s3.upload_file(local_file, image_bucket, png_key)
-        os.remove(local_file)
+        if key.endswith(".jsonl"):
+            # a part holding the labels of many frames, a line per frame
+            for line in json_obj["Body"].read().decode().splitlines():
+                frame = json.loads(line)
+                select_frame(bucket, frame["key"], frame["labels"], image_bucket, region)
+        else:
+            annotations = json.loads(json_obj["Body"].read())
+            # print(annotations)
+            select_frame(bucket, key.replace(".json", ".png"), annotations, image_bucket, region)
 
 
 if __name__ == "__main__":
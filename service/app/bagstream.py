@@ -34,14 +34,22 @@ import logging
 from io import BytesIO
 import bz2
 import csv
+import gzip
+import json
+import mmap
 import os
-from PIL import Image
-from rosbag import bag
-from bagpy.bagreader import slotvalues
+import time
 from datetime import datetime, timedelta
 
+from mosaic import MosaicBuilder
+
+# rosbag and PIL are imported when the first message or image is decoded, so that starting a task (or a stats only
+# pass, which needs neither) doesn't wait for them
+
+
+class ConnectionInfo:
+    """ The fields of a connection rosbag needs to generate its message class"""
 
-class ConnectionInfo (bag._ConnectionInfo):
     def __init__(self, conn):
         self.id = int.from_bytes(conn['conn'], byteorder='little')
         self.topic = conn['topic']
@@ -52,6 +60,75 @@ class ConnectionInfo (bag._ConnectionInfo):
 
 logging.basicConfig(level=logging.INFO)
 
+
+def slotvalues(m, slot):
+    """
+    Returns the value of a slot of a message and its column name, or lists of the values and column names
+    (<slot>.<field>) of all the leaves if the slot holds a nested message. From bagpy.bagreader, which pulls in
+    pandas, matplotlib and seaborn when imported.
+    """
+    vals = getattr(m, slot)
+    try:
+        slots = vals.__slots__
+    except AttributeError:
+        return vals, slot
+
+    varray = []
+    sarray = []
+    for s in slots:
+        vnew, snew = slotvalues(vals, s)
+        if isinstance(snew, list):
+            for i, snn in enumerate(snew):
+                sarray.append(slot + '.' + snn)
+                varray.append(vnew[i])
+        elif isinstance(snew, str):
+            sarray.append(slot + '.' + snew)
+            varray.append(vnew)
+    return varray, sarray
+
+
+class BufferReader:
+    """
+    File like reader over a bytes like object such as a memory mapped file. read() returns memoryview slices of the
+    buffer instead of copies.
+    """
+
+    def __init__(self, buffer):
+        self.view = memoryview(buffer)
+        self.pos = 0
+
+    def read(self, size=-1):
+        end = len(self.view) if size < 0 else min(len(self.view), self.pos + size)
+        data = self.view[self.pos:end]
+        self.pos = end
+        return data
+
+    def seek(self, pos):
+        self.pos = pos
+
+    def tell(self):
+        return self.pos
+
+
+# connection header fields saved in a checkpoint, enough to rebuild the message types on resume
+checkpoint_fields = ['topic', 'type', 'md5sum', 'message_definition', 'callerid', 'latching']
+
+# per topic statistics gathered as messages are read, saved in checkpoints and written to the sidecar index
+stats_fields = ['message_count', 'message_bytes', 'start_time', 'end_time']
+
+# name of the sidecar index written next to the outputs of a bag
+INDEX_NAME = 'bag-index.json.gz'
+
+# directory under the output prefix the CSV parts are written to, they are stitched into <topic>.csv once the
+# extraction is done
+CSV_PARTS_DIR = 'csv-parts'
+
+
+def ros_time_to_seconds(timestamp):
+    """ Converts a ROS time read as a little endian 64 bit int (secs in the low word, nsecs in the high word)"""
+    return (timestamp & 0xffffffff) + (timestamp >> 32) / 1e9
+
+
 class bagFileStream:
     """
     Extracts data from a ROS bag file using streaming access only.
@@ -61,33 +138,215 @@ class bagFileStream:
     
     """
 
-    def __init__(self, input_stream, upload_callback, output_prefix=''):
+    def __init__(self, input_stream, upload_callback, output_prefix='', checkpoint=None, checkpoint_callback=None,
+                 checkpoint_interval=300, range_index=None, stats_only=False, scene_change_threshold=0,
+                 keyframe_seconds=5, mosaic_grid=(1, 1)):
+        """
+        Processes the whole of input_stream. If checkpoint_callback is given, every checkpoint_interval seconds
+        (checked after each fully processed chunk) the CSV files are rolled over to a new part and the state needed to
+        resume is passed to it. To resume, pass that state as checkpoint and an input_stream starting at
+        checkpoint['offset'], or at the start of the bag if the offset is 0. The parts are written as
+        <output_prefix>/csv-parts/<topic>.part<n>.csv, for the uploader to stitch together when the extraction is done.
+
+        A drive recorded as a sequence of split bags is extracted by calling extract() with each further split, see
+        extract().
+
+        If range_index is given, input_stream is one range of a bag split between several tasks, and the CSVs are
+        written as parts even without checkpoints, named <topic>.part<range_index>_<n>.csv so that the parts of each
+        range sort before the next range's. Otherwise the CSVs of an extraction that neither saves nor resumes from a
+        checkpoint are just <topic>.csv.
+
+        If stats_only is set nothing is extracted, only what get_index() needs is read. For an indexed bag that is
+        the bag header and the index at the end of the bag, input_stream is seeked straight to it. Messages are
+        only read, but not decoded, if the bag has no index.
+
+        With a scene_change_threshold, camera frames that differ from the last frame marked for labelling by less
+        than it (the mean absolute difference of small greyscale thumbnails, 0 to 1) are not labelled, unless
+        keyframe_seconds have passed since that frame. They are uploaded naming it as their representative.
+
+        With a mosaic_grid (cols, rows) larger than 1x1 the frames to be labelled are also tiled into mosaics, see
+        MosaicBuilder, which are labelled in their place.
+        """
 
         self.filepos = 0
 
-        self.bagfile = input_stream
         self.upload_callback = upload_callback
+        self.output_prefix = output_prefix
+        self.checkpoint_callback = checkpoint_callback
+        self.checkpoint_interval = checkpoint_interval
+        # a resumed extraction only has the rows from the checkpoint on, so it is always written as parts
+        self.part_names = range_index is not None or checkpoint_callback is not None or checkpoint is not None
+        self.part_prefix = f'{range_index:04d}_' if range_index is not None else ''
+        self.stats_only = stats_only
+        self.scene_change_threshold = scene_change_threshold
+        self.keyframe_seconds = keyframe_seconds
+        self.mosaic = MosaicBuilder(output_prefix, *mosaic_grid) if mosaic_grid[0] * mosaic_grid[1] > 1 else None
+        # connection and chunk infos of each bag processed, for the sidecar index
+        self.bags = []
+        # connections by (topic, md5sum), each holding its CSV writer and frame count. Connection ids are only
+        # unique within one bag, this table is what carries over from one split of a drive to the next.
+        self.topics = {}
+        # generated message classes by md5sum
+        self.msg_types = {}
+        self.last_checkpoint = time.monotonic()
+
+        self.extract(input_stream, checkpoint)
+
+    def extract(self, input_stream, checkpoint=None):
+        """
+        Processes the whole of input_stream. Called from the constructor, and again with each further split of a
+        drive recorded as several bags, in order. The connections of the new split are matched to the ones already
+        seen by topic and message type, so the split carries on writing to the same CSV files and frame numbers.
+        """
+        self.bagfile = input_stream
         self.bag_header = {}
+        # connections by their id in the bag being processed
         self.connections = {}
-        self.output_prefix = output_prefix
-
-        v_string = self.read_string( b'\n', self.bagfile)
-        if '2.0' not in v_string:
-            logging.info(f'Version {v_string} not supported. Only V2.0 is currently supported')
-            exit()
 
-
-        while True:
-            self.bagfile, record_header = self.read_record_header(self.bagfile)
+        if checkpoint:
+            self.restore_checkpoint(checkpoint)
+        if not checkpoint or not checkpoint['offset']:
+            v_string = self.read_string( b'\n', self.bagfile)
+            if '2.0' not in v_string:
+                logging.info(f'Version {v_string} not supported. Only V2.0 is currently supported')
+                exit()
+            # offset in the bag file of the top level record being processed, used to tell which chunk an output
+            # came from and where to resume from
+            self.record_offset = len(v_string) + 1
+
+        self.chunk_offset = None
+        self.index_pos = 0
+        self.chunk_infos = []
+
+        self.process_records()
+        self.upload_mosaic()
+
+        self.bags.append({'index_pos': self.index_pos,
+                          'connections': [{'conn': conn_key.hex(), 'topic': conn['topic'], 'type': conn['type'],
+                                           'md5sum': conn['md5sum']} for conn_key, conn in self.connections.items()],
+                          'chunks': [dict(c, start_time=ros_time_to_seconds(c['start_time']),
+                                          end_time=ros_time_to_seconds(c['end_time']),
+                                          counts={conn.hex(): n for conn, n in c['counts'].items()})
+                                     for c in sorted(self.chunk_infos, key=lambda c: c['pos'])]})
+
+    @classmethod
+    def from_file(cls, path, upload_callback, output_prefix='', **kwargs):
+        """
+        Extracts a bag that is already on a local disk or EFS. The file is memory mapped and records are parsed in
+        place rather than being copied out of a stream, and the chunks are found through the index if the bag has
+        one.
+        """
+        with open(path, 'rb') as f:
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        reader = BufferReader(mapping)
+        if kwargs.get('checkpoint'):
+            reader.seek(kwargs['checkpoint']['offset'])
+        return cls(reader, upload_callback, output_prefix=output_prefix, **kwargs)
+
+    def process_records(self, count=None):
+        """ Processes records until the end of the stream, or until count records have been processed"""
+        while count is None or count > 0:
+            bagfile, record_header = self.read_record_header(self.bagfile)
             logging.info(record_header)
             if record_header is None:
                 return
+            self.bagfile = bagfile
+
+            # connection handlers reuse the header dict, so take the record size before processing it
+            record_size = record_header['hdr_len'] + record_header['data_len'] + 8
+            if record_header['op'] == 5:
+                self.chunk_offset = self.record_offset
 
             if self.process_record[record_header['op']]:
                 self.bagfile = self.process_record[record_header['op']](self, record_header, self.bagfile)
             else:
                 logging.warning(f'No handler for op code {record_header["op"]}')
 
+            self.record_offset += record_size
+
+            if record_header['op'] == 5 and self.checkpoint_callback and \
+                    time.monotonic() - self.last_checkpoint >= self.checkpoint_interval:
+                self.checkpoint()
+
+            if record_header['op'] == 3 and self.index_pos and self.stats_only:
+                self.process_index()
+                return
+
+            if record_header['op'] == 3 and self.index_pos and isinstance(self.bagfile, BufferReader):
+                self.process_indexed()
+                return
+
+            if count is not None:
+                count -= 1
+
+    def process_indexed(self):
+        """
+        Reads the connections and chunk infos from the index at the end of a memory mapped bag, then processes
+        the chunks by seeking straight to them, skipping the index data records between them
+        """
+        self.process_index()
+
+        for chunk_info in sorted(self.chunk_infos, key=lambda c: c['pos']):
+            self.bagfile.seek(chunk_info['pos'])
+            self.record_offset = chunk_info['pos']
+            self.process_records(count=1)
+
+    def process_index(self):
+        """ Seeks to the index at the end of the bag and reads its connection and chunk info records"""
+        self.bagfile.seek(self.index_pos)
+        self.record_offset = self.index_pos
+        self.process_records()
+
+    def checkpoint(self):
+        """ Rolls every topic over to a new CSV part and passes the state after the current record to the callback"""
+        for conn in self.topics.values():
+            conn['csv_file'].close()
+            self.upload_callback(conn['csv_filename'])
+            self.open_csv(conn, conn['csv_part'] + 1)
+        # a resumed extraction starts a new mosaic, the frames waiting for this one have already been uploaded
+        self.upload_mosaic()
+
+        self.checkpoint_callback(self.get_checkpoint())
+        self.last_checkpoint = time.monotonic()
+
+    def get_checkpoint(self):
+        connections = []
+        for conn_key, conn in self.connections.items():
+            connections.append(self.checkpoint_entry(conn_key.hex(), conn))
+        # topics carried over from earlier splits of a drive that have not appeared in this one yet
+        in_bag = [id(conn) for conn in self.connections.values()]
+        for conn in self.topics.values():
+            if id(conn) not in in_bag:
+                connections.append(self.checkpoint_entry(None, conn))
+        return {'offset': self.record_offset, 'connections': connections}
+
+    def checkpoint_entry(self, conn_id, conn):
+        return {'conn': conn_id,
+                'header': {f: conn[f] for f in checkpoint_fields if f in conn},
+                'frame_count': conn['frame_count'],
+                'csv_part': conn['csv_part'],
+                'stats': {f: conn[f] for f in stats_fields}}
+
+    def restore_checkpoint(self, checkpoint):
+        logging.info(f"resuming from offset {checkpoint['offset']}")
+        for c in checkpoint['connections']:
+            topic_key = (c['header']['topic'], c['header'].get('md5sum'))
+            record = self.topics.get(topic_key)
+            if record is None:
+                record = dict(c['header'])
+                # the part opened when the checkpoint was taken only has messages from after it, if an earlier
+                # attempt got as far as uploading it, it is rewritten
+                self.open_csv(record, c['csv_part'])
+                record['frame_count'] = c['frame_count']
+                self.init_stats(record)
+                # not in the checkpoints planned for the ranges of a split bag
+                record.update(c.get('stats', {}))
+                self.topics[topic_key] = record
+            if c['conn']:
+                record['conn'] = bytes.fromhex(c['conn'])
+                self.connections[record['conn']] = record
+        self.record_offset = checkpoint['offset']
+
     def read_string(self, terminator, bagfile):
         str_bytes=[]
         while True:
@@ -121,7 +380,7 @@ class bagFileStream:
                 logging.info(f'header op: {fields[field_name]}')
                 self.filepos += 1
             else:
-                fields[field_name] = bagfile.read(field_len - len(field_name) - 1)
+                fields[field_name] = bytes(bagfile.read(field_len - len(field_name) - 1))
                 self.filepos += field_len - len(field_name) - 1
 
             hdr_len = hdr_len - field_len - 4
@@ -162,13 +421,57 @@ class bagFileStream:
     def process_bag_header(self, record, bagfile):
         self.bagfile.read(record['data_len'])
         self.bag_header = record
+        self.index_pos = int.from_bytes(record['index_pos'], byteorder='little')
         return self.bagfile
 
+    def process_chunk_info(self, record, bagfile):
+        data = bytes(bagfile.read(record['data_len']))
+        counts = {}
+        for i in range(int.from_bytes(record['count'], byteorder='little')):
+            counts[data[i * 8:i * 8 + 4]] = int.from_bytes(data[i * 8 + 4:i * 8 + 8], byteorder='little')
+        self.chunk_infos.append({'pos': int.from_bytes(record['chunk_pos'], byteorder='little'),
+                                 'start_time': int.from_bytes(record['start_time'], byteorder='little'),
+                                 'end_time': int.from_bytes(record['end_time'], byteorder='little'),
+                                 'counts': counts})
+        return bagfile
+
 
     def process_connection(self, record, bagfile):
         con_hdr = BytesIO(bagfile.read(record['data_len']))
         self.read_connection_header(con_hdr, fields=record)
-        csvfile=os.path.join(self.output_prefix, f"{record['topic']}.csv".replace('/','',1))
+        if record['conn'] in self.connections:
+            # connection records are repeated in the index at the end of the bag, and a resumed stream already has
+            # its connections from the checkpoint
+            return bagfile
+        topic_key = (record['topic'], record.get('md5sum'))
+        if topic_key in self.topics:
+            # same topic as an earlier split of the drive, or another publisher of a topic in this bag
+            logging.info(f"continuing {record['topic']} as connection {record['conn'].hex()}")
+            conn = self.topics[topic_key]
+            conn['conn'] = record['conn']
+            self.connections[record['conn']] = conn
+            return bagfile
+        if not self.stats_only:
+            self.open_csv(record, 0)
+        self.connections[record['conn']] = record
+        self.topics[topic_key] = record
+        record['frame_count'] = 0
+        self.init_stats(record)
+        return bagfile
+
+    def init_stats(self, record):
+        record['message_count'] = 0
+        record['message_bytes'] = 0
+        record['start_time'] = None
+        record['end_time'] = None
+
+    def open_csv(self, record, part):
+        """ Opens part number part of the CSV file for a connection, or just <topic>.csv unless part_names is set"""
+        name = record['topic'].replace('/','',1)
+        if self.part_names:
+            csvfile = os.path.join(self.output_prefix, CSV_PARTS_DIR, f'{name}.part{self.part_prefix}{part:06d}.csv')
+        else:
+            csvfile = os.path.join(self.output_prefix, f'{name}.csv')
         dir = os.path.dirname(csvfile)
         if not os.path.exists(dir):
             os.makedirs(dir)
@@ -176,22 +479,21 @@ class bagFileStream:
         csvf = open(csvfile, 'w', newline='')
         record['csv_file'] = csvf
         record['csv_writer']= csv.writer(csvf, delimiter=',')
-        self.connections[record['conn']] = record
-        record['frame_count'] = 0
+        record['csv_part'] = part
         record['csv_header_written']= False
-        return bagfile
 
     def process_chunk(self, record, bagfile):
-        if record['compression'] == 'bz2':
+        if record['compression'] == b'bz2':
             logging.warning('Compressed chunks not tested')
-            data = bz2.decompress(BytesIO(self.bagfile.read(record['data_len'])))
+            data = bz2.decompress(self.bagfile.read(record['data_len']))
         else:
             data = self.bagfile.read(record['data_len'])
 
 
         bytes_to_process = int.from_bytes(record['size'], byteorder='little')
 
-        chunk_io = BytesIO(data)
+        # messages are sliced out of the chunk rather than copied
+        chunk_io = BufferReader(data)
         while bytes_to_process > 0:
             chunk_io, record_header = self.read_record_header(chunk_io)
             if record_header is None:
@@ -220,11 +522,22 @@ class bagFileStream:
         data = bagfile.read(record_header['data_len'])
         conn = self.connections[record_header['conn']]
         record_header['time'] = int.from_bytes(record_header['time'], byteorder='little')
+
+        seconds = ros_time_to_seconds(record_header['time'])
+        conn['message_count'] = conn['message_count'] + 1
+        conn['message_bytes'] = conn['message_bytes'] + record_header['data_len']
+        if conn['start_time'] is None or seconds < conn['start_time']:
+            conn['start_time'] = seconds
+        if conn['end_time'] is None or seconds > conn['end_time']:
+            conn['end_time'] = seconds
+        if self.stats_only:
+            return bagfile
+
         record_header['isotime'] = self.ros_time_to_iso(record_header['time'])
 
-        msg_type = bag._get_message_type(ConnectionInfo(conn ))
-        msg = msg_type()
-        msg.deserialize(data)
+        msg = self.message_type(conn)()
+        # genpy needs bytes to decode strings, this is the only copy made of the message data
+        msg.deserialize(bytes(data))
 
         msg_type = conn['type']
         if 'std_msgs' in msg_type:
@@ -237,6 +550,14 @@ class bagFileStream:
             logging.warning(f"unknown message type: {conn['type']}")
         return bagfile
 
+    def message_type(self, conn):
+        msg_type = self.msg_types.get(conn['md5sum'])
+        if msg_type is None:
+            from rosbag import bag
+            msg_type = bag._get_message_type(ConnectionInfo(conn))
+            self.msg_types[conn['md5sum']] = msg_type
+        return msg_type
+
     def process_unknown(self, record, bagfile):
         bagfile.read(record['data_len'])
         logging.warning(f"Unknown header op={record['op']}")
@@ -244,7 +565,7 @@ class bagFileStream:
 
 
     def process_image_data(self, conn, data, record_header, msg):
-
+        from PIL import Image
 
         img_encodings = {'rgb8': 'RGB', 'rgba8': 'RGBA', 'mono8': 'L', '8UC3' : 'RGB'}
 
@@ -263,11 +584,44 @@ class bagFileStream:
             os.makedirs(dir)
         img.save(img_file)
 
-        self.upload_callback(img_file)
+        metadata = {}
+        representative = self.representative_frame(conn, img, img_file, record_header['time'])
+        if representative:
+            metadata['representative'] = representative
+        elif self.mosaic:
+            metadata['mosaic'] = self.mosaic.add(img_file, img)
+        self.upload_callback(img_file, self.chunk_offset, metadata)
+        if self.mosaic and self.mosaic.full():
+            self.upload_mosaic()
 
         new_row = [record_header['time'], record_header['isotime'], img_file]
         conn['csv_writer'].writerow(new_row)
 
+    def upload_mosaic(self):
+        """ Saves and uploads the frames waiting to be tiled as a mosaic, if there are any"""
+        mosaic = self.mosaic.save() if self.mosaic else None
+        if mosaic:
+            mosaic_file, layout = mosaic
+            self.upload_callback(mosaic_file, self.chunk_offset, {'tiles': layout})
+
+    def representative_frame(self, conn, img, img_file, time):
+        """
+        Returns None if a camera frame should be labelled, otherwise the file of the earlier frame of the camera it
+        is near identical to, see scene_change_threshold.
+        """
+        if not self.scene_change_threshold:
+            return None
+        import numpy as np
+
+        thumbnail = np.asarray(img.convert('L').resize((64, 48)), dtype=np.float32) / 255
+        seconds = ros_time_to_seconds(time)
+        last = conn.get('labelled_frame')
+        if (last is None or seconds - last['seconds'] >= self.keyframe_seconds
+                or np.abs(thumbnail - last['thumbnail']).mean() >= self.scene_change_threshold):
+            conn['labelled_frame'] = {'thumbnail': thumbnail, 'seconds': seconds, 'file': img_file}
+            return None
+        return last['file']
+
     def process_laser_data(self, conn, data, record_header, msg):
         new_row = [record_header['time'],
                    record_header['isotime'],
@@ -367,12 +721,56 @@ class bagFileStream:
                     process_bag_header,
                     process_unknown,
                     process_chunk,
-                    process_unknown,
+                    process_chunk_info,
                     process_connection]
 
+    def get_index(self):
+        """
+        Returns the sidecar index of what has been processed: the connections and chunk infos of each bag (more
+        than one for a drive) and the message count, bytes and time range of each topic. Times are in seconds. The
+        topic statistics come from the messages read, or from the chunk infos if the messages were skipped in
+        stats_only mode, in which case the message bytes are not known.
+        """
+        topics = {}
+        for conn in self.topics.values():
+            topics[conn['topic']] = {'type': conn['type'], 'md5sum': conn['md5sum'],
+                                     'count': conn['message_count'], 'bytes': conn['message_bytes'],
+                                     'start_time': conn['start_time'], 'end_time': conn['end_time']}
+
+        if self.stats_only and any(bag['chunks'] for bag in self.bags):
+            for topic in topics.values():
+                topic.update(count=0, bytes=None, start_time=None, end_time=None)
+            for bag in self.bags:
+                conn_topics = {c['conn']: c['topic'] for c in bag['connections']}
+                for chunk in bag['chunks']:
+                    for conn, count in chunk['counts'].items():
+                        topic = topics[conn_topics[conn]]
+                        topic['count'] = topic['count'] + count
+                        if topic['start_time'] is None or chunk['start_time'] < topic['start_time']:
+                            topic['start_time'] = chunk['start_time']
+                        if topic['end_time'] is None or chunk['end_time'] > topic['end_time']:
+                            topic['end_time'] = chunk['end_time']
+
+        start_times = [t['start_time'] for t in topics.values() if t['start_time'] is not None]
+        end_times = [t['end_time'] for t in topics.values() if t['end_time'] is not None]
+        return {'version': 1,
+                'start_time': min(start_times) if start_times else None,
+                'end_time': max(end_times) if end_times else None,
+                'topics': topics,
+                'bags': self.bags}
+
+    def write_index(self):
+        """ Writes the sidecar index next to the outputs and queues it for upload"""
+        index_file = os.path.join(self.output_prefix, INDEX_NAME)
+        dir = os.path.dirname(index_file)
+        if dir and not os.path.exists(dir):
+            os.makedirs(dir)
+        with open(index_file, 'wb') as f:
+            f.write(gzip.compress(json.dumps(self.get_index()).encode()))
+        self.upload_callback(index_file)
+
     def upload_csvs(self):
-        for conn_key in self.connections.keys():
-            conn = self.connections[conn_key]
+        for conn in self.topics.values():
             conn['csv_file'].close()
             self.upload_callback(conn['csv_filename'])
 
@@ -1,10 +1,64 @@
-from bagstream import bagFileStream
+from bagstream import bagFileStream, INDEX_NAME, CSV_PARTS_DIR
+from s3writer import S3Writer, s3_client, error_code
+from manifest import OutputManifest, file_sha256
+from s3reader import S3RangeReader
 import os
+import sys
+import gzip
+import json
 import boto3
 import logging
+import re
+import tarfile
+import time
 from multiprocessing import Process, Queue
 import subprocess
 import uuid
+from botocore.exceptions import ClientError
+from datetime import datetime
+
+# a drive recorded as a sequence of split bags <drive>_0.bag, <drive>_1.bag, ...
+DRIVE_SPLIT = re.compile(r"(.*)_(\d+)\.bag$")
+
+# a part of a topic's CSV, <prefix>/csv-parts/<topic>.part[<range>_]<n>.csv, see bagFileStream
+CSV_PART = re.compile(rf"(.*)/{CSV_PARTS_DIR}/(.*)\.part(\d+_)?(\d+)\.csv$")
+
+# how long a worker keeps a bag's message hidden from other workers, extended while the bag is being extracted
+WORKER_VISIBILITY_SECONDS = 15 * 60
+
+# a worker only stops once these are all 0: messages waiting, sent with a delay, and received but not yet deleted
+# (being extracted by another worker, or put back after a failure)
+WORKER_QUEUE_DEPTH = [
+    "ApproximateNumberOfMessages",
+    "ApproximateNumberOfMessagesDelayed",
+    "ApproximateNumberOfMessagesNotVisible",
+]
+
+# a stats only pass just needs the bag header and the index, so reads ahead in small parts
+STATS_PART_SIZE = 1024 * 1024
+
+# camera frames near identical to the last one marked for labelling are uploaded pointing at it rather than being
+# labelled themselves, and the rest can be tiled into mosaics labelled in their place, see bagFileStream. A threshold
+# of 0 labels every frame, a 1x1 grid labels frames one by one.
+LABELLING = dict(
+    scene_change_threshold=float(os.environ.get("scene_change_threshold", 0)),
+    keyframe_seconds=float(os.environ.get("keyframe_seconds", 5)),
+    mosaic_grid=(int(os.environ.get("mosaic_cols", 1)), int(os.environ.get("mosaic_rows", 1))),
+)
+
+# the frames uploaded for labelling are counted per drive and camera in this DynamoDB table, if set, the counts are
+# added every PROGRESS_SECONDS
+PROGRESS_TABLE = os.environ.get("progress_table")
+PROGRESS_SECONDS = 60
+
+
+def csv_part(key):
+    """ Returns the key of the CSV a part belongs to, its series (the key up to the part number) and number, or None
+    if key isn't a CSV part"""
+    match = CSV_PART.match(key)
+    if not match:
+        return None
+    return f"{match.group(1)}/{match.group(2)}.csv", key[: match.start(4)], int(match.group(4))
 
 
 class Uploader(Process):
@@ -12,93 +66,295 @@ class Uploader(Process):
     Uploader creates a separate process to upload file to S3 as they are generated. It creates a Queue for passing the
     names of files to be uploaded to the run() method, which gets spawned when start() is called
     """
-    def __init__(self, s3_dest_bucket, framerate):
-        """ Constructor take the destination S3 bucket name as an argument"""
+    def __init__(self, s3_dest_bucket, framerate, s3_prefix, etag=None, resumed=False, range_index=None,
+                 last_parts=None):
+        """ Constructor take the destination S3 bucket name, the video framerate, the S3 prefix the outputs are
+        written under, the ETag of the source bag (recorded in checkpoints) and whether the extraction is resuming
+        from a checkpoint as arguments. When extracting one range of a split bag, range_index is the number of the
+        range and no mp4s are generated or CSV parts stitched, that is left to the merge task. last_parts is the
+        number of the last CSV part of each series written by tasks that have finished, see stitch_csvs()."""
         self.s3_dest_bucket = s3_dest_bucket
         self.framerate = framerate
+        self.s3_prefix = s3_prefix
+        self.checkpoint_key = checkpoint_key(s3_prefix, range_index)
+        self.etag = etag
+        self.resumed = resumed
+        self.range_index = range_index
         self.q = Queue()
         self.working_dir = f"/root/efs/{uuid.uuid1().hex}/"
         self.image_dirs = set()
+        # the keys of the CSV parts queued by this task, and the last part of each series written by it or by the
+        # range tasks of a split bag
+        self.part_keys = set()
+        self.last_parts = dict(last_parts or {})
+        # frames uploaded by camera since the progress counters were last updated
+        self.queued = {}
+        self.progress_updated = time.monotonic()
         super().__init__()
 
     def run(self):
         """ run method pulls filenames from the queue and uploads them to S3. If it pulls 'Finished' from the queue
         it will generate mp4s for any channels with png images and upload those to S3 before terminating"""
 
-        s3 = boto3.client("s3")
+        s3 = S3Writer(s3_client(), self.s3_dest_bucket)
+        if self.range_index is None:
+            manifest = OutputManifest(boto3.client("s3"), s3, self.s3_prefix)
+        else:
+            manifest = OutputManifest(boto3.client("s3"), s3, self.s3_prefix, name=f"range{self.range_index:04d}")
+        dynamo = boto3.client("dynamodb")
         while True:
-            file = self.q.get()
+            if time.monotonic() - self.progress_updated >= PROGRESS_SECONDS:
+                self.update_progress(dynamo)
+            file, arg, metadata = self.q.get()
             if file == 'Finished':
-                self.generate_mp4s(s3)
+                if self.range_index is None:
+                    # the CSVs are in S3 before the mp4s, which trigger video labelling
+                    self.stitch_csvs(s3, manifest)
+                    self.generate_mp4s(s3, manifest)
+                s3.retry_dead_letters()
+                # with the writes that only made it when retried
+                manifest.flush()
+                self.update_progress(dynamo)
+                failed = s3.retry_dead_letters()
+                if failed:
+                    logging.error(f"{len(failed)} files could not be uploaded: {failed}")
+                    sys.exit(1)
+                self.save_checkpoint(s3, {"complete": True, "last_parts": self.last_parts})
                 return
-            logging.info(f"uploading {file} to bucket {self.s3_dest_bucket}")
+            if file == 'Checkpoint':
+                self.save_checkpoint(s3, arg, manifest)
+                self.update_progress(dynamo)
+                continue
+            self.add_part(file)
+            self.upload(s3, manifest, file, arg, metadata)
+            image_dir = "/".join(file.split("/")[:-1])
+            # mosaics are only there to be labelled, they don't get an mp4
+            if file.endswith(".png") and "tiles" not in metadata:
+                print(f"adding {image_dir}")
+                self.image_dirs.add(image_dir)
+                print(f"{self.image_dirs}")
+
+    def upload(self, s3, manifest, file, source_offset=None, metadata=None):
+        """ Uploads a file unless the manifest shows a previous run already uploaded the same content. Any metadata
+        is stored with the object along with its SHA-256, with the local paths in it made into keys. The layout of a
+        mosaic is stored as a JSON object next to it, its tiles metadata is the key of that object"""
+        s3_prefix = file.replace(self.working_dir, "")
+        size = os.path.getsize(file)
+        sha256 = file_sha256(file)
+        if manifest.matches(s3_prefix, size, sha256):
+            logging.info(f"skipping {file}, already in bucket {self.s3_dest_bucket}")
+            return
+        logging.info(f"uploading {file} to bucket {self.s3_dest_bucket}")
+        metadata = {k: v.replace(self.working_dir, "") for k, v in (metadata or {}).items()}
+        metadata["sha256"] = sha256
+        # the labelling Lambdas count frames under the drive they belong to
+        metadata["drive"] = self.s3_prefix
+        if "tiles" in metadata:
+            # a mosaic's layout names its frames, which takes more than the 2KB of user metadata S3 allows for larger
+            # grids, so it is written next to the mosaic, before the mosaic is labelled
+            layout_key = os.path.splitext(s3_prefix)[0] + ".json"
+            s3.put_object(layout_key, metadata["tiles"].encode(), ContentType="application/json")
+            metadata["tiles"] = layout_key
+
+        def uploaded():
+            # also called if the upload only succeeds when the dead letters are retried
+            manifest.add(s3_prefix, size, sha256, source_offset)
+            if file.endswith(".png") and "tiles" not in metadata:
+                camera = os.path.dirname(s3_prefix)[len(self.s3_prefix):].strip("/")
+                self.queued[camera] = self.queued.get(camera, 0) + 1
+
+        s3.upload_file(file, s3_prefix, extra_args={"Metadata": metadata}, on_success=uploaded)
+
+    def update_progress(self, dynamo):
+        """ Adds the frames uploaded since the last update to the queued counters of the progress table"""
+        self.progress_updated = time.monotonic()
+        if not PROGRESS_TABLE:
+            return
+        now = datetime.now().isoformat()
+        for camera, count in list(self.queued.items()):
             try:
-                s3_prefix = file.replace(self.working_dir, "")
-                s3.upload_file(file, self.s3_dest_bucket, s3_prefix)
-                image_dir = "/".join(file.split("/")[:-1])
-                if file.endswith(".png"):
-                    print(f"adding {image_dir}")
-                    self.image_dirs.add(image_dir)
-                    print(f"{self.image_dirs}")
+                dynamo.update_item(
+                    TableName=PROGRESS_TABLE,
+                    Key={"drive": {"S": self.s3_prefix}, "camera": {"S": camera}},
+                    UpdateExpression="ADD #queued :n"
+                    " SET last_queued = :now, first_queued = if_not_exists(first_queued, :now)",
+                    ExpressionAttributeNames={"#queued": "queued"},
+                    ExpressionAttributeValues={":n": {"N": str(count)}, ":now": {"S": now}},
+                )
+                del self.queued[camera]
+            except ClientError as e:
+                # the count is kept and added with the next update
+                logging.warning(f"could not update the progress of {self.s3_prefix}/{camera}: {e}")
 
-            except Exception as e:
-                logging.warning(e)
+    def save_checkpoint(self, s3, state, manifest=None):
+        """
+        Writes a checkpoint to S3. Everything queued before the checkpoint has been through upload() by now, it is
+        only written if none of those uploads are still failing, otherwise a resumed task would miss them.
+        """
+        s3.retry_dead_letters()
+        if manifest:
+            # with the uploads that only made it when retried
+            manifest.flush()
+        if s3.retry_dead_letters():
+            logging.warning("not saving checkpoint as some earlier files could not be uploaded")
+            return
+        state["etag"] = self.etag
+        logging.info(f"saving checkpoint to {self.checkpoint_key}")
+        s3.put_object(self.checkpoint_key, gzip.compress(json.dumps(state).encode()), dead_letter=False)
+
+    def add_part(self, file):
+        """ Records a file queued for upload if it is a CSV part, see stitch_csvs()"""
+        key = file.replace(self.working_dir, "")
+        part = csv_part(key)
+        if part:
+            _, series, number = part
+            self.part_keys.add(key)
+            self.last_parts[series] = max(self.last_parts.get(series, -1), number)
+
+    def stitch_csvs(self, s3, manifest):
+        """
+        Concatenates the CSV parts of each topic, written at every checkpoint by this task, earlier attempts at the
+        bag or the range tasks of a split bag, into one <topic>.csv and uploads it. A part numbered past the last part
+        of its series was uploaded by an attempt that failed after its last checkpoint, the rows in it were extracted
+        again by the attempt that finished, so the part is left out. The parts this task wrote are read from the
+        working directory, the rest from S3.
+        """
+        parts = {}
+        for key in set(manifest.entries) | self.part_keys:
+            part = csv_part(key)
+            if not part:
+                continue
+            csv_key, series, number = part
+            if number <= self.last_parts.get(series, -1):
+                parts.setdefault(csv_key, []).append((series, number, key))
+
+        s3_client = boto3.client("s3")
+        for csv_key, topic_parts in parts.items():
+            csvfile = os.path.join(self.working_dir, csv_key)
+            os.makedirs(os.path.dirname(csvfile), exist_ok=True)
+            header = None
+            with open(csvfile, "wb") as out:
+                for _, _, key in sorted(topic_parts):
+                    local_file = os.path.join(self.working_dir, key)
+                    if os.path.exists(local_file):
+                        with open(local_file, "rb") as f:
+                            lines = f.read().splitlines(keepends=True)
+                    else:
+                        body = s3_client.get_object(Bucket=self.s3_dest_bucket, Key=key)["Body"].read()
+                        lines = body.splitlines(keepends=True)
+                    # parts of topics with generic messages each start with the same column names
+                    if lines and lines[0].startswith(b"Time,ISOTime"):
+                        if header is None:
+                            header = lines[0]
+                        else:
+                            lines = lines[1:]
+                    out.writelines(lines)
+            logging.info(f"stitched {len(topic_parts)} parts into {csv_key}")
+            self.upload(s3, manifest, csvfile)
+
+    def fetch_earlier_frames(self, manifest):
+        """ Downloads the frames a resumed task's earlier attempts uploaded, so the mp4s cover the whole bag"""
+        s3 = boto3.client("s3")
+        for key in manifest.entries:
+            local_file = os.path.join(self.working_dir, key)
+            if key.endswith(".png") and "/mosaics/" not in key and not os.path.exists(local_file):
+                image_dir = os.path.dirname(local_file)
+                os.makedirs(image_dir, exist_ok=True)
+                s3.download_file(self.s3_dest_bucket, key, local_file)
+                self.image_dirs.add(image_dir)
 
-    def generate_mp4s(self, s3):
+    def generate_mp4s(self, s3, manifest):
         """
         Goes through the list of directories containing png files and generates an mp4 for each of them. These are
         uploaded to S3 along side the images.
         """
 
+        if self.resumed:
+            self.fetch_earlier_frames(manifest)
+
         # generate mp4 files
         print(f"processing {self.image_dirs}")
 
         for x in self.image_dirs:
             try:
+                # frame file names sort by timestamp then frame number
                 subprocess.call(
-                    f"ffmpeg -framerate {self.framerate} -i {x}/image_raw-%04d.png -c:v libx264 -crf 20 -pix_fmt yuv420p {x}.mp4",
+                    f"ffmpeg -framerate {self.framerate} -pattern_type glob -i '{x}/*.png' -c:v libx264 -crf 20 -pix_fmt yuv420p {x}.mp4",
                     shell=True,
                 )
-                s3_prefix = x.replace(self.working_dir, "")
-                s3.upload_file(f"{x}.mp4", self.s3_dest_bucket, f"{s3_prefix}.mp4")
+                self.upload(s3, manifest, f"{x}.mp4")
 
             except Exception as e:
                 logging.warning(e)
 
-    def upload_callback(self,file):
-        """ Call back function to pass to the bagFileStream object. Just queues the file for upload"""
-        logging.info(f"queuing {file} for upload to bucket {s3_src_bucket}")
-        self.q.put(file)
+    def upload_callback(self, file, source_offset=None, metadata=None):
+        """ Call back function to pass to the bagFileStream object. Just queues the file for upload along with the
+        offset of the bag chunk it was extracted from and any metadata to store with it, such as how a frame is
+        labelled"""
+        logging.info(f"queuing {file} for upload to bucket {self.s3_dest_bucket}")
+        self.q.put((file, source_offset, metadata or {}))
 
+    def checkpoint_callback(self, state):
+        """ Call back function to pass to the bagFileStream object. Queues the checkpoint behind the files extracted
+        before it, so it is only saved once they are in S3"""
+        self.q.put(('Checkpoint', state, {}))
 
-if __name__ == "__main__":
 
-    s3_src_bucket = os.environ["s3_source"]
-    s3_src_key = os.environ["s3_source_prefix"]
-    s3_dest_bucket = os.environ["s3_destination"]
-    if "framerate" in os.environ:
-        framerate = os.environ["framerate"]
-    else:
-        framerate = 20
+def checkpoint_key(s3_prefix, range_index=None):
+    if range_index is None:
+        return f"{s3_prefix}/checkpoint.json.gz"
+    return f"{s3_prefix}/checkpoint-range{range_index:04d}.json.gz"
+
+
+def load_checkpoint(s3, bucket, key, etag):
+    """ Returns the checkpoint left by an earlier attempt at the same bag, or None if we need to start from byte 0"""
+    try:
+        state = read_gzip_json(s3, bucket, key)
+    except s3.exceptions.NoSuchKey:
+        return None
+    if state.get("complete") or state.get("etag") != etag:
+        return None
+    return state
 
-    upload = Uploader(s3_dest_bucket, framerate)
-    upload.start()
 
+def get_datafolder(s3_src_key):
     key_root = s3_src_key.split(".")[:-1]
     file_root = "/".join(key_root[0].split("/")[0:-1]).replace(".", "")
     # get the name of the input file without the .bag extension
-    datafolder = os.path.join("/".join(key_root), file_root)
+    return os.path.join("/".join(key_root), file_root)
 
-    s3 = boto3.client("s3")
-    input_stream = s3.get_object(Bucket=s3_src_bucket, Key=s3_src_key)["Body"]
 
-    bagfile = bagFileStream(
-        input_stream, upload.upload_callback, output_prefix=upload.working_dir + datafolder
+def read_gzip_json(s3, bucket, key):
+    return json.loads(gzip.decompress(s3.get_object(Bucket=bucket, Key=key)["Body"].read()))
+
+
+def run_extraction(upload, input_stream, datafolder, checkpoint=None, checkpoint_interval=300, range_index=None):
+    """ Extracts a bag stream, or a local bag file if input_stream is a path, with the given (already started)
+    uploader, returns the uploader's exit code. No checkpoints are saved if checkpoint_interval is None. The sidecar
+    index is written unless only one range of the bag is extracted (range_index is given)."""
+    kwargs = dict(
+        output_prefix=upload.working_dir + datafolder,
+        checkpoint=checkpoint,
+        checkpoint_callback=upload.checkpoint_callback if checkpoint_interval else None,
+        checkpoint_interval=checkpoint_interval,
+        range_index=range_index,
+        **LABELLING,
     )
+    if isinstance(input_stream, str):
+        bagfile = bagFileStream.from_file(input_stream, upload.upload_callback, **kwargs)
+    else:
+        bagfile = bagFileStream(input_stream, upload.upload_callback, **kwargs)
+        input_stream.close()
+    if range_index is None:
+        bagfile.write_index()
     bagfile.upload_csvs()
+    return finish(upload)
 
+
+def finish(upload):
     upload.upload_callback('Finished')
     upload.join()
+    exitcode = upload.exitcode
     upload.close()
 
     # Clean up
@@ -106,3 +362,395 @@ if __name__ == "__main__":
         f'rm -rf {upload.working_dir}',
         shell=True,
     )
+    return exitcode
+
+
+def extract(s3, s3_src_bucket, s3_src_key, s3_dest_bucket, framerate, checkpoint_interval, readahead_connections):
+    """ Extracts a whole bag, resuming from the last checkpoint if an earlier attempt failed part way through"""
+    datafolder = get_datafolder(s3_src_key)
+    etag = s3.head_object(Bucket=s3_src_bucket, Key=s3_src_key)["ETag"]
+
+    checkpoint = load_checkpoint(s3, s3_dest_bucket, checkpoint_key(datafolder), etag)
+
+    upload = Uploader(s3_dest_bucket, framerate, s3_prefix=datafolder, etag=etag, resumed=bool(checkpoint))
+    upload.start()
+
+    input_stream = S3RangeReader(
+        s3,
+        s3_src_bucket,
+        s3_src_key,
+        start=checkpoint["offset"] if checkpoint else 0,
+        etag=etag,
+        connections=readahead_connections,
+    )
+
+    return run_extraction(upload, input_stream, datafolder, checkpoint, checkpoint_interval)
+
+
+def extract_archive(s3, s3_src_bucket, s3_src_key, s3_dest_bucket, framerate, readahead_connections):
+    """
+    Extracts every bag in a tar.gz archive in one pass. The archive is decompressed as it streams in from S3 and each
+    member is read straight into a bagFileStream, so nothing is staged on disk. The outputs of each bag are written
+    under <archive name>/<member name>. A gzip stream can't be resumed part way through, so no checkpoints are
+    saved, but a rerun still skips the outputs that are already in S3.
+    """
+    etag = s3.head_object(Bucket=s3_src_bucket, Key=s3_src_key)["ETag"]
+    archive_root = re.sub(r"\.(tar\.gz|tgz)$", "", s3_src_key)
+    input_stream = S3RangeReader(s3, s3_src_bucket, s3_src_key, etag=etag, connections=readahead_connections)
+
+    exitcode = 0
+    with tarfile.open(fileobj=input_stream, mode="r|gz") as archive:
+        for member in archive:
+            if not member.isfile() or not member.name.endswith(".bag"):
+                continue
+            logging.info(f"extracting {member.name} from {s3_src_key}")
+            datafolder = get_datafolder(f"{archive_root}/{member.name}")
+            upload = Uploader(s3_dest_bucket, framerate, s3_prefix=datafolder, etag=etag)
+            upload.start()
+            exitcode = run_extraction(upload, archive.extractfile(member), datafolder, checkpoint_interval=None) \
+                or exitcode
+
+    input_stream.close()
+    return exitcode
+
+
+def extract_local(s3, path, s3_dest_bucket, framerate, checkpoint_interval):
+    """ Extracts a bag that is already on a local disk or EFS, the outputs are named after its path"""
+    datafolder = get_datafolder(path.lstrip("/"))
+    stat = os.stat(path)
+    # stands in for the ETag to tell whether a checkpoint is for this version of the file
+    etag = f"{stat.st_size}-{int(stat.st_mtime)}"
+
+    checkpoint = load_checkpoint(s3, s3_dest_bucket, checkpoint_key(datafolder), etag)
+
+    upload = Uploader(s3_dest_bucket, framerate, s3_prefix=datafolder, etag=etag, resumed=bool(checkpoint))
+    upload.start()
+
+    return run_extraction(upload, path, datafolder, checkpoint, checkpoint_interval)
+
+
+def wait_for_object(s3, bucket, key, timeout, poll_seconds=30):
+    """ Returns the ETag of key once it exists, or None if it has not appeared after timeout seconds"""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return s3.head_object(Bucket=bucket, Key=key)["ETag"]
+        except ClientError as e:
+            if error_code(e) not in ("404", "NoSuchKey", "NotFound"):
+                raise
+        if time.monotonic() >= deadline:
+            return None
+        logging.info(f"waiting for s3://{bucket}/{key}")
+        time.sleep(poll_seconds)
+
+
+def extract_drive(s3, s3_src_bucket, s3_src_key, s3_dest_bucket, framerate, checkpoint_interval,
+                  readahead_connections, split_wait_seconds):
+    """
+    Extracts a drive recorded as a sequence of split bags into one set of outputs, starting from the split in
+    s3_src_key (normally <drive>_0.bag) as soon as it lands. The splits are processed in order with a single
+    bagFileStream, so the CSV files and frame numbers carry on from one split to the next and there is one mp4 per
+    camera for the whole drive. The drive is complete once the next split has not appeared after split_wait_seconds.
+    """
+    match = DRIVE_SPLIT.match(s3_src_key)
+    drive = match.group(1)
+    split = int(match.group(2))
+    datafolder = get_datafolder(f"{drive}.bag")
+
+    # drive checkpoints also record which split they are in, and that split's ETag
+    checkpoint = load_checkpoint(s3, s3_dest_bucket, checkpoint_key(datafolder), None)
+    if checkpoint:
+        etag = wait_for_object(s3, s3_src_bucket, f"{drive}_{checkpoint['split']}.bag", 0)
+        if etag == checkpoint["split_etag"]:
+            split = checkpoint["split"]
+        else:
+            logging.warning(f"split {checkpoint['split']} of {drive} has changed, starting again")
+            checkpoint = None
+
+    upload = Uploader(s3_dest_bucket, framerate, s3_prefix=datafolder, resumed=bool(checkpoint))
+    upload.start()
+
+    current = {}
+
+    def checkpoint_callback(state):
+        state.update(current)
+        upload.checkpoint_callback(state)
+
+    bagfile = None
+    etag = wait_for_object(s3, s3_src_bucket, f"{drive}_{split}.bag", split_wait_seconds)
+    while etag:
+        split_key = f"{drive}_{split}.bag"
+        logging.info(f"extracting split {split} of {drive}")
+        current.update(split=split, split_etag=etag)
+        input_stream = S3RangeReader(
+            s3,
+            s3_src_bucket,
+            split_key,
+            start=checkpoint["offset"] if checkpoint else 0,
+            etag=etag,
+            connections=readahead_connections,
+        )
+        if bagfile is None:
+            bagfile = bagFileStream(
+                input_stream,
+                upload.upload_callback,
+                output_prefix=upload.working_dir + datafolder,
+                checkpoint=checkpoint,
+                checkpoint_callback=checkpoint_callback if checkpoint_interval else None,
+                checkpoint_interval=checkpoint_interval,
+                **LABELLING,
+            )
+        else:
+            bagfile.extract(input_stream)
+        input_stream.close()
+        checkpoint = None
+
+        split += 1
+        etag = wait_for_object(s3, s3_src_bucket, f"{drive}_{split}.bag", split_wait_seconds)
+
+    logging.info(f"{drive} complete after {split} splits")
+    if bagfile:
+        bagfile.write_index()
+        bagfile.upload_csvs()
+    return finish(upload)
+
+
+def index_bag(s3, s3_src_bucket, s3_src_key, s3_dest_bucket):
+    """
+    Writes the sidecar index of a bag without extracting it. Only the bag header and the connection and chunk info
+    records in the index at the end of the bag are read, with a few ranged GETs, so the per topic message bytes are
+    not known. A bag without an index is read through but its messages are not decoded.
+    """
+    datafolder = get_datafolder(s3_src_key)
+    etag = s3.head_object(Bucket=s3_src_bucket, Key=s3_src_key)["ETag"]
+    input_stream = S3RangeReader(s3, s3_src_bucket, s3_src_key, etag=etag, connections=2, part_size=STATS_PART_SIZE)
+    bagfile = bagFileStream(input_stream, None, stats_only=True)
+    input_stream.close()
+
+    index = bagfile.get_index()
+    index["etag"] = etag
+    index_key = f"{datafolder}/{INDEX_NAME}"
+    logging.info(f"writing index of s3://{s3_src_bucket}/{s3_src_key} to {index_key}")
+    writer = S3Writer(s3_client(), s3_dest_bucket)
+    if not writer.put_object(index_key, gzip.compress(json.dumps(index).encode()), dead_letter=False):
+        return 1
+    return 0
+
+
+def extract_range(s3, s3_src_bucket, s3_src_key, s3_dest_bucket, framerate, checkpoint_interval,
+                  readahead_connections, plan_key, range_index):
+    """
+    Extracts one byte range of a bag that has been split across several tasks. The plan gives the range and a
+    checkpoint to start it from, which holds the connection table and the frame counts at the start of the range.
+    """
+    datafolder = get_datafolder(s3_src_key)
+    plan = read_gzip_json(s3, s3_dest_bucket, plan_key)
+    byte_range = plan["ranges"][range_index]
+
+    checkpoint = load_checkpoint(s3, s3_dest_bucket, checkpoint_key(datafolder, range_index), plan["etag"])
+    if not checkpoint:
+        checkpoint = byte_range["checkpoint"]
+
+    upload = Uploader(s3_dest_bucket, framerate, s3_prefix=datafolder, etag=plan["etag"], range_index=range_index)
+    upload.start()
+
+    input_stream = S3RangeReader(
+        s3,
+        s3_src_bucket,
+        s3_src_key,
+        start=checkpoint["offset"],
+        end=byte_range["end"],
+        etag=plan["etag"],
+        connections=readahead_connections,
+    )
+
+    return run_extraction(upload, input_stream, datafolder, checkpoint, checkpoint_interval, range_index=range_index)
+
+
+def merge_ranges(s3, s3_src_bucket, s3_src_key, s3_dest_bucket, framerate):
+    """
+    Stitches the per range CSV parts of a split bag into one CSV per topic and generates the mp4s from the frames
+    uploaded by all the range tasks. The sidecar index is built from the bag's own index, as no task has seen the
+    whole bag.
+    """
+    datafolder = get_datafolder(s3_src_key)
+
+    # the last CSV part of each series, from the checkpoint each range task saved when it completed
+    last_parts = {}
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=s3_dest_bucket, Prefix=f"{datafolder}/checkpoint-range"):
+        for obj in page.get("Contents", []):
+            for series, number in read_gzip_json(s3, s3_dest_bucket, obj["Key"]).get("last_parts", {}).items():
+                last_parts[series] = max(last_parts.get(series, -1), number)
+
+    # the uploader stitches the parts together when it finishes
+    upload = Uploader(s3_dest_bucket, framerate, s3_prefix=datafolder, resumed=True, last_parts=last_parts)
+    upload.start()
+
+    return finish(upload) or index_bag(s3, s3_src_bucket, s3_src_key, s3_dest_bucket)
+
+
+def process_bag(s3, job, framerate, checkpoint_interval, readahead_connections, split_wait_seconds):
+    """ Runs the extraction for a bag, archive or drive, job holds the same fields as a state machine execution"""
+    if re.search(r"\.(tar\.gz|tgz)$", job["key"]):
+        return extract_archive(s3, job["bucket"], job["key"], job["dest_bucket"], framerate, readahead_connections)
+    if job.get("mode") == "drive":
+        return extract_drive(
+            s3,
+            job["bucket"],
+            job["key"],
+            job["dest_bucket"],
+            framerate,
+            checkpoint_interval,
+            readahead_connections,
+            split_wait_seconds,
+        )
+    return extract(
+        s3, job["bucket"], job["key"], job["dest_bucket"], framerate, checkpoint_interval, readahead_connections
+    )
+
+
+def process_job(job, framerate, checkpoint_interval, readahead_connections, split_wait_seconds):
+    """ Target of the worker's child processes"""
+    s3 = boto3.client("s3")
+    sys.exit(process_bag(s3, job, framerate, checkpoint_interval, readahead_connections, split_wait_seconds))
+
+
+def queue_is_empty(sqs, queue_url):
+    attributes = sqs.get_queue_attributes(QueueUrl=queue_url, AttributeNames=WORKER_QUEUE_DEPTH)["Attributes"]
+    return not any(int(attributes.get(name, 0)) for name in WORKER_QUEUE_DEPTH)
+
+
+def run_worker(queue_url, cache_table, framerate, checkpoint_interval, readahead_connections, split_wait_seconds,
+               concurrency, idle_seconds):
+    """
+    Extracts bags from an SQS queue until it has been idle for idle_seconds, up to concurrency at a time. Each bag is
+    extracted in a child process forked from this one, so the modules are only imported once. A bag's message is
+    deleted once it has been extracted, a failed bag is put back on the queue after a minute and resumes from its
+    checkpoint. Completed bags are recorded in the extraction cache, as the state machine does.
+
+    bag-queue-proc doesn't start a worker while the maximum are running, so a bag queued just as this one goes idle
+    could be left with no worker. Before stopping it receives once more without waiting and checks the queue is
+    empty, and otherwise keeps going.
+    """
+    sqs = boto3.client("sqs")
+    cache = boto3.resource("dynamodb").Table(cache_table)
+    running = {}
+    last_busy = time.monotonic()
+    last_heartbeat = time.monotonic()
+
+    while True:
+        for worker, (message, job) in list(running.items()):
+            if worker.is_alive():
+                continue
+            worker.join()
+            del running[worker]
+            if worker.exitcode == 0:
+                logging.info(f"extracted s3://{job['bucket']}/{job['key']}")
+                cache.put_item(
+                    Item={"fingerprint": job["fingerprint"], "bucket": job["bucket"], "key": job["key"],
+                          "execution": "worker"}
+                )
+                sqs.delete_message(QueueUrl=queue_url, ReceiptHandle=message["ReceiptHandle"])
+            else:
+                logging.error(f"extracting s3://{job['bucket']}/{job['key']} failed with {worker.exitcode}")
+                sqs.change_message_visibility(
+                    QueueUrl=queue_url, ReceiptHandle=message["ReceiptHandle"], VisibilityTimeout=60
+                )
+
+        if time.monotonic() - last_heartbeat >= WORKER_VISIBILITY_SECONDS / 3:
+            for message, _ in running.values():
+                sqs.change_message_visibility(
+                    QueueUrl=queue_url,
+                    ReceiptHandle=message["ReceiptHandle"],
+                    VisibilityTimeout=WORKER_VISIBILITY_SECONDS,
+                )
+            last_heartbeat = time.monotonic()
+
+        if running:
+            last_busy = time.monotonic()
+        if len(running) >= concurrency:
+            time.sleep(5)
+            continue
+
+        idle = not running and time.monotonic() - last_busy >= idle_seconds
+        # a long poll, which also paces the loop while there is nothing to do
+        messages = sqs.receive_message(
+            QueueUrl=queue_url,
+            MaxNumberOfMessages=min(10, concurrency - len(running)),
+            WaitTimeSeconds=0 if idle else 5 if running else 20,
+            VisibilityTimeout=WORKER_VISIBILITY_SECONDS,
+        ).get("Messages", [])
+        if idle and not messages:
+            if queue_is_empty(sqs, queue_url):
+                break
+            # bags that are delayed or being retried, which this worker may have to pick up
+            last_busy = time.monotonic()
+        for message in messages:
+            job = json.loads(message["Body"])
+            logging.info(f"worker starting s3://{job['bucket']}/{job['key']}")
+            worker = Process(
+                target=process_job,
+                args=(job, framerate, checkpoint_interval, readahead_connections, split_wait_seconds),
+            )
+            worker.start()
+            running[worker] = (message, job)
+            last_busy = time.monotonic()
+
+    logging.info(f"no bags for {idle_seconds}s, worker shutting down")
+    return 0
+
+
+if __name__ == "__main__":
+
+    # not used when extracting a local file
+    s3_src_bucket = os.environ.get("s3_source")
+    s3_src_key = os.environ.get("s3_source_prefix")
+    s3_dest_bucket = os.environ["s3_destination"]
+    if "framerate" in os.environ:
+        framerate = os.environ["framerate"]
+    else:
+        framerate = 20
+    checkpoint_interval = int(os.environ.get("checkpoint_seconds", 300))
+    # number of concurrent ranged GETs reading ahead of the parser
+    readahead_connections = int(os.environ.get("readahead_connections", 8))
+    mode = os.environ.get("mode", "extract")
+    # how long a drive task waits for the next split of the drive before finishing
+    split_wait_seconds = int(os.environ.get("split_wait_seconds", 600))
+
+    s3 = boto3.client("s3")
+    if mode == "range":
+        exitcode = extract_range(
+            s3,
+            s3_src_bucket,
+            s3_src_key,
+            s3_dest_bucket,
+            framerate,
+            checkpoint_interval,
+            readahead_connections,
+            os.environ["plan_key"],
+            int(os.environ["range_index"]),
+        )
+    elif mode == "worker":
+        exitcode = run_worker(
+            os.environ["worker_queue_url"],
+            os.environ["cache_table"],
+            framerate,
+            checkpoint_interval,
+            readahead_connections,
+            split_wait_seconds,
+            int(os.environ.get("worker_concurrency", 2)),
+            int(os.environ.get("worker_idle_seconds", 600)),
+        )
+    elif mode == "local":
+        exitcode = extract_local(s3, os.environ["local_path"], s3_dest_bucket, framerate, checkpoint_interval)
+    elif mode == "merge":
+        exitcode = merge_ranges(s3, s3_src_bucket, s3_src_key, s3_dest_bucket, framerate)
+    elif mode == "stats":
+        exitcode = index_bag(s3, s3_src_bucket, s3_src_key, s3_dest_bucket)
+    else:
+        job = {"bucket": s3_src_bucket, "key": s3_src_key, "dest_bucket": s3_dest_bucket, "mode": mode}
+        exitcode = process_bag(s3, job, framerate, checkpoint_interval, readahead_connections, split_wait_seconds)
+
+    # fail the task if any file could not be uploaded, so that it gets retried
+    sys.exit(exitcode)
@@ -0,0 +1,75 @@
+# Copyright (c) Amazon Web Services
+# About: Output manifest for an extraction. Every object written to S3 is
+#        recorded with its size, SHA-256 and the offset of the bag chunk it
+#        came from. The manifest is written incrementally as numbered JSON
+#        lines parts so that a rerun of the same bag can skip everything that
+#        already made it to S3.
+
+import hashlib
+import json
+import logging
+
+
+def file_sha256(filename, block_size=1024 * 1024):
+    h = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+class OutputManifest:
+    """
+    Manifest of the outputs of one bag, stored as s3://<bucket>/<prefix>/manifest/<name>-NNNNN.jsonl. Entries from
+    previous runs are loaded on construction, new entries are buffered and written as a new part every flush_every
+    entries (and on flush()), parts are never overwritten. Tasks writing to the same manifest at the same time must
+    use different names.
+    """
+
+    def __init__(self, s3, writer, prefix, flush_every=500, name="part"):
+        """ s3 is a client used to read back existing parts, writer is the S3Writer used to write new ones"""
+        self.s3 = s3
+        self.writer = writer
+        self.manifest_prefix = f"{prefix}/manifest/"
+        self.name = name
+        self.flush_every = flush_every
+        self.entries = {}
+        self.pending = []
+        self.part = 0
+        self.load()
+
+    def load(self):
+        paginator = self.s3.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.writer.bucket, Prefix=self.manifest_prefix):
+            for obj in page.get("Contents", []):
+                body = self.s3.get_object(Bucket=self.writer.bucket, Key=obj["Key"])["Body"].read()
+                for line in body.decode().splitlines():
+                    if line:
+                        entry = json.loads(line)
+                        self.entries[entry["key"]] = entry
+                name, part = obj["Key"][len(self.manifest_prefix) :].split(".")[0].rsplit("-", 1)
+                if name == self.name:
+                    self.part = max(self.part, int(part) + 1)
+
+        if self.entries:
+            logging.info(f"loaded {len(self.entries)} manifest entries from {self.manifest_prefix}")
+
+    def matches(self, key, size, sha256):
+        """ True if key was already written by a previous run with the same content"""
+        entry = self.entries.get(key)
+        return entry is not None and entry["size"] == size and entry["sha256"] == sha256
+
+    def add(self, key, size, sha256, source_offset=None):
+        entry = {"key": key, "size": size, "sha256": sha256, "source_offset": source_offset}
+        self.entries[key] = entry
+        self.pending.append(entry)
+        if len(self.pending) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        body = "".join(json.dumps(e) + "\n" for e in self.pending).encode()
+        self.writer.put_object(f"{self.manifest_prefix}{self.name}-{self.part:05d}.jsonl", body)
+        self.part = self.part + 1
+        self.pending = []
@@ -0,0 +1,60 @@
+# Copyright (c) Amazon Web Services
+# About: Tiles camera frames into mosaics so that one Rekognition DetectLabels
+#        call labels several frames. Each mosaic is uploaded with its layout,
+#        which the labelling Lambda uses to map the boxes found back to the
+#        frames they are in.
+
+import json
+import os
+
+
+class MosaicBuilder:
+    """
+    Collects frames and tiles them row by row into a grid of cols x rows cells, saved as a PNG under
+    <output_prefix>/mosaics. Every cell is the size of the largest frame, smaller frames sit in the top left corner of
+    their cell. A mosaic holding fewer frames than the grid, because the bag ended, only has the rows it needs.
+    """
+
+    def __init__(self, output_prefix, cols, rows):
+        self.output_prefix = output_prefix
+        self.cols = cols
+        self.rows = rows
+        self.frames = []
+
+    def mosaic_file(self):
+        """ The mosaic is named after its first frame, so the name is unique and the same if the bag is re-extracted"""
+        first = os.path.relpath(self.frames[0][0], self.output_prefix)
+        return os.path.join(self.output_prefix, 'mosaics', first.replace('/', '_'))
+
+    def add(self, img_file, img):
+        """ Adds a frame, returns the file of the mosaic it will be in"""
+        self.frames.append((img_file, img))
+        return self.mosaic_file()
+
+    def full(self):
+        return len(self.frames) >= self.cols * self.rows
+
+    def save(self):
+        """
+        Saves the frames added since the last mosaic as a mosaic, returns its file and its layout as JSON, None if
+        there are no frames.
+        """
+        if not self.frames:
+            return None
+        from PIL import Image
+
+        cell_width = max(img.width for _, img in self.frames)
+        cell_height = max(img.height for _, img in self.frames)
+        rows = (len(self.frames) + self.cols - 1) // self.cols
+        mosaic = Image.new('RGB', (cell_width * self.cols, cell_height * rows))
+        tiles = []
+        for i, (img_file, img) in enumerate(self.frames):
+            mosaic.paste(img.convert('RGB'), ((i % self.cols) * cell_width, (i // self.cols) * cell_height))
+            tiles.append([img_file, img.width, img.height])
+
+        mosaic_file = self.mosaic_file()
+        os.makedirs(os.path.dirname(mosaic_file), exist_ok=True)
+        mosaic.save(mosaic_file)
+        self.frames = []
+        layout = {'cols': self.cols, 'rows': rows, 'cell': [cell_width, cell_height], 'tiles': tiles}
+        return mosaic_file, json.dumps(layout, separators=(',', ':'))
@@ -0,0 +1,105 @@
+# Copyright (c) Amazon Web Services
+# About: File-like reader for an S3 object that downloads the upcoming byte
+#        ranges concurrently over several connections. Parsing a bag only
+#        ever reads forward, so the next parts can be fetched ahead of time
+#        into a bounded set of buffers and read() is served from memory.
+
+import logging
+import random
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import BotoCoreError, ClientError
+
+
+class S3RangeReader:
+    """
+    Sequential reader for bytes [start, end) of an S3 object, a drop in replacement for the streaming body returned
+    by get_object. Up to connections parts of part_size bytes are downloaded or held in memory at any time. A part
+    that fails to download is retried up to max_attempts times with backoff before read() raises.
+    """
+
+    def __init__(self, s3, bucket, key, start=0, end=None, etag=None, connections=8, part_size=8 * 1024 * 1024,
+                 max_attempts=5):
+        """ end defaults to the end of the object, if etag is given every ranged GET is made conditional on it"""
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.etag = etag
+        self.part_size = part_size
+        self.connections = connections
+        self.max_attempts = max_attempts
+        if end is None:
+            end = s3.head_object(Bucket=bucket, Key=key)["ContentLength"]
+        self.end = end
+        self.next_offset = start
+        self.parts = deque()
+        self.buf = b""
+        self.buf_pos = 0
+        self.executor = ThreadPoolExecutor(max_workers=connections)
+        self.fill()
+
+    def fetch(self, start, end):
+        extra_args = {"IfMatch": self.etag} if self.etag else {}
+        for attempt in range(self.max_attempts):
+            try:
+                data = self.s3.get_object(
+                    Bucket=self.bucket, Key=self.key, Range=f"bytes={start}-{end - 1}", **extra_args
+                )["Body"].read()
+                if len(data) == end - start:
+                    return data
+                logging.warning(f"short read of bytes {start}-{end - 1} from s3://{self.bucket}/{self.key}")
+            except (ClientError, BotoCoreError) as e:
+                if attempt == self.max_attempts - 1:
+                    raise
+                logging.warning(f"reading bytes {start}-{end - 1} from s3://{self.bucket}/{self.key} failed: {e}")
+            time.sleep(random.uniform(0, 2 ** attempt))
+
+        raise IOError(f"could not read bytes {start}-{end - 1} from s3://{self.bucket}/{self.key}")
+
+    def fill(self):
+        """ Queues downloads of the next parts until connections parts are in flight or buffered"""
+        while len(self.parts) < self.connections and self.next_offset < self.end:
+            part_end = min(self.end, self.next_offset + self.part_size)
+            self.parts.append(self.executor.submit(self.fetch, self.next_offset, part_end))
+            self.next_offset = part_end
+
+    def next_part(self):
+        if not self.parts:
+            return False
+        self.buf = self.parts.popleft().result()
+        self.buf_pos = 0
+        self.fill()
+        return True
+
+    def read(self, size=-1):
+        chunks = []
+        while size != 0:
+            if self.buf_pos >= len(self.buf) and not self.next_part():
+                break
+            available = len(self.buf) - self.buf_pos
+            take = available if size < 0 else min(size, available)
+            chunks.append(self.buf[self.buf_pos : self.buf_pos + take])
+            self.buf_pos += take
+            if size > 0:
+                size -= take
+
+        if len(chunks) == 1:
+            return chunks[0]
+        return b"".join(chunks)
+
+    def seek(self, pos):
+        """ Drops the parts read ahead and carries on reading from pos, used to jump to the index of a bag"""
+        for part in self.parts:
+            part.cancel()
+        self.parts = deque()
+        self.buf = b""
+        self.buf_pos = 0
+        self.next_offset = pos
+        self.fill()
+
+    def close(self):
+        for part in self.parts:
+            part.cancel()
+        self.executor.shutdown(wait=False)
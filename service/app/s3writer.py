@@ -0,0 +1,198 @@
+# Copyright (c) Amazon Web Services
+# About: Adaptive retry layer for S3 writes. Every PUT goes through a per-prefix
+#        token bucket that halves its rate when S3 answers SlowDown/503 and
+#        grows it again on success. Failed writes are retried with exponential
+#        backoff and full jitter if they were throttled, hit a server or
+#        connection error, and anything still failing, or failing for any other
+#        reason, is kept on a dead letter list that is retried once the
+#        extraction has finished.
+
+import logging
+import random
+import re
+import threading
+import time
+
+import boto3
+from boto3.exceptions import S3UploadFailedError
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError, HTTPClientError
+from botocore.exceptions import ConnectionError as BotoConnectionError
+
+# Error codes S3 uses to ask us to slow down
+THROTTLE_CODES = {
+    "SlowDown",
+    "503",
+    "ServiceUnavailable",
+    "RequestLimitExceeded",
+    "Throttling",
+    "ThrottlingException",
+    "TooManyRequestsException",
+}
+
+# Error codes of requests that may succeed if sent again, besides throttling and 5xx responses
+TRANSIENT_CODES = {
+    "InternalError",
+    "RequestTimeout",
+    "RequestTimeoutException",
+    "PriorRequestNotComplete",
+}
+
+# S3 supports at least 3,500 PUT/COPY/POST/DELETE requests per second per prefix
+MAX_PREFIX_RATE = 3500
+
+
+def s3_client():
+    """
+    Returns an S3 client with botocore's own retries switched off so that every throttling response reaches
+    S3Writer and can be used to adjust the per-prefix rate
+    """
+    return boto3.client("s3", config=Config(retries={"mode": "standard", "max_attempts": 1}))
+
+
+def error_code(e):
+    """ Extracts the S3 error code from a ClientError or from the message of a wrapped upload error"""
+    if isinstance(e, ClientError):
+        return e.response.get("Error", {}).get("Code", "")
+    # S3UploadFailedError only carries the original error in its message e.g.
+    # "An error occurred (SlowDown) when calling the PutObject operation"
+    match = re.search(r"An error occurred \((\w+)\)", str(e))
+    if match:
+        return match.group(1)
+    return type(e).__name__
+
+
+def retryable(e):
+    """ True if a failed write may succeed if sent again: throttling, a 5xx response or a connection error"""
+    if isinstance(e, (BotoConnectionError, HTTPClientError)):
+        return True
+    code = error_code(e)
+    if code in THROTTLE_CODES or code in TRANSIENT_CODES or (code.isdigit() and int(code) >= 500):
+        return True
+    if isinstance(e, ClientError):
+        return e.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0) >= 500
+    return False
+
+
+class TokenBucket:
+    """
+    Rate limiter for a single S3 prefix. The rate is decreased multiplicatively when S3 throttles us and increased
+    additively on every success, so it settles just under the rate S3 is willing to serve.
+    """
+
+    def __init__(self, rate=MAX_PREFIX_RATE, min_rate=1.0, max_rate=MAX_PREFIX_RATE, increase=1.0):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.tokens = rate
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """ Blocks until a request may be sent"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def throttled(self):
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = min(self.tokens, self.rate)
+
+    def succeeded(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+
+class S3Writer:
+    """
+    Wraps the S3 write calls used by the service with adaptive rate limiting and retries. Only writes that were
+    throttled or hit a server or connection error are retried. Writes that still fail after max_attempts, or fail
+    with any other error (access denied, a missing bucket...), are added to dead_letters rather than being dropped,
+    call retry_dead_letters() at the end of the extraction to give them another go.
+    """
+
+    def __init__(self, s3, bucket, max_attempts=8, base_delay=0.2, max_delay=30):
+        self.s3 = s3
+        self.bucket = bucket
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.buckets = {}
+        self.dead_letters = []
+
+    def token_bucket(self, key):
+        prefix = key.rsplit("/", 1)[0] if "/" in key else ""
+        if prefix not in self.buckets:
+            self.buckets[prefix] = TokenBucket()
+        return self.buckets[prefix]
+
+    def upload_file(self, filename, key, extra_args=None, on_success=None):
+        """ Uploads a local file, returns True if it made it to S3. on_success is called once it has, which may only
+        be when the dead letters are retried"""
+        return self.write(
+            key, lambda: self.s3.upload_file(filename, self.bucket, key, ExtraArgs=extra_args), on_success=on_success
+        )
+
+    def put_object(self, key, body, dead_letter=True, **kwargs):
+        """ Writes bytes to S3, returns True if it made it to S3"""
+        return self.write(
+            key, lambda: self.s3.put_object(Bucket=self.bucket, Key=key, Body=body, **kwargs), dead_letter
+        )
+
+    def write(self, key, request, dead_letter=True, on_success=None):
+        bucket = self.token_bucket(key)
+        for attempt in range(self.max_attempts):
+            bucket.acquire()
+            try:
+                request()
+                bucket.succeeded()
+                if on_success:
+                    on_success()
+                return True
+            except (ClientError, S3UploadFailedError, BotoCoreError) as e:
+                code = error_code(e)
+                if not retryable(e):
+                    logging.warning(f"writing s3://{self.bucket}/{key} failed with {code}, not retrying")
+                    break
+                if code in THROTTLE_CODES:
+                    bucket.throttled()
+                # exponential backoff with full jitter
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                logging.warning(
+                    f"writing s3://{self.bucket}/{key} failed with {code} "
+                    f"(attempt {attempt + 1}/{self.max_attempts}), retrying in {delay:.2f}s"
+                )
+                time.sleep(delay)
+            except Exception as e:
+                logging.warning(f"writing s3://{self.bucket}/{key} failed: {e}")
+                break
+
+        if dead_letter:
+            logging.error(f"adding s3://{self.bucket}/{key} to the dead letter list")
+            self.dead_letters.append((key, request, on_success))
+        return False
+
+    def retry_dead_letters(self, rounds=3):
+        """
+        Retries every write on the dead letter list, up to rounds times, calling the on_success of those that make
+        it. Returns the keys that still could not be written.
+        """
+        for r in range(rounds):
+            if not self.dead_letters:
+                break
+            pending, self.dead_letters = self.dead_letters, []
+            logging.info(f"retrying {len(pending)} failed writes, round {r + 1}/{rounds}")
+            for key, request, on_success in pending:
+                if not self.write(key, request, dead_letter=False, on_success=on_success):
+                    self.dead_letters.append((key, request, on_success))
+
+        return [key for key, _, _ in self.dead_letters]
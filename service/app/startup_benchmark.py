@@ -0,0 +1,58 @@
+# Copyright (c) Amazon Web Services
+# About: Measures what starting the extraction container costs before the
+#        first byte of a bag is read: the time taken to import the extractor
+#        and create the S3 client, the peak RSS at that point and the slowest
+#        imports. Run it in the image with
+#        docker run --entrypoint python3 <image> startup_benchmark.py
+
+import json
+import re
+import subprocess
+import sys
+
+# each stage runs in a fresh interpreter so nothing is already imported
+STAGES = {
+    "interpreter": "",
+    "import bagstream": "import bagstream",
+    "import main": "import main",
+    "import main and create clients": "import main, boto3; boto3.client('s3'); main.s3_client()",
+    # what the first message pays on top, the extraction itself imports these lazily
+    "import rosbag and PIL": "import rosbag.bag, PIL.Image",
+}
+
+MEASURE = """
+import resource, time, json
+start = time.perf_counter()
+{code}
+seconds = time.perf_counter() - start
+print(json.dumps({{"seconds": seconds, "max_rss_mib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}}))
+"""
+
+
+def run_stage(code):
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", MEASURE.format(code=code)],
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        return {"error": result.stderr.strip().splitlines()[-1]}, []
+
+    # lines look like "import time:   self [us] | cumulative | imported package"
+    imports = []
+    for line in result.stderr.splitlines():
+        match = re.match(r"import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)", line)
+        if match and not match.group(3):
+            imports.append((int(match.group(2)) / 1e6, match.group(4)))
+    return json.loads(result.stdout), sorted(imports, reverse=True)[:5]
+
+
+if __name__ == "__main__":
+    for stage, code in STAGES.items():
+        stats, slowest = run_stage(code)
+        if "error" in stats:
+            print(f"{stage:32s} failed: {stats['error']}")
+            continue
+        print(f"{stage:32s} {stats['seconds']:7.3f}s  {stats['max_rss_mib']:7.1f} MiB RSS")
+        for seconds, module in slowest:
+            print(f"{'':34s}{seconds:7.3f}s  {module}")
@@ -0,0 +1,73 @@
+# Copyright (c) Amazon Web Services
+# About: Shows how far the labelling of a drive has got, from the counters
+#        the extractor and the labelling Lambdas keep per drive and camera in
+#        the RekProgress DynamoDB table. One query per drive, however many
+#        frames it has.
+#
+#        python3 drive_progress.py <progress table> <drive>
+#
+#        The drive is the bag's output prefix in the destination bucket.
+
+import argparse
+from datetime import datetime
+
+import boto3
+
+COUNTERS = ["queued", "labelled", "cached", "linked", "failed"]
+
+
+def drive_progress(dynamo, table, drive):
+    """ The progress items of a drive's cameras, with the counters and timestamps as Python values"""
+    cameras = []
+    kwargs = dict(
+        TableName=table,
+        KeyConditionExpression="#drive = :drive",
+        ExpressionAttributeNames={"#drive": "drive"},
+        ExpressionAttributeValues={":drive": {"S": drive}},
+    )
+    while True:
+        response = dynamo.query(**kwargs)
+        for item in response["Items"]:
+            camera = {name: int(item[name]["N"]) if name in item else 0 for name in COUNTERS}
+            camera["camera"] = item["camera"]["S"]
+            for name in ["first_queued", "last_queued", "first_labelled", "last_labelled"]:
+                camera[name] = datetime.fromisoformat(item[name]["S"]) if name in item else None
+            cameras.append(camera)
+        if "LastEvaluatedKey" not in response:
+            return cameras
+        kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+def throughput(camera):
+    """ Frames labelled per second between the first and last labelled, None until there are two points in time"""
+    if not camera["first_labelled"] or camera["last_labelled"] == camera["first_labelled"]:
+        return None
+    done = camera["labelled"] + camera["cached"] + camera["linked"]
+    return done / (camera["last_labelled"] - camera["first_labelled"]).total_seconds()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Shows the labelling progress of a drive")
+    parser.add_argument("table")
+    parser.add_argument("drive")
+    args = parser.parse_args()
+
+    cameras = drive_progress(boto3.client("dynamodb"), args.table, args.drive)
+    if not cameras:
+        print(f"nothing recorded for {args.drive}")
+        return
+
+    print(f"{'camera':<30} " + " ".join(f"{name:>9}" for name in COUNTERS + ["remaining"]) + f" {'frames/s':>9}")
+    for camera in sorted(cameras, key=lambda c: c["camera"]):
+        done = camera["labelled"] + camera["cached"] + camera["linked"]
+        rate = throughput(camera)
+        print(
+            f"{camera['camera']:<30} "
+            + " ".join(f"{camera[name]:>9}" for name in COUNTERS)
+            + f" {max(camera['queued'] - done, 0):>9} "
+            + (f"{rate:>9.1f}" if rate is not None else f"{'-':>9}")
+        )
+
+
+if __name__ == "__main__":
+    main()
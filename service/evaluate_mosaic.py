@@ -0,0 +1,129 @@
+# Copyright (c) Amazon Web Services
+# About: Compares labelling frames tiled into mosaics with labelling them one
+#        by one. A sample of extracted frames is labelled with a DetectLabels
+#        call per frame, then with one call per mosaic for each grid size, and
+#        the labels each frame ends up with are compared.
+#
+#        python3 evaluate_mosaic.py <bucket> <prefix> [--frames 36] [--grids 2x2 3x3]
+#
+#        Needs Pillow and boto3, and credentials allowed to read the bucket
+#        and call rekognition:DetectLabels. Costs frames + mosaics calls.
+
+import argparse
+import importlib.util
+import io
+import json
+import os
+import sys
+import tempfile
+
+import boto3
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "app"))
+from mosaic import MosaicBuilder
+
+# the labelling Lambda maps the boxes found in a mosaic back to its frames, the same code is used here
+spec = importlib.util.spec_from_file_location(
+    "process_queue_sync",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "infrastructure", "process-queue-sync",
+                 "process-queue-sync.py"),
+)
+process_queue_sync = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(process_queue_sync)
+
+# DetectLabels takes at most 5MB of image bytes, larger mosaics are sent as JPEG
+MAX_IMAGE_BYTES = 5 * 1024 * 1024
+
+
+def list_frames(s3, bucket, prefix, count):
+    """ The first count camera frames under prefix, in key order, leaving out mosaics"""
+    frames = []
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            key = obj["Key"]
+            if key.endswith(".png") and "image_raw" in key and "/mosaics/" not in key:
+                frames.append(key)
+                if len(frames) == count:
+                    return frames
+    return frames
+
+
+def detect_labels(rek, img):
+    """ DetectLabels on an in-memory image"""
+    data = io.BytesIO()
+    img.save(data, format="PNG")
+    if data.tell() > MAX_IMAGE_BYTES:
+        data = io.BytesIO()
+        img.convert("RGB").save(data, format="JPEG", quality=95)
+    return rek.detect_labels(Image={"Bytes": data.getvalue()})["Labels"]
+
+
+def boxed_labels(labels):
+    """ The names of the labels with boxes and their number of boxes, the labels the results table counts"""
+    return {l["Name"]: len(l["Instances"]) for l in labels if l.get("Instances")}
+
+
+def compare(baseline, labelled):
+    """ Precision and recall of label names, and the fraction of boxes found, over all frames"""
+    matched = sum(len(baseline[f].keys() & labelled[f].keys()) for f in baseline)
+    found = sum(len(labelled[f]) for f in baseline)
+    expected = sum(len(baseline[f]) for f in baseline)
+    boxes = sum(min(n, labelled[f].get(name, 0)) for f in baseline for name, n in baseline[f].items())
+    expected_boxes = sum(sum(baseline[f].values()) for f in baseline)
+    return (
+        matched / found if found else 1.0,
+        matched / expected if expected else 1.0,
+        boxes / expected_boxes if expected_boxes else 1.0,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compares labelling frames tiled into mosaics with one by one")
+    parser.add_argument("bucket")
+    parser.add_argument("prefix")
+    parser.add_argument("--frames", type=int, default=36)
+    parser.add_argument("--grids", nargs="+", default=["2x2", "3x3"])
+    args = parser.parse_args()
+
+    s3 = boto3.client("s3")
+    rek = boto3.client("rekognition")
+
+    keys = list_frames(s3, args.bucket, args.prefix, args.frames)
+    if not keys:
+        sys.exit(f"no frames found under s3://{args.bucket}/{args.prefix}")
+    workdir = tempfile.mkdtemp()
+    frames = {}
+    for key in keys:
+        body = s3.get_object(Bucket=args.bucket, Key=key)["Body"].read()
+        frames[os.path.join(workdir, key)] = Image.open(io.BytesIO(body))
+
+    baseline = {f: boxed_labels(detect_labels(rek, img)) for f, img in frames.items()}
+    print(f"{'grid':>6} {'calls':>6} {'cost':>6} {'precision':>10} {'recall':>7} {'boxes':>6}")
+    print(f"{'1x1':>6} {len(frames):>6} {1:>6.2f} {1:>10.3f} {1:>7.3f} {1:>6.3f}")
+
+    for grid in args.grids:
+        cols, rows = (int(n) for n in grid.split("x"))
+        builder = MosaicBuilder(workdir, cols, rows)
+        labelled = {}
+        calls = 0
+        mosaics = []
+        for f, img in frames.items():
+            builder.add(f, img)
+            if builder.full():
+                mosaics.append(builder.save())
+        mosaics.append(builder.save())
+        for mosaic in filter(None, mosaics):
+            mosaic_file, layout = mosaic
+            layout = json.loads(layout)
+            labels = detect_labels(rek, Image.open(mosaic_file))
+            calls = calls + 1
+            for tile, tile_labels in zip(layout["tiles"], process_queue_sync.split_mosaic_labels(labels, layout)):
+                labelled[tile[0]] = boxed_labels(tile_labels)
+        precision, recall, boxes = compare(baseline, labelled)
+        print(f"{grid:>6} {calls:>6} {calls / len(frames):>6.2f} {precision:>10.3f} {recall:>7.3f} {boxes:>6.3f}")
+
+
+if __name__ == "__main__":
+    main()
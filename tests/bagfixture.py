@@ -0,0 +1,144 @@
+# Builds small ROS bags (V2.0) for the tests, laid out the way rosbag's own writer lays them out: the version line,
+# a bag header record whose header and data are padded to 4096 bytes, uncompressed chunks each followed by its index
+# data records, then the connection and chunk info records of the index.
+# http://wiki.ros.org/Bags/Format/2.0
+
+import struct
+
+STRING_MD5 = "992ce8a1687cec8c8bd883ec73ca41d1"
+
+
+def field(name, value):
+    data = name.encode() + b"=" + value
+    return struct.pack("<I", len(data)) + data
+
+
+def record(fields, data=b""):
+    header = b"".join(field(k, v) for k, v in fields.items())
+    return struct.pack("<I", len(header)) + header + struct.pack("<I", len(data)) + data
+
+
+def ros_time(seconds):
+    return struct.pack("<II", int(seconds), int(round((seconds % 1) * 1e9)))
+
+
+def connection_record(conn, topic):
+    data = b"".join(
+        field(k, v.encode())
+        for k, v in dict(
+            topic=topic, type="std_msgs/String", md5sum=STRING_MD5, message_definition="string data"
+        ).items()
+    )
+    return record({"op": b"\x07", "conn": struct.pack("<I", conn), "topic": topic.encode()}, data)
+
+
+def bag_header(index_pos, conn_count, chunk_count, record_padding=False, extra_padding=0):
+    """ rosbag pads the header and data to 4096 bytes, record_padding pads the whole record instead as some
+    writers do, extra_padding pads it further still"""
+    fields = {
+        "op": b"\x03",
+        "index_pos": struct.pack("<Q", index_pos),
+        "conn_count": struct.pack("<I", conn_count),
+        "chunk_count": struct.pack("<I", chunk_count),
+    }
+    header_len = len(record(fields)) - 8
+    padding = 4096 - header_len - (8 if record_padding else 0) + extra_padding
+    return record(fields, b" " * padding)
+
+
+def make_bag(chunks, topics=("/gps", "/status"), record_padding=False, extra_padding=0, indexed=True):
+    """
+    Returns the bytes of a bag of std_msgs/String messages. chunks is a list of chunks, each a list of
+    (topic, seconds, text) messages. Each connection record is written in the first chunk it has a message in.
+    """
+    conns = {topic: i for i, topic in enumerate(topics)}
+    header_size = len(bag_header(0, 0, 0, record_padding, extra_padding))
+    out = bytearray(b"#ROSBAG V2.0\n" + b"\0" * header_size)
+    seen = set()
+    chunk_infos = []
+    for messages in chunks:
+        body = bytearray()
+        counts = {}
+        for topic, seconds, text in messages:
+            conn = conns[topic]
+            if conn not in seen:
+                body += connection_record(conn, topic)
+                seen.add(conn)
+            data = text.encode()
+            body += record(
+                {"op": b"\x02", "conn": struct.pack("<I", conn), "time": ros_time(seconds)},
+                struct.pack("<I", len(data)) + data,
+            )
+            counts[conn] = counts.get(conn, 0) + 1
+        pos = len(out)
+        out += record({"op": b"\x05", "compression": b"none", "size": struct.pack("<I", len(body))}, bytes(body))
+        for conn, count in counts.items():
+            out += record(
+                {"op": b"\x04", "ver": struct.pack("<I", 1), "conn": struct.pack("<I", conn),
+                 "count": struct.pack("<I", count)},
+                b"\0" * 12 * count,
+            )
+        times = [seconds for _, seconds, _ in messages]
+        chunk_infos.append((pos, counts, min(times), max(times)))
+
+    index_pos = len(out)
+    for topic, conn in conns.items():
+        out += connection_record(conn, topic)
+    for pos, counts, start, end in chunk_infos:
+        out += record(
+            {"op": b"\x06", "ver": struct.pack("<I", 1), "chunk_pos": struct.pack("<Q", pos),
+             "start_time": ros_time(start), "end_time": ros_time(end), "count": struct.pack("<I", len(counts))},
+            b"".join(struct.pack("<II", conn, count) for conn, count in counts.items()),
+        )
+    header = bag_header(index_pos if indexed else 0, len(conns), len(chunks), record_padding, extra_padding)
+    out[13 : 13 + len(header)] = header
+    return bytes(out)
+
+
+def string_messages(chunk_count, per_chunk=4, topics=("/gps", "/status")):
+    """ chunk_count chunks of per_chunk messages, alternating between the topics, one second apart"""
+    return [
+        [(topics[m % len(topics)], 1600000000 + c * per_chunk + m, f"msg {c}-{m}") for m in range(per_chunk)]
+        for c in range(chunk_count)
+    ]
+
+
+class FakeS3:
+    """ get_object with byte ranges, head_object and put_object over in-memory objects, checksums holds the
+    checksum fields head_object returns for some of them"""
+
+    def __init__(self, objects=None, checksums=None):
+        self.objects = dict(objects or {})
+        self.checksums = dict(checksums or {})
+        self.gets = []
+
+    def head_object(self, Bucket, Key, **kwargs):
+        head = {"ContentLength": len(self.objects[Key]), "ETag": f'"{len(self.objects[Key])}"', "Metadata": {}}
+        if kwargs.get("ChecksumMode") == "ENABLED":
+            head.update(self.checksums.get(Key, {}))
+        return head
+
+    def get_object(self, Bucket, Key, Range=None, **kwargs):
+        import io
+
+        data = self.objects[Key]
+        if Range:
+            start, end = Range[len("bytes="):].split("-")
+            data = data[int(start) : int(end) + 1 if end else None]
+        self.gets.append((Key, Range))
+        return {"Body": io.BytesIO(data)}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.objects[Key] = Body
+        return {}
+
+
+class StringMessage:
+    """ Decodes std_msgs/String in place of the class rosbag generates from the connection's message definition"""
+
+    __slots__ = ["data"]
+
+    def deserialize(self, data):
+        (length,) = struct.unpack_from("<I", data)
+        self.data = data[4 : 4 + length].decode()
+        return self
@@ -0,0 +1,34 @@
+import importlib.util
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# the extractor's modules import each other by name, as do the Lambdas and their layers
+sys.path.insert(0, os.path.join(ROOT, "service", "app"))
+sys.path.insert(0, os.path.join(ROOT, "infrastructure", "bagindex-layer", "python"))
+sys.path.insert(0, os.path.join(ROOT, "infrastructure", "labels-layer", "python"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# the Lambdas create their clients when imported
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+
+def load_lambda(name):
+    """ Imports infrastructure/<name>/<name>.py, the Lambdas' module names aren't valid Python identifiers"""
+    path = os.path.join(ROOT, "infrastructure", name, f"{name}.py")
+    spec = importlib.util.spec_from_file_location(name.replace("-", "_"), path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture
+def string_messages_only(monkeypatch):
+    """ Decodes the fixture bags' messages without rosbag, which only installs with ROS"""
+    from bagfixture import StringMessage
+    from bagstream import bagFileStream
+
+    monkeypatch.setattr(bagFileStream, "message_type", lambda self, conn: StringMessage)
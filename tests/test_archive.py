@@ -0,0 +1,73 @@
+import io
+import tarfile
+
+import pytest
+
+import main
+from bagfixture import FakeS3, make_bag, string_messages
+
+pytestmark = pytest.mark.usefixtures("string_messages_only")
+
+
+class Uploader:
+    """ Stands in for main.Uploader, keeping {key: contents} of the files it is given instead of uploading them"""
+
+    def __init__(self, working_dir, uploaded):
+        self.working_dir = f"{working_dir}/"
+        self.uploaded = uploaded
+        self.exitcode = 0
+
+    def start(self):
+        pass
+
+    def upload_callback(self, file, source_offset=None, metadata=None):
+        if file != "Finished":
+            with open(file, "rb") as f:
+                self.uploaded[file[len(self.working_dir):]] = f.read()
+
+    def join(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def archive(members):
+    """ The bytes of a tar.gz of {name: bytes}"""
+    out = io.BytesIO()
+    with tarfile.open(fileobj=out, mode="w:gz") as tar:
+        for name, data in members.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return out.getvalue()
+
+
+def test_each_bag_in_an_archive_is_extracted_under_the_archive_name(tmp_path, monkeypatch):
+    uploaded = {}
+    uploaders = []
+
+    def uploader(bucket, framerate, s3_prefix, etag=None):
+        uploaders.append(s3_prefix)
+        return Uploader(tmp_path / str(len(uploaders)), uploaded)
+
+    monkeypatch.setattr(main, "Uploader", uploader)
+    first = make_bag(string_messages(2))
+    second = make_bag(string_messages(3, topics=("/speed", "/status")), topics=("/speed", "/status"))
+    s3 = FakeS3({"drives/day1.tar.gz": archive({"a.bag": first, "notes.txt": b"not a bag", "b/c.bag": second})})
+
+    assert main.extract_archive(s3, "src", "drives/day1.tar.gz", "dest", 20, readahead_connections=2) == 0
+
+    # the archive is streamed once, nothing is read twice
+    ranges = sorted(tuple(int(n) for n in r[len("bytes="):].split("-")) for _, r in s3.gets)
+    assert [start for start, _ in ranges] == [0] + [end + 1 for _, end in ranges[:-1]]
+    assert ranges[-1][1] == len(s3.objects["drives/day1.tar.gz"]) - 1
+    assert uploaders == [main.get_datafolder("drives/day1/a.bag"), main.get_datafolder("drives/day1/b/c.bag")]
+    assert sorted(uploaded) == sorted(
+        f"{datafolder}/{name}"
+        for datafolder, names in zip(uploaders, [["gps.csv", "status.csv"], ["speed.csv", "status.csv"]])
+        for name in names + ["bag-index.json.gz"]
+    )
+    # the column names and a row per message
+    assert uploaded[f"{uploaders[0]}/gps.csv"].count(b"\n") == 5
+    assert uploaded[f"{uploaders[1]}/speed.csv"].count(b"\n") == 7
@@ -0,0 +1,308 @@
+import json
+
+import pytest
+from botocore.exceptions import ClientError
+
+from bagfixture import FakeS3, make_bag, string_messages
+from conftest import load_lambda
+
+bag_queue_proc = load_lambda("bag-queue-proc")
+
+
+@pytest.fixture(autouse=True)
+def preflight_config(monkeypatch):
+    monkeypatch.setenv("preflight_required_topics", "/gps")
+    monkeypatch.setenv("preflight_min_duration_seconds", "5")
+    monkeypatch.setenv("preflight_max_size_gb", "0")
+    monkeypatch.setenv("preflight_reject_unindexed", "false")
+
+
+@pytest.mark.parametrize("record_padding", [False, True])
+def test_preflight_admits_bag(record_padding):
+    bag = make_bag(string_messages(3), record_padding=record_padding)
+
+    reason, metadata = bag_queue_proc.preflight(FakeS3({"a.bag": bag}), "bucket", "a.bag")
+
+    assert reason is None
+    assert metadata["size"] == len(bag)
+    assert metadata["indexed"]
+    assert metadata["chunk_count"] == 3
+    assert metadata["duration"] == 11
+    assert metadata["topics"] == {"/gps": 6, "/status": 6}
+
+
+def test_preflight_rejects_bag_failing_checks():
+    topics = ("/status", "/camera")
+    bag = make_bag(string_messages(3, topics=topics), topics=topics)
+    reason, metadata = bag_queue_proc.preflight(FakeS3({"a.bag": bag}), "bucket", "a.bag")
+    assert reason.startswith("none of the topics")
+    assert metadata["topics"] == {"/status": 6, "/camera": 6}
+
+
+def test_preflight_rejects_what_is_not_a_bag():
+    reason, metadata = bag_queue_proc.preflight(FakeS3({"a.bag": b"not a bag" * 1000}), "bucket", "a.bag")
+    assert "not a V2.0 ROS bag" in reason
+    assert metadata == {}
+
+
+@pytest.mark.parametrize(
+    "damage",
+    [
+        # a bag header with no op field
+        lambda bag: bag[:17] + b"\xff\xff\xff\x7f" + bag[21:],
+        # truncated in the middle of the bag header
+        lambda bag: bag[:100],
+    ],
+)
+def test_preflight_extracts_bag_it_cannot_read(damage):
+    bag = damage(make_bag(string_messages(3)))
+    assert bag_queue_proc.preflight(FakeS3({"a.bag": bag}), "bucket", "a.bag") == (None, {})
+
+
+def test_fingerprint_of_copies_match():
+    bag = make_bag(string_messages(3))
+    checksum = {"ChecksumCRC64NVME": "qvjsZEt1qtg=", "ChecksumType": "FULL_OBJECT"}
+    s3 = FakeS3({"a.bag": bag, "copy/a.bag": bag}, {"a.bag": checksum, "copy/a.bag": checksum})
+    assert bag_queue_proc.fingerprint(s3, "bucket", "a.bag") == f"crc64nvme:{len(bag)}:qvjsZEt1qtg="
+    assert bag_queue_proc.fingerprint(s3, "bucket", "a.bag") == bag_queue_proc.fingerprint(s3, "bucket", "copy/a.bag")
+
+
+def test_fingerprint_of_bags_with_different_content_differ():
+    bag = make_bag(string_messages(3))
+    s3 = FakeS3(
+        {"a.bag": bag, "b.bag": bag},
+        {"a.bag": {"ChecksumCRC64NVME": "qvjsZEt1qtg="}, "b.bag": {"ChecksumCRC64NVME": "7kXYzFXPbCA="}},
+    )
+    assert bag_queue_proc.fingerprint(s3, "bucket", "a.bag") != bag_queue_proc.fingerprint(s3, "bucket", "b.bag")
+
+
+@pytest.mark.parametrize(
+    "checksums",
+    [
+        {},
+        # a multipart upload's checksum is made of its parts'
+        {"ChecksumSHA256": "n4bQgYhMfWWaL+qgxVrQFaO/TxsrC4Is0V1sFbDwCgg=-3", "ChecksumType": "COMPOSITE"},
+    ],
+)
+def test_fingerprint_without_full_object_checksum_is_the_etag(checksums):
+    bag = make_bag(string_messages(3))
+    s3 = FakeS3({"a.bag": bag}, {"a.bag": checksums})
+    assert bag_queue_proc.fingerprint(s3, "bucket", "a.bag") == f"etag:{len(bag)}:{len(bag)}"
+
+
+class FakeSlots:
+    """ The slots item, updated with the few expressions bag-queue-proc uses"""
+
+    def __init__(self):
+        self.item = {"id": "extractions"}
+
+    def get_item(self, Key, ConsistentRead):
+        return {"Item": dict(self.item)}
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeNames, ExpressionAttributeValues,
+                    ConditionExpression=""):
+        name = ExpressionAttributeNames["#execution"]
+        values = ExpressionAttributeValues
+        running = self.item.get("running")
+        ok = True
+        if "attribute_not_exists(#execution)" in ConditionExpression:
+            ok = ok and name not in self.item
+        if "attribute_exists(#execution)" in ConditionExpression:
+            ok = ok and name in self.item
+        if ":limit" in values:
+            ok = ok and (running is None or running <= values[":limit"])
+        if not ok:
+            raise ClientError({"Error": {"Code": "ConditionalCheckFailedException"}}, "UpdateItem")
+        if UpdateExpression.startswith("SET"):
+            self.item[name] = values[":holder"]
+            self.item["running"] = (running or 0) + values[":count"]
+        else:
+            self.item.pop(name, None)
+            self.item["running"] = running + values[":minus"]
+
+
+class FakeStepFunctions:
+    class exceptions:
+        class ExecutionDoesNotExist(Exception):
+            pass
+
+    def __init__(self, statuses, on_describe=None):
+        self.statuses = statuses
+        self.on_describe = on_describe
+
+    def describe_execution(self, executionArn):
+        assert executionArn.startswith("arn:aws:states:us-east-1:1:execution:sm:")
+        name = executionArn.split(":")[-1]
+        if self.on_describe:
+            self.on_describe(name)
+        if name not in self.statuses:
+            raise self.exceptions.ExecutionDoesNotExist()
+        return {"status": self.statuses[name]}
+
+
+class FakeECS:
+    def __init__(self, workers=0):
+        self.workers = workers
+        self.started = 0
+
+    def list_tasks(self, cluster, startedBy, desiredStatus):
+        return {"taskArns": [f"worker{i}" for i in range(self.workers)]}
+
+    def run_task(self, **kwargs):
+        self.started += 1
+
+
+class FakeSQS:
+    def __init__(self):
+        self.sent = []
+
+    def send_message(self, QueueUrl, MessageBody):
+        self.sent.append(MessageBody)
+
+
+@pytest.fixture
+def slots(monkeypatch):
+    table = FakeSlots()
+    monkeypatch.setenv("slots_table", "slots")
+    monkeypatch.setenv("max_running_extractions", "2")
+    monkeypatch.setenv("state_machine_arn", "arn:aws:states:us-east-1:1:stateMachine:sm")
+    monkeypatch.setattr(
+        bag_queue_proc.boto3, "resource", lambda name: type("Dynamo", (), {"Table": lambda self, t: table})()
+    )
+    return table
+
+
+def use_clients(monkeypatch, statuses, on_describe=None, ecs=None, sqs=None):
+    clients = {"stepfunctions": FakeStepFunctions(statuses, on_describe), "ecs": ecs, "sqs": sqs}
+    monkeypatch.setattr(bag_queue_proc.boto3, "client", lambda name: clients[name])
+
+
+def test_slots_of_running_executions_are_not_freed(monkeypatch, slots):
+    use_clients(monkeypatch, {"a": "RUNNING", "b": "RUNNING"})
+    assert bag_queue_proc.acquire_slots("a") == 1
+    assert bag_queue_proc.acquire_slots("b") == 1
+
+    assert bag_queue_proc.acquire_slots("c") == 0
+
+    assert set(slots.item) == {"id", "running", "a", "b"}
+    assert slots.item["running"] == 2
+
+
+def test_slots_taken_before_the_execution_starts_are_not_freed(monkeypatch, slots):
+    # "b" has taken its slot but not started its execution yet
+    use_clients(monkeypatch, {"a": "RUNNING"})
+    assert bag_queue_proc.acquire_slots("a") == 1
+    assert bag_queue_proc.acquire_slots("b") == 1
+
+    assert bag_queue_proc.acquire_slots("c") == 0
+    assert slots.item["running"] == 2
+
+
+def test_slots_of_ended_executions_are_freed(monkeypatch, slots):
+    monkeypatch.setenv("max_running_extractions", "4")
+    use_clients(monkeypatch, {"a": "ABORTED", "b": "RUNNING", "c": "RUNNING"})
+    assert bag_queue_proc.acquire_slots("a", 2) == 2
+    assert bag_queue_proc.acquire_slots("b") == 1
+    # "d" took its slot long ago and never started its execution
+    slots.item["d"] = {"taken_at": 0, "slots": 1}
+    slots.item["running"] += 1
+
+    assert bag_queue_proc.acquire_slots("c", 3) == 3
+
+    assert set(slots.item) == {"id", "running", "b", "c"}
+    assert slots.item["running"] == 4
+
+
+def test_slot_given_back_while_reclaiming_is_freed_once(monkeypatch, slots):
+    use_clients(monkeypatch, {})
+    assert bag_queue_proc.acquire_slots("a") == 1
+    assert bag_queue_proc.acquire_slots("b") == 1
+    # "a" ends and gives its slot back between the slots being read and its status being checked
+    use_clients(
+        monkeypatch,
+        {"a": "SUCCEEDED", "b": "RUNNING"},
+        on_describe=lambda name: name == "a" and "a" in slots.item and bag_queue_proc.release_slots("a", 1),
+    )
+
+    assert not bag_queue_proc.reclaim_slots(slots)
+
+    assert slots.item["running"] == 1
+    assert bag_queue_proc.acquire_slots("c") == 1
+    assert slots.item["running"] == 2
+
+
+def test_split_bag_takes_a_slot_per_range_that_is_free(monkeypatch, slots):
+    monkeypatch.setenv("max_running_extractions", "4")
+    use_clients(monkeypatch, {"a": "RUNNING", "b": "RUNNING"})
+
+    assert bag_queue_proc.acquire_slots("a", 3) == 3
+    assert bag_queue_proc.acquire_slots("b", 3) == 1
+
+    assert slots.item["b"]["slots"] == 1
+    assert slots.item["running"] == 4
+
+
+def test_running_workers_use_slots(monkeypatch, slots):
+    monkeypatch.setenv("worker_max_bag_gb", "1")
+    monkeypatch.setenv("cluster_arn", "cluster")
+    use_clients(monkeypatch, {"a": "RUNNING"}, ecs=FakeECS(workers=1))
+
+    assert bag_queue_proc.acquire_slots("a", 2) == 1
+    assert bag_queue_proc.acquire_slots("b") == 0
+
+
+@pytest.fixture
+def worker_env(monkeypatch):
+    for name, value in dict(
+        cluster_arn="cluster", worker_max_tasks="2", worker_queue_url="queue", task_definition_arn="task",
+        worker_subnets="subnet", worker_security_group="sg", container_name="container", cache_table="cache",
+        worker_concurrency="2", worker_idle_seconds="60",
+    ).items():
+        monkeypatch.setenv(name, value)
+
+
+@pytest.mark.parametrize("workers, queued, started", [(0, False, 0), (1, True, 0)])
+def test_bag_for_workers_waits_for_a_slot(monkeypatch, slots, worker_env, workers, queued, started):
+    use_clients(monkeypatch, {"a": "RUNNING"}, ecs=FakeECS(workers), sqs=FakeSQS())
+    assert bag_queue_proc.acquire_slots("a", 2 - workers) == 2 - workers
+    ecs, sqs = bag_queue_proc.boto3.client("ecs"), bag_queue_proc.boto3.client("sqs")
+
+    assert bag_queue_proc.queue_for_worker("bucket", "dest", "a.bag", "extract", "fp") == queued
+
+    assert len(sqs.sent) == queued
+    assert ecs.started == started
+
+
+def test_bag_for_workers_starts_a_worker_with_a_free_slot(monkeypatch, slots, worker_env):
+    use_clients(monkeypatch, {}, ecs=FakeECS(), sqs=FakeSQS())
+    assert bag_queue_proc.queue_for_worker("bucket", "dest", "a.bag", "extract", "fp")
+    assert bag_queue_proc.boto3.client("ecs").started == 1
+
+
+def test_planned_ranges(monkeypatch):
+    monkeypatch.setenv("split_range_gb", "1")
+    monkeypatch.setenv("max_split_ranges", "4")
+    metadata = {"size": int(2.5 * 1024 ** 3), "indexed": True, "chunk_count": 100}
+
+    assert bag_queue_proc.planned_ranges("a.bag", "extract", metadata) == 3
+    assert bag_queue_proc.planned_ranges("a.bag", "extract", dict(metadata, size=10 * 1024 ** 3)) == 4
+    assert bag_queue_proc.planned_ranges("a.bag", "extract", dict(metadata, indexed=False)) == 1
+    assert bag_queue_proc.planned_ranges("a_0.bag", "drive", metadata) == 1
+    assert bag_queue_proc.planned_ranges("a.tar.gz", "extract", None) == 1
+
+
+@pytest.mark.parametrize(
+    "sizes, expected",
+    [
+        ([{"name": "small", "max_bag_gb": 1}, {"name": "large", "max_bag_gb": None}], ("small", "large")),
+        ([{"name": "small", "max_bag_gb": 1}, {"name": "medium", "max_bag_gb": 10}], ("small", None)),
+    ],
+)
+def test_drive_gets_the_task_size_for_bags_of_any_size(monkeypatch, sizes, expected):
+    monkeypatch.setenv("task_sizes", json.dumps(sizes))
+    metadata = {"size": 1024}
+
+    extract = bag_queue_proc.task_size(None, "bucket", "a_0.bag", metadata)
+    drive = bag_queue_proc.task_size(None, "bucket", "a_0.bag", metadata, mode="drive")
+
+    assert (extract, drive) == expected
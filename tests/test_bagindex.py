@@ -0,0 +1,56 @@
+import pytest
+
+from bagfixture import FakeS3, make_bag, string_messages
+from bagindex import BagFormatError, read_bag_header, read_bag_index, time_range, topic_counts
+
+
+@pytest.mark.parametrize("record_padding", [False, True])
+def test_read_bag_index(record_padding):
+    bag = make_bag(string_messages(3), record_padding=record_padding)
+    s3 = FakeS3({"a.bag": bag})
+
+    index = read_bag_index(s3, "bucket", "a.bag")
+
+    assert index["indexed"]
+    assert index["size"] == len(bag)
+    assert [c["topic"] for c in index["connections"].values()] == ["/gps", "/status"]
+    assert len(index["chunks"]) == 3
+    assert [c["pos"] for c in index["chunks"]] == sorted(c["pos"] for c in index["chunks"])
+    assert topic_counts(index) == {"/gps": 6, "/status": 6}
+    assert time_range(index) == (1600000000, 1600000011)
+    # the header and the index, however the header is padded
+    assert len(s3.gets) == 2
+
+
+def test_bag_header_longer_than_first_read():
+    # a writer padding the header record further than rosbag does
+    s3 = FakeS3({"a.bag": make_bag(string_messages(2), extra_padding=1000)})
+    assert read_bag_header(s3, "bucket", "a.bag")["chunk_count"] == 2
+    assert read_bag_index(s3, "bucket", "a.bag")["indexed"]
+
+
+def test_unindexed_bag():
+    index = read_bag_index(FakeS3({"a.bag": make_bag(string_messages(2), indexed=False)}), "bucket", "a.bag")
+    assert not index["indexed"]
+
+
+def test_not_a_bag():
+    with pytest.raises(BagFormatError):
+        read_bag_index(FakeS3({"a.bag": b"#ROSBAG V1.2\n" + b"\0" * 5000}), "bucket", "a.bag")
+
+
+def test_bag_written_by_rosbags(tmp_path):
+    rosbag1 = pytest.importorskip("rosbags.rosbag1")
+    typesys = pytest.importorskip("rosbags.typesys")
+    typestore = typesys.get_typestore(typesys.Stores.ROS1_NOETIC)
+    String = typestore.types["std_msgs/msg/String"]
+    path = tmp_path / "a.bag"
+    with rosbag1.Writer(path) as writer:
+        conn = writer.add_connection("/chatter", String.__msgtype__, typestore=typestore)
+        for i in range(5):
+            writer.write(conn, (1600000000 + i) * 10 ** 9, typestore.serialize_ros1(String(data="hi"), String.__msgtype__))
+
+    index = read_bag_index(FakeS3({"a.bag": path.read_bytes()}), "bucket", "a.bag")
+
+    assert index["indexed"]
+    assert topic_counts(index) == {"/chatter": 5}
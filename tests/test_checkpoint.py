@@ -0,0 +1,157 @@
+import io
+import json
+import os
+
+import pytest
+from botocore.exceptions import ClientError
+
+import main
+from bagfixture import FakeS3, make_bag, string_messages
+from bagstream import bagFileStream
+from s3writer import S3Writer
+
+pytestmark = pytest.mark.usefixtures("string_messages_only")
+
+
+def extract(bag, output_prefix, checkpoints=None, **kwargs):
+    """ Extracts bag from the start, or from kwargs["checkpoint"], returns the files it uploaded"""
+    uploads = []
+    stream = io.BytesIO(bag)
+    if kwargs.get("checkpoint"):
+        stream.seek(kwargs["checkpoint"]["offset"])
+    if checkpoints is not None:
+        # as saved to and loaded from S3
+        kwargs["checkpoint_callback"] = lambda state: checkpoints.append(json.loads(json.dumps(state)))
+    extraction = bagFileStream(stream, lambda f, *args: uploads.append(f), output_prefix=str(output_prefix), **kwargs)
+    extraction.upload_csvs()
+    return uploads
+
+
+class Writer:
+    def __init__(self):
+        self.keys = []
+
+    def upload_file(self, filename, key, extra_args=None, on_success=None):
+        self.keys.append(key)
+        on_success()
+        return True
+
+
+class Manifest:
+    def __init__(self, keys=()):
+        self.entries = {key: {} for key in keys}
+
+    def matches(self, key, size, sha256):
+        return False
+
+    def add(self, key, size, sha256, source_offset=None):
+        self.entries[key] = {}
+
+    def flush(self):
+        pass
+
+
+def stitch(monkeypatch, working_dir, uploads, earlier_parts=None, last_parts=None, recorded=None):
+    """ Stitches the CSV parts the way the uploader does when the extraction finishes, earlier_parts are the
+    {key: body} of the parts uploaded by earlier tasks and recorded the keys in their manifest, all of them by
+    default"""
+    monkeypatch.setattr(main.boto3, "client", lambda *args, **kwargs: FakeS3(earlier_parts))
+    upload = main.Uploader("bucket", 20, "drive", last_parts=last_parts)
+    upload.working_dir = f"{working_dir}/"
+    for file in uploads:
+        upload.add_part(file)
+    writer = Writer()
+    upload.stitch_csvs(writer, Manifest((earlier_parts or {}) if recorded is None else recorded))
+    return writer.keys
+
+
+def read(path):
+    with open(path) as f:
+        return f.read()
+
+
+def test_extraction_without_checkpoints_writes_topic_csvs(tmp_path):
+    uploads = extract(make_bag(string_messages(3)), tmp_path / "drive")
+    assert sorted(os.path.relpath(f, tmp_path) for f in uploads) == ["drive/gps.csv", "drive/status.csv"]
+    # the column names and a row per message
+    assert read(tmp_path / "drive" / "gps.csv").count("\n") == 7
+
+
+def test_checkpointed_extraction_is_stitched(tmp_path, monkeypatch):
+    bag = make_bag(string_messages(5))
+    extract(bag, tmp_path / "full" / "drive")
+
+    checkpoints = []
+    uploads = extract(bag, tmp_path / "run" / "drive", checkpoints, checkpoint_interval=0)
+    # a part per topic per checkpoint
+    assert len(checkpoints) == 5
+
+    assert sorted(stitch(monkeypatch, tmp_path / "run", uploads)) == ["drive/gps.csv", "drive/status.csv"]
+    for topic in ["gps", "status"]:
+        assert read(tmp_path / "run" / "drive" / f"{topic}.csv") == read(tmp_path / "full" / "drive" / f"{topic}.csv")
+
+
+def test_resumed_extraction_is_stitched_with_earlier_parts(tmp_path, monkeypatch):
+    bag = make_bag(string_messages(6))
+    extract(bag, tmp_path / "full" / "drive")
+
+    # the first attempt uploads a part at every chunk but its checkpoints after the second are never saved
+    checkpoints = []
+    first = extract(bag, tmp_path / "first" / "drive", checkpoints, checkpoint_interval=0)
+    earlier_parts = {}
+    for file in first:
+        with open(file, "rb") as f:
+            earlier_parts[os.path.relpath(file, tmp_path / "first")] = f.read()
+
+    # the second resumes from the second checkpoint and saves no more
+    second = extract(bag, tmp_path / "second" / "drive", [], checkpoint=checkpoints[1], checkpoint_interval=3600)
+
+    stitch(monkeypatch, tmp_path / "second", second, earlier_parts)
+    for topic in ["gps", "status"]:
+        full = read(tmp_path / "full" / "drive" / f"{topic}.csv")
+        assert read(tmp_path / "second" / "drive" / f"{topic}.csv") == full
+
+
+class FailingOnce:
+    """ An S3 client refusing the first upload of a key, and accepting everything else"""
+
+    def __init__(self, key):
+        self.key = key
+        self.failed = False
+
+    def upload_file(self, filename, bucket, key, ExtraArgs=None):
+        if key == self.key and not self.failed:
+            self.failed = True
+            raise ClientError({"Error": {"Code": "AccessDenied"}, "ResponseMetadata": {"HTTPStatusCode": 403}}, "Put")
+
+    def put_object(self, Bucket, Key, Body):
+        pass
+
+
+def test_resumed_extraction_is_stitched_with_earlier_parts_uploaded_when_retried(tmp_path, monkeypatch):
+    bag = make_bag(string_messages(6))
+    extract(bag, tmp_path / "full" / "drive")
+
+    checkpoints = []
+    first = extract(bag, tmp_path / "first" / "drive", checkpoints, checkpoint_interval=0)
+    earlier_parts = {}
+    for file in first:
+        with open(file, "rb") as f:
+            earlier_parts[os.path.relpath(file, tmp_path / "first")] = f.read()
+    # the first attempt's first part only makes it to S3 when the dead letters are retried at its checkpoint
+    monkeypatch.setattr(main.boto3, "client", lambda *args, **kwargs: FakeS3())
+    upload = main.Uploader("bucket", 20, "drive")
+    upload.working_dir = f"{tmp_path / 'first'}/"
+    writer = S3Writer(FailingOnce("drive/csv-parts/gps.part000000.csv"), "bucket")
+    manifest = Manifest()
+    for file in first:
+        upload.upload(writer, manifest, file)
+    upload.save_checkpoint(writer, checkpoints[1], manifest)
+    assert "drive/csv-parts/gps.part000000.csv" in manifest.entries
+
+    second = extract(bag, tmp_path / "second" / "drive", [], checkpoint=checkpoints[1], checkpoint_interval=3600)
+
+    stitch(monkeypatch, tmp_path / "second", second, earlier_parts, recorded=manifest.entries)
+    for topic in ["gps", "status"]:
+        full = read(tmp_path / "full" / "drive" / f"{topic}.csv")
+        assert read(tmp_path / "second" / "drive" / f"{topic}.csv") == full
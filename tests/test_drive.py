@@ -0,0 +1,102 @@
+import gzip
+import io
+import json
+
+import pytest
+
+import main
+from bagfixture import FakeS3, make_bag, string_messages
+from bagstream import bagFileStream
+
+pytestmark = pytest.mark.usefixtures("string_messages_only")
+
+
+class DriveS3(FakeS3):
+    """ FakeS3 raising what load_checkpoint expects of a missing checkpoint"""
+
+    class exceptions:
+        NoSuchKey = KeyError
+
+
+class Uploader:
+    """ Stands in for main.Uploader, keeping {key: contents} of the files it is given instead of uploading them"""
+
+    def __init__(self, working_dir):
+        self.working_dir = f"{working_dir}/"
+        self.uploaded = {}
+        self.exitcode = 0
+
+    def start(self):
+        pass
+
+    def upload_callback(self, file, source_offset=None, metadata=None):
+        if file != "Finished":
+            with open(file, "rb") as f:
+                self.uploaded[file[len(self.working_dir):]] = f.read()
+
+    def join(self):
+        pass
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def drive(tmp_path, monkeypatch):
+    """ Runs extract_drive over {key: bag} splits, returns the uploader it used"""
+    uploaders = []
+
+    def uploader(bucket, framerate, s3_prefix, resumed=False):
+        uploaders.append(Uploader(tmp_path / "drive"))
+        return uploaders[-1]
+
+    def wait_for_object(s3, bucket, key, timeout):
+        return s3.head_object(Bucket=bucket, Key=key)["ETag"] if key in s3.objects else None
+
+    monkeypatch.setattr(main, "Uploader", uploader)
+    monkeypatch.setattr(main, "wait_for_object", wait_for_object)
+
+    def extract_drive(splits):
+        s3 = DriveS3(splits)
+        assert main.extract_drive(s3, "src", "day1/car_0.bag", "dest", 20, None, 2, split_wait_seconds=0) == 0
+        return uploaders[-1]
+
+    return extract_drive
+
+
+def csvs(bag, output_prefix):
+    uploads = []
+    extraction = bagFileStream(io.BytesIO(bag), lambda f, *args: uploads.append(f), output_prefix=str(output_prefix))
+    extraction.upload_csvs()
+    result = {}
+    for file in uploads:
+        with open(file, "rb") as f:
+            result[file[len(str(output_prefix)) + 1:]] = f.read()
+    return result
+
+
+def test_splits_are_stitched_into_continuous_outputs(tmp_path, drive):
+    chunks = string_messages(5)
+    whole = csvs(make_bag(chunks), tmp_path / "whole")
+
+    # the recorder starts a new split every two chunks
+    upload = drive({f"day1/car_{n}.bag": make_bag(chunks[2 * n : 2 * n + 2]) for n in range(3)})
+
+    datafolder = main.get_datafolder("day1/car.bag")
+    names = ["bag-index.json.gz", "gps.csv", "status.csv"]
+    assert sorted(upload.uploaded) == [f"{datafolder}/{name}" for name in names]
+    for name, contents in whole.items():
+        assert upload.uploaded[f"{datafolder}/{name}"] == contents
+    # the index describes the drive as a whole, with the chunks of each split
+    index = json.loads(gzip.decompress(upload.uploaded[f"{datafolder}/bag-index.json.gz"]))
+    assert [len(bag["chunks"]) for bag in index["bags"]] == [2, 2, 1]
+    assert index["topics"]["/gps"]["count"] == 10
+
+
+def test_drive_with_missing_split_ends_at_the_gap(tmp_path, drive):
+    chunks = string_messages(3)
+    # the second split never lands
+    upload = drive({"day1/car_0.bag": make_bag(chunks[:1]), "day1/car_2.bag": make_bag(chunks[2:])})
+
+    datafolder = main.get_datafolder("day1/car.bag")
+    assert upload.uploaded[f"{datafolder}/gps.csv"] == csvs(make_bag(chunks[:1]), tmp_path / "first")["gps.csv"]
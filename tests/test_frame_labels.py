@@ -0,0 +1,138 @@
+import json
+
+import pytest
+
+import frame_labels
+from conftest import load_lambda
+
+process_queue_sync = load_lambda("process-queue-sync")
+
+
+def message(message_id, n):
+    key = f"drive/camera/image_raw-2020-12-16T23_32_{n:02d}.000000-{n:04d}.png"
+    body = {"Records": [{"s3": {"bucket": {"name": "bucket"}, "object": {"key": key}}}]}
+    return {"messageId": message_id, "body": json.dumps(body)}
+
+
+def labelled(m):
+    bucket, key = process_queue_sync.message_frame(m)
+    labels = [{"Name": "Road", "Confidence": 99.0, "Instances": [], "Parents": []}]
+    item = process_queue_sync.process_labels(bucket, key, labels)
+    return [item], [(("drive", "camera"), "labelled")], None, [(bucket, key, labels)]
+
+
+class Context:
+    aws_request_id = "request"
+
+
+@pytest.fixture
+def handler(monkeypatch):
+    """ Runs lambda_handler with the writes recorded, returns what it returned and what it counted"""
+    monkeypatch.setenv("results_table", "results")
+    monkeypatch.setenv("label_cache_table", "cache")
+    monkeypatch.setenv("frame_duration", "67")
+    monkeypatch.setenv("anonymize_queue_url", "queue")
+    monkeypatch.delenv("label_output", raising=False)
+    monkeypatch.setattr(process_queue_sync.s3, "head_object", lambda Bucket, Key: {"Metadata": {"drive": "drive"}})
+    monkeypatch.setattr(process_queue_sync, "write_label_parts", lambda parts, request_id: None)
+    monkeypatch.setattr(process_queue_sync, "send_for_anonymization", lambda sqs, queue_url, frames: None)
+    counted = []
+    monkeypatch.setattr(process_queue_sync, "update_progress", counted.append)
+
+    def run(messages):
+        return process_queue_sync.lambda_handler({"Records": messages}, Context()), counted
+
+    return run
+
+
+def test_only_the_frames_that_failed_are_retried(monkeypatch, handler):
+    def label_frame(m):
+        if m["messageId"] == "b":
+            raise RuntimeError("throttled")
+        return labelled(m)
+
+    writes = []
+    monkeypatch.setattr(process_queue_sync, "label_frame", label_frame)
+    monkeypatch.setattr(process_queue_sync, "batch_write", lambda dynamo, requests: writes.append(requests))
+
+    response, counted = handler([message("a", 1), message("b", 2), message("c", 3)])
+
+    assert response == {"batchItemFailures": [{"itemIdentifier": "b"}]}
+    assert len(writes[0]["results"]) == 2
+    assert counted == [{("drive", "camera"): {"labelled": 2, "failed": 1}}]
+
+
+def test_frames_whose_labels_could_not_be_written_are_retried(monkeypatch, handler):
+    def batch_write(dynamo, requests):
+        raise RuntimeError("unprocessed items left")
+
+    monkeypatch.setattr(process_queue_sync, "label_frame", labelled)
+    monkeypatch.setattr(process_queue_sync, "batch_write", batch_write)
+
+    response, counted = handler([message("a", 1), message("b", 2)])
+
+    assert response == {"batchItemFailures": [{"itemIdentifier": "a"}, {"itemIdentifier": "b"}]}
+    assert counted == [{("drive", "camera"): {"failed": 2}}]
+
+
+class FakeDynamo:
+    """ BatchWriteItem leaving the first unprocessed[n] items of its n-th call unprocessed, recording each call"""
+
+    def __init__(self, *unprocessed):
+        self.unprocessed = list(unprocessed)
+        self.calls = []
+
+    def batch_write_item(self, RequestItems):
+        self.calls.append(RequestItems)
+        left = self.unprocessed.pop(0) if self.unprocessed else 0
+        unprocessed = {}
+        for table, requests in RequestItems.items():
+            taken = requests[:left]
+            left = left - len(taken)
+            if taken:
+                unprocessed[table] = taken
+        return {"UnprocessedItems": unprocessed}
+
+
+def put(n):
+    return {"PutRequest": {"Item": {"n": {"N": str(n)}}}}
+
+
+@pytest.fixture
+def no_backoff(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(frame_labels.time, "sleep", sleeps.append)
+    return sleeps
+
+
+def test_items_are_written_25_at_a_time(no_backoff):
+    dynamo = FakeDynamo()
+
+    frame_labels.batch_write(dynamo, {"results": [put(n) for n in range(30)], "cache": [put(n) for n in range(5)]})
+
+    assert dynamo.calls == [
+        {"results": [put(n) for n in range(25)]},
+        {"results": [put(n) for n in range(25, 30)], "cache": [put(n) for n in range(5)]},
+    ]
+    assert no_backoff == []
+
+
+def test_unprocessed_items_are_retried(no_backoff):
+    dynamo = FakeDynamo(3, 1)
+
+    frame_labels.batch_write(dynamo, {"results": [put(n) for n in range(10)]})
+
+    assert [call["results"] for call in dynamo.calls] == [
+        [put(n) for n in range(10)], [put(n) for n in range(3)], [put(0)]
+    ]
+    # backing off further after each call leaving items unprocessed
+    assert len(no_backoff) == 2 and no_backoff[0] < no_backoff[1]
+
+
+def test_items_left_unprocessed_every_attempt_fail_the_write(no_backoff):
+    dynamo = FakeDynamo(*[1] * 3)
+
+    with pytest.raises(RuntimeError):
+        frame_labels.batch_write(dynamo, {"results": [put(0)]}, max_attempts=3)
+
+    assert len(dynamo.calls) == 3
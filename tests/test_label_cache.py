@@ -0,0 +1,98 @@
+import json
+
+import pytest
+
+from conftest import load_lambda
+
+process_queue_sync = load_lambda("process-queue-sync")
+
+KEY = "drive/camera/image_raw-2020-12-16T23_32_19.000000-0001.png"
+MESSAGE = {"body": json.dumps({"Records": [{"s3": {"bucket": {"name": "bucket"}, "object": {"key": KEY}}}]})}
+LABELS = [{"Name": "Road", "Confidence": 99.0, "Instances": [], "Parents": []}]
+
+
+class FakeCache:
+    """ The label cache table"""
+
+    def __init__(self, items=()):
+        self.items = {item["content_hash"]["S"]: item for item in items}
+        self.gets = []
+
+    def get_item(self, TableName, Key):
+        self.gets.append(Key["content_hash"]["S"])
+        item = self.items.get(Key["content_hash"]["S"])
+        return {"Item": item} if item else {}
+
+
+def cache_item(frame_hash, model_version="3.0", labels=LABELS):
+    return {
+        "content_hash": {"S": frame_hash},
+        "model_version": {"S": model_version},
+        "labels": {"S": json.dumps(labels)},
+    }
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    """ Labels a frame whose head_object is head against the cache holding items, returns what label_frame returned
+    and the frames sent to DetectLabels"""
+    monkeypatch.setenv("label_cache_table", "cache")
+    monkeypatch.setenv("label_model_version", "3.0")
+    monkeypatch.setenv("frame_duration", "67")
+    detected = []
+
+    def detect_labels(bucket, key):
+        detected.append(key)
+        return LABELS, "3.0"
+
+    monkeypatch.setattr(process_queue_sync, "detect_labels", detect_labels)
+
+    def label_frame(head, *items):
+        monkeypatch.setattr(process_queue_sync, "dynamo", FakeCache(items))
+        monkeypatch.setattr(process_queue_sync.s3, "head_object", lambda Bucket, Key: dict({"Metadata": {}}, **head))
+        return process_queue_sync.label_frame(MESSAGE), detected
+
+    return label_frame
+
+
+@pytest.mark.parametrize(
+    "head, frame_hash",
+    [
+        ({"ETag": '"e"', "Metadata": {"sha256": "ab"}}, "sha256:ab"),
+        ({"ETag": '"9e107d9d372bb6826bd81d3542a419d6"'}, "md5:9e107d9d372bb6826bd81d3542a419d6"),
+        # the ETag of a multipart upload isn't the hash of the bytes
+        ({"ETag": '"9e107d9d372bb6826bd81d3542a419d6-2"'}, None),
+    ],
+)
+def test_content_hash(head, frame_hash):
+    assert process_queue_sync.content_hash(head) == frame_hash
+
+
+def test_frame_labelled_before_reuses_its_labels(cache):
+    cached = [{"Name": "Car", "Confidence": 90.0, "Instances": [], "Parents": []}]
+
+    (_, progress, new_item, frames), detected = cache({"ETag": '"e"', "Metadata": {"sha256": "ab"}},
+                                                     cache_item("sha256:ab", labels=cached))
+
+    assert detected == []
+    assert new_item is None
+    assert frames == [("bucket", KEY, cached)]
+    assert [status for _, status in progress] == ["cached"]
+
+
+@pytest.mark.parametrize("cached", [[], [cache_item("sha256:ab", model_version="2.0")]])
+def test_frame_not_in_the_cache_for_the_current_model_is_labelled_and_cached(cache, cached):
+    (_, progress, new_item, frames), detected = cache({"ETag": '"e"', "Metadata": {"sha256": "ab"}}, *cached)
+
+    assert detected == [KEY]
+    assert new_item == cache_item("sha256:ab")
+    assert frames == [("bucket", KEY, LABELS)]
+    assert [status for _, status in progress] == ["labelled"]
+
+
+def test_frame_without_a_hash_is_labelled_and_not_cached(cache):
+    (_, _, new_item, _), detected = cache({"ETag": '"e-2"', "Metadata": {}})
+
+    assert detected == [KEY]
+    assert new_item is None
+    assert process_queue_sync.dynamo.gets == []
@@ -0,0 +1,73 @@
+import io
+
+import pytest
+
+from bagfixture import make_bag, string_messages
+from bagstream import BufferReader, bagFileStream
+
+pytestmark = pytest.mark.usefixtures("string_messages_only")
+
+
+def outputs(output_prefix, uploads):
+    """ {name: contents} of the CSVs an extraction wrote under output_prefix"""
+    result = {}
+    for file in uploads:
+        with open(file) as f:
+            result[file[len(str(output_prefix)):]] = f.read()
+    return result
+
+
+def extract_stream(bag, output_prefix, **kwargs):
+    uploads = []
+    extraction = bagFileStream(io.BytesIO(bag), lambda f, *args: uploads.append(f), output_prefix=str(output_prefix),
+                               **kwargs)
+    extraction.upload_csvs()
+    return outputs(output_prefix, uploads)
+
+
+def extract_file(path, output_prefix, **kwargs):
+    uploads = []
+    extraction = bagFileStream.from_file(str(path), lambda f, *args: uploads.append(f),
+                                         output_prefix=str(output_prefix), **kwargs)
+    extraction.upload_csvs()
+    return outputs(output_prefix, uploads)
+
+
+def test_buffer_reader_returns_slices_of_the_buffer():
+    reader = BufferReader(b"0123456789")
+
+    data = reader.read(4)
+    assert isinstance(data, memoryview)
+    assert data == b"0123"
+    assert reader.read(10) == b"456789"
+    assert reader.read() == b""
+
+    reader.seek(2)
+    assert reader.tell() == 2
+    assert reader.read() == b"23456789"
+
+
+@pytest.mark.parametrize("indexed", [True, False])
+def test_memory_mapped_bag_is_extracted_like_a_stream(tmp_path, indexed):
+    bag = make_bag(string_messages(4), indexed=indexed)
+    path = tmp_path / "drive.bag"
+    path.write_bytes(bag)
+
+    assert extract_file(path, tmp_path / "file" / "drive") == extract_stream(bag, tmp_path / "stream" / "drive")
+
+
+def test_memory_mapped_bag_resumes_from_a_checkpoint(tmp_path):
+    bag = make_bag(string_messages(5))
+    path = tmp_path / "drive.bag"
+    path.write_bytes(bag)
+    full = extract_stream(bag, tmp_path / "full" / "drive")
+
+    checkpoints = []
+    extract_file(path, tmp_path / "first" / "drive", checkpoint_interval=0, checkpoint_callback=checkpoints.append)
+    resumed = extract_file(path, tmp_path / "second" / "drive", checkpoint=checkpoints[2], checkpoint_interval=3600)
+
+    # the parts written after the checkpoint hold the column names and the rows of the last two chunks
+    assert sorted(resumed) == ["/csv-parts/gps.part000003.csv", "/csv-parts/status.part000003.csv"]
+    for topic in ["gps", "status"]:
+        rows = full[f"/{topic}.csv"].splitlines()
+        assert resumed[f"/csv-parts/{topic}.part000003.csv"].splitlines() == rows[:1] + rows[-4:]
@@ -0,0 +1,137 @@
+import json
+
+import pytest
+
+import main
+from bagfixture import FakeS3
+from conftest import load_lambda
+
+process_queue_sync = load_lambda("process-queue-sync")
+
+# a 2x2 mosaic of 100x50 frames, the last cell empty
+LAYOUT = {"cols": 2, "rows": 2, "cell": [100, 50], "tiles": [["a.png", 100, 50], ["b.png", 100, 50], ["c.png", 100, 50]]}
+
+
+def instance(left, top, width, height, confidence=90.0):
+    """ A box given in pixels of the 200x100 mosaic"""
+    return {
+        "BoundingBox": {"Left": left / 200, "Top": top / 100, "Width": width / 200, "Height": height / 100},
+        "Confidence": confidence,
+    }
+
+
+def label(name, *instances, confidence=95.0):
+    return {"Name": name, "Confidence": confidence, "Instances": list(instances), "Parents": []}
+
+
+def test_boxes_are_mapped_to_their_frames():
+    labels = [label("Car", instance(10, 10, 20, 20, 80.0), instance(120, 5, 10, 10), instance(10, 60, 40, 20, 70.0))]
+
+    a, b, c = process_queue_sync.split_mosaic_labels(labels, LAYOUT)
+
+    assert [l["Confidence"] for l in a + b + c] == [80.0, 90.0, 70.0]
+    assert a[0]["Instances"][0]["BoundingBox"] == pytest.approx({"Left": 0.1, "Top": 0.2, "Width": 0.2, "Height": 0.4})
+    # c is the cell in the second row
+    assert c[0]["Instances"][0]["BoundingBox"] == pytest.approx({"Left": 0.1, "Top": 0.2, "Width": 0.4, "Height": 0.4})
+
+
+def test_boxes_crossing_frames_are_dropped():
+    labels = [label("Truck", instance(80, 10, 40, 20)), label("Car", instance(10, 40, 20, 20))]
+    assert process_queue_sync.split_mosaic_labels(labels, LAYOUT) == [[], [], []]
+
+
+def test_boxes_in_empty_cells_are_dropped():
+    assert process_queue_sync.split_mosaic_labels([label("Car", instance(110, 60, 20, 20))], LAYOUT) == [[], [], []]
+
+
+def test_labels_without_boxes_are_not_given_to_every_frame():
+    labels = [label("Road"), label("Person", instance(10, 10, 20, 20))]
+
+    a, b, c = process_queue_sync.split_mosaic_labels(labels, LAYOUT)
+
+    assert [l["Name"] for l in a] == ["Person"]
+    assert b == c == []
+    assert not process_queue_sync.contains_vru(b)
+
+
+def test_labels_without_boxes_describe_a_single_frame_mosaic():
+    layout = dict(LAYOUT, tiles=LAYOUT["tiles"][:1])
+    assert process_queue_sync.split_mosaic_labels([label("Road")], layout) == [[label("Road")]]
+
+
+def test_unplaced_vru():
+    assert process_queue_sync.unplaced_vru([label("Person")], LAYOUT)
+    assert not process_queue_sync.unplaced_vru([label("Person", instance(10, 10, 20, 20))], LAYOUT)
+    assert not process_queue_sync.unplaced_vru([label("Road")], LAYOUT)
+    assert not process_queue_sync.unplaced_vru([label("Person")], dict(LAYOUT, tiles=LAYOUT["tiles"][:1]))
+
+
+def frame_key(n):
+    return f"drive/camera/image_raw-2020-12-16T23_32_{n:02d}.000000-{n:04d}.png"
+
+
+@pytest.mark.parametrize("mosaic_labels, relabelled", [([label("Person")], True), ([label("Road")], False)])
+def test_mosaic_with_unplaced_vru_is_labelled_frame_by_frame(monkeypatch, mosaic_labels, relabelled):
+    layout = dict(LAYOUT, tiles=[[frame_key(n), 100, 50] for n in range(3)])
+    metadata = {"tiles": "drive/camera/mosaics/image_raw-0.json", "sha256": "ab", "drive": "drive"}
+    monkeypatch.setenv("frame_duration", "67")
+    monkeypatch.setattr(process_queue_sync.s3, "head_object", lambda Bucket, Key: {"Metadata": metadata})
+    layouts = FakeS3({metadata["tiles"]: json.dumps(layout).encode()})
+    monkeypatch.setattr(process_queue_sync.s3, "get_object", layouts.get_object)
+    monkeypatch.setattr(process_queue_sync, "cached_labels", lambda frame_hash: mosaic_labels)
+    calls = []
+    # only the second frame has the person in it
+    monkeypatch.setattr(
+        process_queue_sync,
+        "detect_labels",
+        lambda bucket, key: (calls.append(key) or ([label("Person")] if key == frame_key(1) else []), "3.0"),
+    )
+    message = {"body": json.dumps({"Records": [{"s3": {"bucket": {"name": "bucket"},
+                                                       "object": {"key": "drive/camera/mosaics/image_raw-0.png"}}}]})}
+
+    _, _, _, frames = process_queue_sync.label_frame(message)
+
+    assert [key for _, key, _ in frames] == [frame_key(n) for n in range(3)]
+    if relabelled:
+        assert calls == [frame_key(n) for n in range(3)]
+        assert [process_queue_sync.contains_vru(labels) for _, _, labels in frames] == [False, True, False]
+    else:
+        assert calls == []
+        assert [labels for _, _, labels in frames] == [[], [], []]
+
+
+class Writer:
+    def __init__(self):
+        self.objects = {}
+        self.metadata = {}
+
+    def put_object(self, key, body, **kwargs):
+        self.objects[key] = body
+
+    def upload_file(self, filename, key, extra_args=None, on_success=None):
+        self.metadata[key] = extra_args["Metadata"]
+
+
+class Manifest:
+    def matches(self, key, size, sha256):
+        return False
+
+
+def test_mosaic_layout_is_written_next_to_the_mosaic(tmp_path):
+    # a 10x10 grid of frames with long keys, more than S3 takes as user metadata
+    tiles = [[str(tmp_path / "drive" / frame_key(n)), 100, 50] for n in range(100)]
+    layout = dict(LAYOUT, cols=10, rows=10, tiles=tiles)
+    mosaic = tmp_path / "drive" / "camera" / "mosaics" / "image_raw-0.png"
+    mosaic.parent.mkdir(parents=True)
+    mosaic.write_bytes(b"png")
+    upload = main.Uploader("bucket", 20, "drive")
+    upload.working_dir = f"{tmp_path}/"
+    writer = Writer()
+
+    upload.upload(writer, Manifest(), str(mosaic), metadata={"tiles": json.dumps(layout)})
+
+    metadata = writer.metadata["drive/camera/mosaics/image_raw-0.png"]
+    assert metadata["tiles"] == "drive/camera/mosaics/image_raw-0.json"
+    assert len(json.dumps(metadata)) < 2048
+    written = json.loads(writer.objects[metadata["tiles"]])
+    assert [tile[0] for tile in written["tiles"]] == [f"drive/{frame_key(n)}" for n in range(100)]
@@ -0,0 +1,79 @@
+import json
+
+import pytest
+
+import main
+from bagfixture import FakeS3, make_bag, string_messages
+from bagindex import read_bag_index
+from conftest import load_lambda
+from test_checkpoint import extract, read, stitch
+
+plan_bag_ranges = load_lambda("plan-bag-ranges")
+
+pytestmark = pytest.mark.usefixtures("string_messages_only")
+
+
+@pytest.fixture
+def bag():
+    return make_bag(string_messages(9))
+
+
+def test_partition_chunks(bag):
+    index = read_bag_index(FakeS3({"a.bag": bag}), "bucket", "a.bag")
+    ranges = plan_bag_ranges.partition_chunks(index, 3)
+
+    assert len(ranges) == 3
+    # contiguous, covering every chunk and ending at the index
+    assert [c for _, _, chunks in ranges for c in chunks] == index["chunks"]
+    assert ranges[0][0] == index["chunks"][0]["pos"]
+    assert all(ranges[i][1] == ranges[i + 1][0] for i in range(2))
+    assert ranges[-1][1] == index["index_pos"]
+
+
+def test_plan_ranges_carries_frame_counts(bag):
+    index = read_bag_index(FakeS3({"a.bag": bag}), "bucket", "a.bag")
+    ranges = plan_bag_ranges.plan_ranges(index, 3)
+
+    # the messages of each topic in the chunks before the range
+    expected = []
+    for start, _, _ in plan_bag_ranges.partition_chunks(index, 3):
+        before = [c for c in index["chunks"] if c["pos"] < start]
+        expected.append({topic: sum(c["counts"][conn] for c in before)
+                         for conn, topic in [("00000000", "/gps"), ("01000000", "/status")]})
+    counts = [{c["header"]["topic"]: c["frame_count"] for c in r["checkpoint"]["connections"]} for r in ranges]
+    assert counts == expected
+    assert counts[1]["/gps"] > 0
+    assert all(c["csv_part"] == 0 for r in ranges for c in r["checkpoint"]["connections"])
+
+
+def test_ranges_stitch_to_full_extraction(bag, tmp_path, monkeypatch):
+    extract(bag, tmp_path / "full" / "drive")
+    index = read_bag_index(FakeS3({"a.bag": bag}), "bucket", "a.bag")
+    plan = json.loads(json.dumps(plan_bag_ranges.plan_ranges(index, 3)))
+
+    # each range task checkpoints after every chunk, the merge task only sees the parts in S3
+    parts = {}
+    last_parts = {}
+    for i, byte_range in enumerate(plan):
+        uploads = extract(bag[: byte_range["end"]], tmp_path / f"range{i}" / "drive", [],
+                          checkpoint=byte_range["checkpoint"], checkpoint_interval=0, range_index=i)
+        upload = main.Uploader("bucket", 20, "drive", range_index=i)
+        upload.working_dir = f"{tmp_path / f'range{i}'}/"
+        for file in uploads:
+            upload.add_part(file)
+            with open(file, "rb") as f:
+                parts[file[len(upload.working_dir):]] = f.read()
+        last_parts.update(upload.last_parts)
+
+    stitch(monkeypatch, tmp_path / "merge", [], parts, last_parts)
+    for topic in ["gps", "status"]:
+        assert read(tmp_path / "merge" / "drive" / f"{topic}.csv") == read(tmp_path / "full" / "drive" / f"{topic}.csv")
+
+
+def test_parts_sort_by_range_then_number():
+    keys = ["d/csv-parts/gps.part0001_000000.csv", "d/csv-parts/gps.part0000_001000.csv",
+            "d/csv-parts/gps.part0000_000002.csv"]
+    parts = sorted(main.csv_part(key)[1:] for key in keys)
+    assert parts == [("d/csv-parts/gps.part0000_", 2), ("d/csv-parts/gps.part0000_", 1000),
+                     ("d/csv-parts/gps.part0001_", 0)]
+    assert {main.csv_part(key)[0] for key in keys} == {"d/gps.csv"}
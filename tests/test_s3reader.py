@@ -0,0 +1,104 @@
+import pytest
+from botocore.exceptions import ClientError
+
+import s3reader
+from bagfixture import FakeS3
+from s3reader import S3RangeReader
+
+DATA = bytes(range(200))
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(s3reader.time, "sleep", lambda seconds: None)
+
+
+class ConditionalS3(FakeS3):
+    """ FakeS3 answering a ranged GET made on another version of the object the way S3 does, and failing the first
+    failures GETs it is sent"""
+
+    def __init__(self, objects, failures=0):
+        super().__init__(objects)
+        self.failures = failures
+
+    def get_object(self, Bucket, Key, Range=None, IfMatch=None):
+        if IfMatch is not None and IfMatch != self.head_object(Bucket=Bucket, Key=Key)["ETag"]:
+            raise ClientError({"Error": {"Code": "PreconditionFailed"}, "ResponseMetadata": {"HTTPStatusCode": 412}},
+                              "GetObject")
+        if self.failures:
+            self.failures -= 1
+            raise ClientError({"Error": {"Code": "SlowDown"}, "ResponseMetadata": {"HTTPStatusCode": 503}}, "GetObject")
+        return super().get_object(Bucket=Bucket, Key=Key, Range=Range)
+
+
+def test_reads_are_served_across_parts():
+    reader = S3RangeReader(FakeS3({"bag": DATA}), "bucket", "bag", connections=3, part_size=16)
+
+    assert reader.read(10) == DATA[:10]
+    assert reader.read(40) == DATA[10:50]
+    assert reader.read() == DATA[50:]
+    assert reader.read(1) == b""
+    reader.close()
+
+
+def test_reads_ahead_a_bounded_number_of_parts():
+    s3 = FakeS3({"bag": DATA})
+    reader = S3RangeReader(s3, "bucket", "bag", start=8, end=108, connections=3, part_size=16)
+
+    # the first three parts are requested before anything is read
+    assert len(reader.parts) == 3
+    assert reader.next_offset == 8 + 3 * 16
+
+    # taking the first part off queues the fourth
+    assert reader.read(1) == DATA[8:9]
+    assert len(reader.parts) == 3
+    assert reader.next_offset == 8 + 4 * 16
+
+    assert reader.read() == DATA[9:108]
+    reader.close()
+    assert sorted(r for _, r in s3.gets) == sorted(
+        f"bytes={start}-{min(start + 16, 108) - 1}" for start in range(8, 108, 16)
+    )
+
+
+def test_seek_reads_from_the_new_position():
+    reader = S3RangeReader(FakeS3({"bag": DATA}), "bucket", "bag", connections=2, part_size=16)
+    reader.read(5)
+
+    reader.seek(150)
+
+    assert reader.read(20) == DATA[150:170]
+    reader.close()
+
+
+def test_failed_parts_are_retried():
+    s3 = ConditionalS3({"bag": DATA}, failures=2)
+    reader = S3RangeReader(s3, "bucket", "bag", connections=1, part_size=64, max_attempts=3)
+
+    assert reader.read() == DATA
+    reader.close()
+
+
+def test_parts_failing_every_attempt_fail_the_read():
+    s3 = ConditionalS3({"bag": DATA}, failures=3)
+    reader = S3RangeReader(s3, "bucket", "bag", connections=1, part_size=64, max_attempts=3)
+
+    with pytest.raises(ClientError):
+        reader.read()
+    reader.close()
+
+
+def test_object_replaced_while_being_read_fails_the_read():
+    s3 = ConditionalS3({"bag": DATA})
+    etag = s3.head_object(Bucket="bucket", Key="bag")["ETag"]
+    reader = S3RangeReader(s3, "bucket", "bag", etag=etag, connections=1, part_size=64, max_attempts=2)
+    assert reader.read(64) == DATA[:64]
+
+    # a new version of the bag is uploaded, the parts still to be read are not taken from it
+    s3.objects["bag"] = DATA + b"more"
+    reader.seek(64)
+
+    with pytest.raises(ClientError) as e:
+        reader.read()
+    assert e.value.response["Error"]["Code"] == "PreconditionFailed"
+    reader.close()
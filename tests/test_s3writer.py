@@ -0,0 +1,97 @@
+import pytest
+from boto3.exceptions import S3UploadFailedError
+from botocore.exceptions import ClientError, EndpointConnectionError, ParamValidationError, ReadTimeoutError
+
+import s3writer
+from s3writer import S3Writer
+
+
+def upload_failed(code):
+    """ upload_file's error, which only names the code S3 answered with in its message"""
+    return S3UploadFailedError(f"Failed to upload a.png: An error occurred ({code}) when calling the PutObject op")
+
+
+def client_error(code, status):
+    return ClientError({"Error": {"Code": code}, "ResponseMetadata": {"HTTPStatusCode": status}}, "PutObject")
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(s3writer.time, "sleep", lambda seconds: None)
+
+
+def failing(*errors):
+    """ A request failing with each of errors in turn and then succeeding, counting its calls"""
+    calls = []
+
+    def request():
+        calls.append(1)
+        if len(calls) <= len(errors):
+            raise errors[len(calls) - 1]
+
+    return request, calls
+
+
+@pytest.mark.parametrize(
+    "error",
+    [
+        client_error("SlowDown", 503),
+        client_error("InternalError", 500),
+        client_error("RequestTimeout", 400),
+        upload_failed("SlowDown"),
+        EndpointConnectionError(endpoint_url="https://s3.amazonaws.com"),
+        ReadTimeoutError(endpoint_url="https://s3.amazonaws.com"),
+    ],
+)
+def test_transient_errors_are_retried(error):
+    writer = S3Writer(None, "bucket")
+    request, calls = failing(error, error)
+
+    assert writer.write("a/b.png", request)
+
+    assert len(calls) == 3
+    assert writer.dead_letters == []
+
+
+@pytest.mark.parametrize(
+    "error",
+    [
+        client_error("AccessDenied", 403),
+        client_error("NoSuchBucket", 404),
+        upload_failed("AccessDenied"),
+        ParamValidationError(report="bad key"),
+    ],
+)
+def test_other_errors_go_straight_to_the_dead_letters(error):
+    writer = S3Writer(None, "bucket")
+    request, calls = failing(error)
+
+    assert not writer.write("a/b.png", request)
+
+    assert len(calls) == 1
+    assert writer.dead_letters == [("a/b.png", request, None)]
+    # retried once the extraction has finished
+    assert writer.retry_dead_letters() == []
+    assert len(calls) == 2
+
+
+def test_writes_failing_every_attempt_go_to_the_dead_letters():
+    writer = S3Writer(None, "bucket", max_attempts=3)
+    request, calls = failing(*[client_error("SlowDown", 503)] * 3)
+
+    assert not writer.write("a/b.png", request)
+
+    assert len(calls) == 3
+    assert [key for key, _, _ in writer.dead_letters] == ["a/b.png"]
+
+
+def test_writes_made_when_retried_call_on_success():
+    writer = S3Writer(None, "bucket")
+    request, calls = failing(client_error("AccessDenied", 403))
+    written = []
+
+    assert not writer.write("a/b.png", request, on_success=lambda: written.append("a/b.png"))
+    assert written == []
+
+    assert writer.retry_dead_letters() == []
+    assert written == ["a/b.png"]
@@ -0,0 +1,110 @@
+import time
+
+import pytest
+from botocore.exceptions import ClientError
+
+from conftest import load_lambda
+
+process_video_labels = load_lambda("process-video-labels")
+
+NOTIFICATION = {"JobId": "job", "Status": "SUCCEEDED", "Video": {"S3Bucket": "bucket", "S3ObjectName": "a/cam.mp4"}}
+
+
+class FakeJobs:
+    """ The jobs table, with the claim's condition evaluated the way claim_job words it"""
+
+    def __init__(self):
+        self.items = {}
+
+    def put_item(self, TableName, Item, ConditionExpression, ExpressionAttributeNames, ExpressionAttributeValues):
+        current = self.items.get(Item["JobId"]["S"])
+        if current is not None and (
+            current["status"]["S"] == ExpressionAttributeValues[":done"]["S"]
+            or int(current["claimed_at"]["N"]) >= int(ExpressionAttributeValues[":stale"]["N"])
+        ):
+            raise ClientError({"Error": {"Code": "ConditionalCheckFailedException"}}, "PutItem")
+        self.items[Item["JobId"]["S"]] = Item
+
+    def update_item(self, TableName, Key, ExpressionAttributeValues, **kwargs):
+        self.items[Key["JobId"]["S"]]["status"] = ExpressionAttributeValues[":done"]
+
+    def delete_item(self, TableName, Key):
+        del self.items[Key["JobId"]["S"]]
+
+
+@pytest.fixture
+def jobs(monkeypatch):
+    table = FakeJobs()
+    monkeypatch.setenv("jobs_table", "jobs")
+    monkeypatch.setattr(process_video_labels, "dynamo", table)
+    return table
+
+
+@pytest.fixture
+def written(monkeypatch):
+    notifications = []
+    monkeypatch.setattr(process_video_labels, "write_detection_results", notifications.append)
+    return notifications
+
+
+def test_redelivered_notification_is_written_once(jobs, written):
+    process_video_labels.finish_detection(NOTIFICATION)
+    process_video_labels.finish_detection(NOTIFICATION)
+
+    assert written == [NOTIFICATION]
+    assert jobs.items["job"]["status"]["S"] == "done"
+
+
+def test_notification_redelivered_while_being_written_is_skipped(jobs, written):
+    assert process_video_labels.claim_job("job")
+    process_video_labels.finish_detection(NOTIFICATION)
+    assert written == []
+
+
+def test_failed_write_is_retried_on_redelivery(monkeypatch, jobs, written):
+    def fail(notification):
+        raise RuntimeError("throttled")
+
+    monkeypatch.setattr(process_video_labels, "write_detection_results", fail)
+    with pytest.raises(RuntimeError):
+        process_video_labels.finish_detection(NOTIFICATION)
+    assert jobs.items == {}
+
+    monkeypatch.setattr(process_video_labels, "write_detection_results", written.append)
+    process_video_labels.finish_detection(NOTIFICATION)
+    assert written == [NOTIFICATION]
+
+
+def test_claim_left_by_a_dead_invocation_is_taken_over(monkeypatch, jobs, written):
+    assert process_video_labels.claim_job("job")
+    later = time.time() + process_video_labels.CLAIM_SECONDS + 1
+    monkeypatch.setattr(process_video_labels.time, "time", lambda: later)
+
+    process_video_labels.finish_detection(NOTIFICATION)
+
+    assert written == [NOTIFICATION]
+
+
+class FakeProgress:
+    """ The progress table, applying the labelled counter the way update_progress words its update"""
+
+    def __init__(self):
+        self.items = {}
+
+    def update_item(self, TableName, Key, UpdateExpression, ExpressionAttributeNames, ExpressionAttributeValues):
+        item = self.items.setdefault((Key["drive"]["S"], Key["camera"]["S"]), {"labelled": 0})
+        n = int(ExpressionAttributeValues[":n"]["N"])
+        item["labelled"] = item["labelled"] + n if UpdateExpression.startswith("ADD") else n
+
+
+def test_video_labelled_again_is_counted_once(monkeypatch):
+    progress = FakeProgress()
+    monkeypatch.setenv("progress_table", "progress")
+    monkeypatch.setattr(process_video_labels, "dynamo", progress)
+    monkeypatch.setattr(process_video_labels.s3, "head_object", lambda Bucket, Key: {"Metadata": {"drive": "a"}})
+
+    # the job of the mp4 and the job of the same mp4 regenerated by a resumed extraction
+    process_video_labels.update_progress("bucket", "a/cam.mp4", 120)
+    process_video_labels.update_progress("bucket", "a/cam.mp4", 120)
+
+    assert progress.items == {("a", "cam"): {"labelled": 120}}
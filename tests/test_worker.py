@@ -0,0 +1,87 @@
+import json
+
+import pytest
+
+import main
+
+
+class FakeSQS:
+    """ Hands out the messages of each receive in turn, and reports queue depths from a list, one per check"""
+
+    def __init__(self, receives, depths):
+        self.receives = list(receives)
+        self.depths = list(depths)
+        self.waits = []
+        self.deleted = []
+
+    def receive_message(self, QueueUrl, WaitTimeSeconds, **kwargs):
+        self.waits.append(WaitTimeSeconds)
+        return {"Messages": self.receives.pop(0) if self.receives else []}
+
+    def get_queue_attributes(self, QueueUrl, AttributeNames):
+        depth = self.depths.pop(0)
+        return {"Attributes": {name: str(depth) if name == AttributeNames[0] else "0" for name in AttributeNames}}
+
+    def delete_message(self, QueueUrl, ReceiptHandle):
+        self.deleted.append(ReceiptHandle)
+
+
+class FakeTable:
+    def __init__(self):
+        self.items = []
+
+    def put_item(self, Item):
+        self.items.append(Item)
+
+
+class FinishedProcess:
+    """ A child process that has extracted its bag by the time the worker checks on it"""
+
+    exitcode = 0
+
+    def __init__(self, target, args):
+        pass
+
+    def start(self):
+        pass
+
+    def is_alive(self):
+        return False
+
+    def join(self):
+        pass
+
+
+def message(key):
+    job = dict(bucket="bucket", key=key, dest_bucket="dest", mode="extract", fingerprint=f"fp-{key}")
+    return {"Body": json.dumps(job), "ReceiptHandle": key}
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    table = FakeTable()
+    monkeypatch.setattr(main.boto3, "resource", lambda name: type("Dynamo", (), {"Table": lambda self, t: table})())
+    monkeypatch.setattr(main, "Process", FinishedProcess)
+    return table
+
+
+def run_worker(monkeypatch, sqs):
+    monkeypatch.setattr(main.boto3, "client", lambda name: sqs)
+    return main.run_worker("queue", "cache", 15, 60, 4, 0, concurrency=2, idle_seconds=0)
+
+
+def test_idle_worker_stops_once_the_queue_is_empty(monkeypatch, cache):
+    sqs = FakeSQS(receives=[], depths=[0])
+    assert run_worker(monkeypatch, sqs) == 0
+    assert sqs.waits == [0]
+
+
+def test_idle_worker_picks_up_a_bag_queued_as_it_stops(monkeypatch, cache):
+    # the last receive misses a bag the queue already counts, the next one gets it
+    sqs = FakeSQS(receives=[[], [message("a.bag")]], depths=[1, 0])
+
+    assert run_worker(monkeypatch, sqs) == 0
+
+    assert sqs.deleted == ["a.bag"]
+    assert [item["key"] for item in cache.items] == ["a.bag"]
+    assert sqs.depths == []